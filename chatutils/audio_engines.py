@@ -21,6 +21,8 @@ logger.addHandler(handler)
 
 import os
 
+from chatutils.resilience import with_retries, CircuitOpenError
+
 class WhisperEngine:
     def __init__(self):
         '''
@@ -65,6 +67,8 @@ class WhisperEngine:
         self.client = AsyncOpenAI(
             api_key=api_key,
             base_url=base_url,
+            # retries are done by chatutils.resilience (with circuit breaker)
+            max_retries=0,
         )
 
         print('Audio transcription via Whisper is enabled')
@@ -131,14 +135,20 @@ class WhisperEngine:
             logger.debug(f"Attempting to transcribe file: {converted_file}")
             logger.debug(f"Using API base URL: {self.client.base_url}")
             
-            with open(converted_file, "rb") as audio:
-                transcript = await self.client.audio.transcriptions.create(
-                    model=self.settings["AudioModel"],
-                    file=audio,
-                )
+            async def request_transcription():
+                # file is opened for every attempt, so retries upload it from the start
+                with open(converted_file, "rb") as audio:
+                    return await self.client.audio.transcriptions.create(
+                        model=self.settings["AudioModel"],
+                        file=audio,
+                    )
+            transcript = await with_retries(request_transcription, 'openai-audio')
             
             os.remove(converted_file)
             return transcript.text
+        except CircuitOpenError as e:
+            logger.error(f'Audio transcription is unavailable: {e}')
+            return 'Service is temporarily unavailable. Please try again later.'
         except self.openai.RateLimitError as e:
             logger.error(f'OpenAI RateLimitError: {e}')
             return 'Service is getting rate limited. Please try again later.'
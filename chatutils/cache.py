@@ -0,0 +1,286 @@
+# Description: Caches of summaries and other results for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Cache")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''
+    LRU cache with time to live
+    Size of the cache is the sum of sizes of values (sizeof(value), 1 for every value by default),
+    least recently used values are evicted when it is over max_size.
+    '''
+    def __init__(self, max_size=1000, ttl=3600, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None or item[0] < time.time():
+            if item is not None:
+                self.pop(key)
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def get_stale(self, key):
+        '''
+        Get value even if it is expired (e.g. to revalidate it), None if there is no value
+        '''
+        item = self.items.get(key)
+        return item[1] if item is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        self.items[key] = (expires, value, size)
+        self.size += size
+        while self.size > self.max_size:
+            self.pop(next(iter(self.items)))
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+        return item[1] if item is not None else None
+
+    def stats(self):
+        return {"items": len(self.items), "size": self.size, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls with the same key into one call
+    The first caller runs the function, others wait for its result.
+    '''
+    def __init__(self):
+        self.calls = {}
+
+    async def run(self, key, func):
+        while key in self.calls:
+            future = self.calls[key]
+            try:
+                # shield: cancelling one of waiters should not cancel the call for everyone
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the first caller was cancelled, the call is made again
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # exception is raised for this caller, retrieve it so it is not logged as unhandled
+            future.exception()
+            raise
+        finally:
+            del self.calls[key]
+
+
+def get_cache_settings():
+    '''
+    Settings of the optional [Cache] section
+    '''
+    def get(option, default):
+        return config.getint("Cache", option) if config.has_option("Cache", option) else default
+    return {
+        "SummaryCacheSize": get("SummaryCacheSize", 1000),
+        "SummaryCacheTTL": get("SummaryCacheTTL", 86400),
+        "SummaryDiskCache": config.getboolean("Cache", "SummaryDiskCache") if config.has_option("Cache", "SummaryDiskCache") else True,
+        "ImageDescriptionCacheSize": get("ImageDescriptionCacheSize", 1000),
+        "ImageDescriptionDiskCache": config.getboolean("Cache", "ImageDescriptionDiskCache") if config.has_option("Cache", "ImageDescriptionDiskCache") else True,
+        "DescribeConcurrency": get("DescribeConcurrency", 4),
+    }
+
+
+class SummaryCache:
+    '''
+    Cache of summaries keyed by hash of the model, size and text
+    The same URL or document is often summarized many times by different users.
+    Summaries are kept in memory (LRU with TTL) and optionally in the chat store (disk tier),
+    concurrent requests of the same summary are sent to the provider once.
+    Cached summary costs nothing, so its token usage is zero.
+    '''
+    def __init__(self, max_size=1000, ttl=86400):
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.flights = SingleFlight()
+        self.store = None
+
+    def bind(self, store):
+        '''
+        Use the chat store as the disk tier (old summaries are removed)
+        '''
+        try:
+            store.delete_expired_summaries(time.time() - self.ttl)
+            self.store = store
+        except Exception as e:
+            logger.exception('Could not use the chat store for summaries')
+
+    def digest(self, model, size, text):
+        return hashlib.sha1(f'{model}\0{size}\0{text}'.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def wrap(self, engine):
+        '''
+        Wrap summary method of the engine with the cache
+        '''
+        summary = engine.summary
+        # summary of Yandex GPT is made by a separate model
+        model = f'{type(engine).__name__}/{engine.model}/{getattr(engine, "chat_vars", {}).get("SummarisationModel", "")}'
+        async def cached_summary(text, size=None):
+            kwargs = {"size": size} if size is not None else {}
+            return await self.get(model, size, text, lambda: summary(text, **kwargs))
+        engine.summary = cached_summary
+        return engine
+
+    async def get(self, model, size, text, func):
+        '''
+        Get summary from the cache or from func (coroutine function that returns summary and token usage)
+        '''
+        digest = self.digest(model, size, text)
+        summary = self.memory.get(digest)
+        if summary is None and self.store is not None:
+            try:
+                summary = self.store.load_summary(digest, time.time() - self.ttl)
+                if summary is not None:
+                    self.memory.set(digest, summary)
+            except Exception as e:
+                logger.error(f'Could not load summary from the chat store: {e}')
+        if summary is not None:
+            logger.debug(f'Summary {digest} was taken from the cache')
+            return summary, {"prompt": 0, "completion": 0}
+
+        leader = []
+        async def compute():
+            leader.append(True)
+            result = await func()
+            if type(result) == tuple and len(result) > 0 and result[0] is not None:
+                self.memory.set(digest, result[0])
+                if self.store is not None:
+                    self.store.save_summary(digest, result[0], time.time())
+            return result
+        result = await self.flights.run(digest, compute)
+        if len(leader) == 0 and type(result) == tuple and len(result) > 1:
+            # tokens are counted only for the caller whose request was sent
+            return result[0], {"prompt": 0, "completion": 0}
+        return result
+
+
+def image_digest(message):
+    '''
+    Hash of the first image of message (data URL of the image), None if there are no images
+    '''
+    content = message.get('content') if type(message) == dict else None
+    if type(content) != list:
+        return None
+    for item in content:
+        if type(item) == dict and item.get('type') == 'image_url':
+            url = item['image_url'].get('url') if type(item['image_url']) == dict else item['image_url']
+            return hashlib.sha1(str(url).encode('utf-8')).hexdigest()
+    return None
+
+
+class ImageDescriptionCache:
+    '''
+    Cache of image descriptions keyed by hash of the image content
+    The same image is described when chat is summarized and when it is deleted from history,
+    so it is described once. Descriptions are kept in memory and optionally in the chat store,
+    not more than `concurrency` images are described at the same time (for all users).
+    '''
+    def __init__(self, max_size=1000, concurrency=4):
+        # images do not change, entries are removed only when the cache is full
+        self.memory = TTLCache(max_size=max_size, ttl=float('inf'))
+        self.flights = SingleFlight()
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.store = None
+
+    def bind(self, store):
+        '''
+        Use the chat store to keep descriptions between restarts
+        '''
+        self.store = store
+
+    def wrap(self, engine):
+        '''
+        Wrap describe_image method of the engine with the cache
+        '''
+        describe = engine.describe_image
+        model = f'{type(engine).__name__}/{engine.model}'
+        async def cached_describe_image(message, user_id=None):
+            digest = image_digest(message)
+            if digest is None:
+                return await describe(message, user_id)
+            digest = hashlib.sha1(f'{model}\0{digest}'.encode('utf-8')).hexdigest()
+            return await self.get(digest, lambda: describe(message, user_id))
+        engine.describe_image = cached_describe_image
+        return engine
+
+    async def get(self, digest, func):
+        '''
+        Get description from the cache or from func (coroutine function that returns description and token usage)
+        '''
+        description = self.memory.get(digest)
+        if description is None and self.store is not None:
+            try:
+                description = self.store.load_image_description(digest)
+                if description is not None:
+                    self.memory.set(digest, description)
+            except Exception as e:
+                logger.error(f'Could not load image description from the chat store: {e}')
+        if description is not None:
+            logger.debug(f'Description of image {digest} was taken from the cache')
+            return description, {"prompt": 0, "completion": 0}
+
+        leader = []
+        async def compute():
+            leader.append(True)
+            async with self.semaphore:
+                result = await func()
+            if type(result) == tuple and len(result) > 0 and result[0] is not None:
+                self.memory.set(digest, result[0])
+                if self.store is not None:
+                    self.store.save_image_description(digest, result[0], time.time())
+            return result
+        result = await self.flights.run(digest, compute)
+        if len(leader) == 0 and type(result) == tuple and len(result) > 1:
+            # tokens are counted only for the caller whose request was sent
+            return result[0], {"prompt": 0, "completion": 0}
+        return result
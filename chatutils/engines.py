@@ -21,9 +21,17 @@ logger.addHandler(handler)
 
 import os
 import hashlib
+import httpx
 import tiktoken
 import asyncio
 import json
+from types import SimpleNamespace
+
+from chatutils.tokens import TokenCounter
+from chatutils.history import completion_budget
+from chatutils.http_client import AsyncHTTPClient
+from chatutils.resilience import CircuitOpenError, HTTPStatusError
+from chatutils.pool import ClientPool, PoolMember, pool_sections, get_option
 
 
 ######## OpenAI Engine ########
@@ -37,6 +45,7 @@ class OpenAIEngine:
         from openai import AsyncOpenAI
         import openai 
         self.openai = openai
+        self.AsyncOpenAI = AsyncOpenAI
         import configparser
         self.config = configparser.SafeConfigParser({
             "ChatModel": "gpt-3.5-turbo",
@@ -65,10 +74,12 @@ class OpenAIEngine:
                 self.base_url = None
         # Set up the API 
         # TODO: working with other parameters
-        self.client = AsyncOpenAI(
-            api_key=self.config.get("OpenAI", "SecretKey"),
-            base_url=self.base_url,
-        )
+        # functions that get headers of every API response (e.g. rate limit budgets)
+        self.response_hooks = []
+        # keys and endpoints from [OpenAI] and [OpenAI.<name>] sections
+        self.pool = ClientPool('openai', [self.get_member(section) for section in pool_sections("OpenAI")])
+        # main client (moderation, image descriptions)
+        self.client = self.pool.members[0].client
         self.text_initiation, self.speech_initiation = text, speech
         self.text_init() if self.text_initiation else None
         self.speech_init() if self.speech_initiation else None
@@ -81,6 +92,7 @@ class OpenAIEngine:
         except KeyError:
             logger.warning(f"Could not get encoding for model `{self.model.split('/')[-1]}`, falling back to encoding for `{self.fallback_enc_base}`")
             self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
 
         logger.info('OpenAI Engine was initialized')
 
@@ -91,6 +103,11 @@ class OpenAIEngine:
         self.model = self.config.get("OpenAI", "ChatModel")
         self.model_completion_price = float(self.config.get("OpenAI", "ChatModelCompletionPrice")) 
         self.model_prompt_price = float(self.config.get("OpenAI", "ChatModelPromptPrice")) 
+        # prompt prefixes are cached by OpenAI (and OpenRouter) automatically, cached tokens are cheaper
+        self.prompt_caching = True
+        self.cache_read_price = float(self.config.get("OpenAI", "CacheReadPrice")) if self.config.has_option("OpenAI", "CacheReadPrice") else self.model_prompt_price * 0.5
+        # cache writes are not reported (and not billed) by OpenAI
+        self.cache_write_price = None
         self.temperature = float(self.config.get("OpenAI", "Temperature"))
         self.max_tokens = int(self.config.get("OpenAI", "MaxTokens"))
         self.end_user_id = self.config.getboolean("OpenAI", "EndUserID") 
@@ -132,20 +149,52 @@ class OpenAIEngine:
             print('-- Function calling is used to call functions from OpenAI API. It can be changed in the self.config file.')
             print('-- Learn more: https://platform.openai.com/docs/guides/function-calling\n')
         
+    def get_member(self, section):
+        '''
+        Create pool member for config section with key, endpoint and (optionally) model
+        APIBase is taken from [OpenAI] if it is not set in the section
+        '''
+        member = PoolMember(section, model=get_option(section, "ChatModel") if section != "OpenAI" else None)
+        base_url = get_option(section, "APIBase", "OpenAI")
+        if base_url is not None and base_url.lower() in ['default', '', 'none', 'false']:
+            base_url = None
+        member.client = self.AsyncOpenAI(
+            api_key=get_option(section, "SecretKey"),
+            base_url=base_url,
+            http_client=httpx.AsyncClient(event_hooks={"response": [member.on_response, self.on_response]}),
+            # retries are done by chatutils.resilience (with circuit breaker)
+            max_retries=0,
+        )
+        return member
+
+    async def on_response(self, response):
+        '''
+        Pass headers of API response to response hooks
+        '''
+        if len(self.pool.members) > 1:
+            # headers describe budget of one key, pool keeps them per member
+            return
+        for hook in self.response_hooks:
+            try:
+                hook(response.headers)
+            except Exception as e:
+                logger.debug(f'Response hook failed: {e}')
+
     async def detect_function_called(self, response):
         '''
         TODO: Function calling is in experimental stage
 
-        Detect if function was called in response
+        Detect if functions were called in response
         Learn more: https://platform.openai.com/docs/guides/function-calling
         Input:
             * response - response from GPT
         Output:
-            * response - response from GPT (None if function was not detected or there was an error)
+            * response - ('function', calls, tokens, text) if functions were called, where calls are
+              [{"id": str, "name": str, "args": dict}, ...] (all tool calls of the response),
+              otherwise the same response
         '''
         response_message = None
         text = None
-        tool_id = None
         try:
             logger.debug(f'Detecting function called in response: "{response}"')
             if response is None:
@@ -160,19 +209,44 @@ class OpenAIEngine:
             tool_calls = response_message.tool_calls
             if not tool_calls:
                 return response
-            function_name = tool_calls[0].function.name
-            function_args = json.loads(tool_calls[0].function.arguments)
-            # tool_id = tool_calls[0].tool_id
-            tokens = {
-                "prompt": response.usage.prompt_tokens,
-                "completion": response.usage.completion_tokens
-            }
-            return ('function', function_name, function_args, tokens, text, tool_id)
+            calls = []
+            for tool_call in tool_calls:
+                try:
+                    function_args = json.loads(tool_call.function.arguments or '{}')
+                except ValueError:
+                    # tool registry answers the model that arguments are invalid
+                    function_args = None
+                calls.append({"id": tool_call.id, "name": tool_call.function.name, "args": function_args})
+            text = response_message.content
+            tokens = self.get_usage(response.usage)
+            return ('function', calls, tokens, text)
         except Exception as e:
             logger.error(f'Could not detect function called: {e}. Response: {response_message}')
             return response
+
+    def tool_messages(self, calls, text, results):
+        '''
+        Messages for chat history with tool calls of the model and their results
+        Input:
+            * calls - tool calls (see detect_function_called)
+            * text - text of the model that came with the calls
+            * results - results of the calls in the same order ({"content": str, ...})
+        Output: assistant message with tool_calls and a "tool" message for every call
+        '''
+        messages = [{
+            "role": "assistant",
+            "content": text,
+            "tool_calls": [{
+                "id": call["id"],
+                "type": "function",
+                "function": {"name": call["name"], "arguments": json.dumps(call["args"], ensure_ascii=False)},
+            } for call in calls],
+        }]
+        for call, result in zip(calls, results):
+            messages.append({"role": "tool", "tool_call_id": call["id"], "content": str(result["content"])})
+        return messages
         
-    async def chat(self, id=0, messages=None, attempt=0):
+    async def chat(self, id=0, messages=None, attempt=0, messages_tokens=None, stream_callback=None, use_tools=True):
         '''
         Chat with GPT
         Input id of user and message
@@ -184,10 +258,14 @@ class OpenAIEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * messages_tokens - number of tokens in messages if it is already known (e.g. after trimming)
+          * stream_callback - async function that gets pieces of the answer while it is generated (optional)
+          * use_tools - let the model call tools (False - it has to answer with text, e.g. when tool rounds are over)
         Output:
             * response - response from GPT (just text of last reply)
             * messages - messages from GPT (all messages - list of dictionaries with last message at the end)
-            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int})
+            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int}),
+              it has "error": True if response is an error message
             If not successful returns None
         If messages tokens are more than 80% of max_tokens, it will be trimmed. 20% of tokens are left for response.
         '''
@@ -199,71 +277,81 @@ class OpenAIEngine:
         # send last message to moderation
         if self.moderation:
             if await self.moderation_pass(messages[-1], id) == False:
-                return 'Your message was flagged as violating OpenAI\'s usage policy and was not sent. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}    
+                return 'Your message was flagged as violating OpenAI\'s usage policy and was not sent. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}    
         # get response from GPT
         try:
-            messages_tokens = await self.count_tokens(messages)
+            if messages_tokens is None:
+                messages_tokens = await self.count_tokens(messages)
             if messages_tokens is None:
                 messages_tokens = 0
 
             user_id = hashlib.sha1(str(id).encode("utf-8")).hexdigest() if self.end_user_id else None
-            requested_tokens = min(self.max_tokens, self.max_tokens - messages_tokens)
-            requested_tokens = max(requested_tokens, 50)
+            requested_tokens = completion_budget(self.max_tokens, messages_tokens)
+            # the same history is serialized the same way every turn, so cached prefix matches
+            request = {
+                "model": self.model,
+                "temperature": self.temperature,
+                "max_tokens": requested_tokens,
+                "messages": self.serialize_messages(messages),
+                "user": str(user_id),
+            }
+            if self.function_calling:
+                request["tools"] = self.serialize_tools()
+                request["tool_choice"] = "auto" if use_tools else "none"
+            # answer that was partly streamed to user can not be retried
+            streamed = []
+            async def request_completion(member):
+                member_request = dict(request, model=member.model or self.model)
+                if stream_callback is not None:
+                    async def callback(text):
+                        streamed.append(text)
+                        await stream_callback(text)
+                    return await self.stream_completion(callback, messages_tokens, client=member.client, **member_request)
+                return await member.client.chat.completions.create(**member_request)
+            response = await self.pool.run(request_completion, retry_if=lambda e: len(streamed) == 0)
             if self.function_calling:
-                response = await self.client.chat.completions.create(
-                        model=self.model,
-                        temperature=self.temperature, 
-                        max_tokens=requested_tokens,
-                        messages=messages,
-                        user=str(user_id),
-                        tools=self.function_calling_tools,
-                        tool_choice="auto",
-                )
                 response = await self.detect_function_called(response)
                 if response is not None:
                     if type(response) == tuple:
                         if response[0] == 'function':
-                            logger.info(f'Function {response[1]} was called by user {id}')
-                            return response, messages, response[3]
-            else:
-                response = await self.client.chat.completions.create(
-                        model=self.model,
-                        temperature=self.temperature, 
-                        max_tokens=requested_tokens,
-                        messages=messages,
-                        user=str(user_id)
-                )
+                            logger.info(f'Functions {", ".join(call["name"] for call in response[1])} were called by user {id}')
+                            return response, messages, response[2]
 
-            prompt_tokens = int(response.usage.prompt_tokens)
-            completion_tokens = int(response.usage.completion_tokens)
+            usage = self.get_usage(response.usage)
+            prompt_tokens = usage['prompt']
+            completion_tokens = usage['completion']
 
             # Delete images from chat history
             if self.vision and self.delete_image_after_chat:
                 messages, token_usage = await self.delete_images(messages)
                 prompt_tokens += int(token_usage['prompt'])
                 completion_tokens += int(token_usage['completion'])
+        # if provider is down
+        except CircuitOpenError as e:
+            logger.error(f'OpenAI is unavailable: {e}')
+            return 'Service is temporarily unavailable. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if ratelimit is reached
         except self.openai.RateLimitError as e:
             logger.error(f'OpenAI RateLimitError: {e}')
-            return 'Service is limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return 'Service is limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if chat is too long
         except self.openai.BadRequestError as e:
             # if 'openai.error.InvalidRequestError: The model: `gpt-4` does not exist'
             if 'does not exist' in str(e):
                 logger.error(f'Invalid model error for model {self.model}')
-                return 'Something went wrong with an attempt to use the model. Please contact the developer.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens} 
+                return 'Something went wrong with an attempt to use the model. Please contact the developer.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True} 
             logger.error(f'Invalid request error: {e}')
             if self.chat_deletion or attempt > 0:
                 logger.debug(f'Chat session for user {id} was deleted due to an error')
                 messages = messages[0]
-                return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}  
+                return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}  
             else:
                 # logger.debug(messages)
-                return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if something else
         except Exception as e:
             logger.exception('Could not get response from GPT')
-            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # process response
         response = response.choices[0].message.content
         # add response to chat history
@@ -277,7 +365,82 @@ class OpenAIEngine:
         if attempt == 1:
             # if chat is too long, return response and advice to delete session
             response += '\nIt seems like you reached length limit of chat session. You can continue, but I advice you to /delete session.'
-        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens}
+        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens, "cache_read": usage['cache_read']}
+
+    def serialize_messages(self, messages):
+        '''
+        Copy of messages with keys in a fixed order (content parts and tool calls are sorted by key)
+        Messages are built in different places of the code, so the same message could be sent
+        with different key order and break the cached prompt prefix
+        '''
+        order = ['role', 'name', 'content', 'tool_calls', 'tool_call_id']
+        serialized = []
+        for message in messages:
+            message = {key: message[key] for key in order + sorted(message) if key in message}
+            for key in ['content', 'tool_calls']:
+                if type(message.get(key)) == list:
+                    message[key] = json.loads(json.dumps(message[key], sort_keys=True, ensure_ascii=False))
+            serialized.append(message)
+        return serialized
+
+    def serialize_tools(self):
+        '''
+        Tool definitions sorted by key (they go before messages in the cached prefix)
+        '''
+        if getattr(self, 'serialized_tools', None) is None or self.serialized_tools[0] is not self.function_calling_tools:
+            self.serialized_tools = (self.function_calling_tools, json.loads(json.dumps(self.function_calling_tools, sort_keys=True, ensure_ascii=False)))
+        return self.serialized_tools[1]
+
+    def get_usage(self, usage):
+        '''
+        Token usage of response
+        Output: {"prompt": int, "completion": int, "cache_read": int}
+        Prompt tokens do not include cached ones (usage.prompt_tokens_details.cached_tokens), they are priced differently
+        '''
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = int(getattr(details, 'cached_tokens', None) or 0)
+        return {
+            "prompt": int(usage.prompt_tokens) - cached,
+            "completion": int(usage.completion_tokens),
+            "cache_read": cached,
+        }
+
+    async def stream_completion(self, stream_callback, messages_tokens=0, client=None, **request):
+        '''
+        Get completion as a stream
+        stream_callback(text) is awaited for every new piece of text
+        client - client of pool member (main client by default)
+        Output: response in the same shape as a regular completion (choices[0].message with content and tool_calls, usage)
+        '''
+        text = ''
+        tool_calls = {}
+        usage = None
+        client = client if client is not None else self.client
+        stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                text += delta.content
+                await stream_callback(delta.content)
+            if delta.tool_calls:
+                # tool calls come in pieces: id and name first, then arguments
+                for call in delta.tool_calls:
+                    current = tool_calls.setdefault(call.index, {"id": None, "name": "", "arguments": ""})
+                    if call.id:
+                        current["id"] = call.id
+                    if call.function is not None:
+                        current["name"] += call.function.name or ''
+                        current["arguments"] += call.function.arguments or ''
+        if usage is None:
+            # some compatible APIs do not return usage for streams
+            usage = SimpleNamespace(prompt_tokens=messages_tokens, completion_tokens=len(self.encoding.encode(text)))
+        calls = [SimpleNamespace(id=call["id"], type="function", function=SimpleNamespace(name=call["name"], arguments=call["arguments"])) for index, call in sorted(tool_calls.items())]
+        message = SimpleNamespace(role="assistant", content=text, tool_calls=calls if len(calls) > 0 else None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
 
     async def summary(self, text, size=420):
         '''
@@ -290,12 +453,12 @@ class OpenAIEngine:
             summary.append({"role": "user", "content": str(text)})
             # Get the response from the API
             requested_tokens = min(size, self.max_tokens)
-            response = await self.client.chat.completions.create(
-                    model=self.model,
+            response = await self.pool.run(lambda member: member.client.chat.completions.create(
+                    model=member.model or self.model,
                     temperature=self.temperature, 
                     max_tokens=requested_tokens,
                     messages=summary
-            )
+            ))
             prompt_tokens = int(response.usage.prompt_tokens)
             completion_tokens = int(response.usage.completion_tokens)
 
@@ -315,10 +478,10 @@ class OpenAIEngine:
                 return None
             text = ''
             prompt_tokens, completion_tokens = 0, 0
+            # images are described at once (descriptions are cached by image content)
+            descriptions = await asyncio.gather(*[self.describe_image(message) for message in messages[1:]])
             # Concatenate all messages into a single string
-            for i in range(1, len(messages)):
-                message = messages[i]
-                image_description, token_usage = await self.describe_image(message)
+            for message, (image_description, token_usage) in zip(messages[1:], descriptions):
                 if image_description is None:
                     text += message['role'] + ': ' + str(message['content']) + '\n'
                 else:
@@ -379,23 +542,33 @@ class OpenAIEngine:
         '''
         Count tokens in messages via tiktoken
         '''
+        costs = await self.count_message_tokens(messages)
+        if costs is None:
+            return None
+        tokens = sum(costs)
+        logger.debug(f'Messages were counted for tokens: {tokens}')
+        return tokens
+
+    async def count_message_tokens(self, messages):
+        '''
+        Count tokens of every message via tiktoken
+        Output: list of token counts (in the same order as messages) or None
+        '''
         try:
             # If messages empty
             if messages is None:
                 logger.debug('Messages are empty')
                 return None
-            if len(messages) == 0:
-                return 0
-            # Count the number of tokens
-            tokens = 0
+            costs = []
             for message in messages:
                 # Check if there is images in message and leave only text
                 if self.vision:
                     message, trimmed = await self.leave_only_text(message)
                 text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
-            logger.debug(f'Messages were counted for tokens: {tokens}')
-            return tokens
+                if message.get('tool_calls'):
+                    text += ' ' + json.dumps(message['tool_calls'], ensure_ascii=False)
+                costs.append(self.token_counter.count(text))
+            return costs
         except Exception as e:
             logger.exception('Could not count tokens in text')
             return None
@@ -428,7 +601,7 @@ class OpenAIEngine:
         '''
         if self.vision == False:
             # no need to describe
-            return None
+            return None, {"prompt": 0, "completion": 0}
         try:
             prompt_tokens, completion_tokens = 0, 0
             summary = None
@@ -485,15 +658,20 @@ class OpenAIEngine:
         try:
             tokens_prompt, tokens_completion = 0, 0
             # Check if there is images in messages
+            images = []
             for i in range(len(messages)):
                 # Leave only text in message
                 text, trimmed = await self.leave_only_text(messages[i])
                 if trimmed == False:
                     # no images in message
                     continue
-                text = text['content'] 
+                images.append((i, text['content']))
+            if self.image_description:
+                # images are described at once (descriptions are cached by image content)
+                descriptions = await asyncio.gather(*[self.describe_image(messages[i]) for i, text in images])
+            for n, (i, text) in enumerate(images):
                 if self.image_description:
-                    image_description, token_usage = await self.describe_image(messages[i])
+                    image_description, token_usage = descriptions[n]
                     tokens_prompt += int(token_usage['prompt'])
                     tokens_completion += int(token_usage['completion'])
                     text += f'\n<There was an image here, but it was deleted. Image description: {image_description} Resend the image if you needed.>'
@@ -515,27 +693,25 @@ class YandexEngine:
         Initialize Yandex API for text generation
         Available: text generation
         '''
-        import requests 
+        import aiohttp
         import json
-        self.requests = requests
+        self.aiohttp = aiohttp
         self.json = json
         self.text_initiation, self.speech_initiation = text, speech
         self.text_init() if self.text_initiation else None
         self.speech_init() if self.speech_initiation else None
 
-        self.headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f"Api-Key {self.chat_vars['SecretKey']}",
-                'x-folder-id': self.chat_vars['CatalogID'],
-            }
-        if self.chat_vars['RequestLogging'] == False:
-            self.headers['x-data-logging-enabled'] = 'false'
+        # keys and catalogs from [YandexGPT] and [YandexGPT.<name>] sections
+        self.pool = ClientPool('yandexgpt', [self.get_member(section) for section in pool_sections("YandexGPT")])
+        self.client = self.pool.members[0].client
+        self.headers = self.client.headers
 
         # Get the encoding for the model
         self.encoding = None
         self.fallback_enc_base = 'cl100k_base'
         logger.info(f"Loading encoding for `{self.fallback_enc_base}` for estimating token usage")
         self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
         
         logger.info('Yandex Engine was initialized')
 
@@ -562,6 +738,9 @@ class YandexEngine:
             "EndUserID": False,
             "RequestLogging": False,
             "FunctionCalling": False,
+            "RequestTimeout": 60,
+            "ConnectTimeout": 10,
+            "MaxConcurrentRequests": 10,
             })
         self.config.read('./data/.config', encoding='utf-8')
         self.chat_vars = {} 
@@ -577,15 +756,13 @@ class YandexEngine:
         self.chat_vars['MaxSummaryTokens'] = self.config.getint("YandexGPT", "MaxSummaryTokens") if self.config.has_option("YandexGPT", "MaxSummaryTokens") else (self.chat_vars['MaxTokens'] // 2)
         self.chat_vars['RequestLogging'] = self.config.getboolean("YandexGPT", "RequestLogging")
         self.chat_vars['EndUserID'] = self.config.getboolean("YandexGPT", "EndUserID")
+        self.chat_vars['RequestTimeout'] = self.config.getfloat("YandexGPT", "RequestTimeout")
+        self.chat_vars['ConnectTimeout'] = self.config.getfloat("YandexGPT", "ConnectTimeout")
+        self.chat_vars['MaxConcurrentRequests'] = self.config.getint("YandexGPT", "MaxConcurrentRequests")
         self.chat_deletion = self.config.getboolean("YandexGPT", "ChatDeletion") 
         self.log_chats = self.config.getboolean("Logging", "LogChats") if self.config.has_option("Logging", "LogChats") else False
         
-        if self.chat_vars['Model'].startswith('gpt://') or self.chat_vars['Model'].startswith('ds://'):
-            # if model is already in correct format (gpt://<folder_ID>/yandexgpt/latest)
-            pass
-        else:
-            # if model is not in correct format, add gpt://<folder_ID>/ to the beginning
-            self.chat_vars['Model'] = f"gpt://{self.chat_vars['CatalogID']}/{self.chat_vars['Model']}"
+        self.chat_vars['Model'] = self.model_uri(self.chat_vars['Model'], self.chat_vars['CatalogID'])
 
         self.model = self.chat_vars['Model']
         self.system_message = self.chat_vars['SystemMessage']
@@ -622,7 +799,7 @@ class YandexEngine:
         # TODO: implement speech to text with Yandex API
         pass
 
-    async def chat(self, id=0, messages=None, attempt=0):
+    async def chat(self, id=0, messages=None, attempt=0, messages_tokens=None, stream_callback=None):
         '''
         Chat with Yandex GPT
         Input id of user and message
@@ -634,10 +811,13 @@ class YandexEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * messages_tokens - number of tokens in messages if it is already known (e.g. after trimming)
+          * stream_callback - not supported by Yandex GPT (answer is returned at once)
         Output:
             * response - response from Yandex GPT (just text of last reply)
             * messages - messages from Yandex GPT (all messages - list of dictionaries with last message at the end)
-            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int})
+            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int}),
+              it has "error": True if response is an error message
             If not successful returns None
         If messages tokens are more than 80% of max_tokens, it will be trimmed. 20% of tokens are left for response.
         '''
@@ -648,12 +828,12 @@ class YandexEngine:
         prompt_tokens, completion_tokens = 0, 0
         # get response from Claude
         try:
-            messages_tokens = await self.count_tokens(messages)
+            if messages_tokens is None:
+                messages_tokens = await self.count_tokens(messages)
             if messages_tokens is None:
                 messages_tokens = 0
 
-            requested_tokens = min(self.max_tokens, self.max_tokens - messages_tokens)
-            requested_tokens = max(requested_tokens, 50)
+            requested_tokens = completion_budget(self.max_tokens, messages_tokens)
             new_messages = await self.revise_messages(messages)
             
             # POST request to Yandex API
@@ -666,7 +846,7 @@ class YandexEngine:
                 },
                 "messages": new_messages
             }
-            response = self.requests.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
+            response = await self.post(payload)
             
             if response.status_code == 200:
                 logger.debug(f'Yandex GPT response: {response.text}')
@@ -676,34 +856,40 @@ class YandexEngine:
                 response = str(response['result']['alternatives'][0]['message']['text'])
             elif response.status_code == 500:
                 logger.error(f'Yandex GPT InternalServerError: {response.text} (code: {response.status_code})')
-                return 'Yandex API service is having troubles. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Yandex API service is having troubles. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
             elif response.status_code == 400:
                 logger.error(f'Yandex GPT BadRequestError: {response.text} (code: {response.status_code})')
-                return 'Yandex API service received a bad request. Please try again later or try to /delete session.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Yandex API service received a bad request. Please try again later or try to /delete session.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
             elif response.status_code == 401:
                 logger.error(f'Yandex GPT UnauthorizedError: {response.text} (code: {response.status_code})')
-                return 'Yandex API service is not authorized. Please contact the administrator.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Yandex API service is not authorized. Please contact the administrator.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
             elif response.status_code == 429:
                 logger.error(f'Yandex GPT RateLimitError: {response.text} (code: {response.status_code})')
-                return 'Service is getting rate limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Service is getting rate limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
             # TODO: Chat is too long - check 
             elif response.status_code == 413:
                 logger.error(f'Yandex GPT PayloadTooLarge: {response.text} (code: {response.status_code})')
                 if self.chat_deletion or attempt > 0:
                     logger.debug(f'Chat session for user {id} was deleted due to an error')
                     messages = messages[0]
-                    return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}  
+                    return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}  
                 else:
-                    return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                    return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
             else:
                 logger.error(f'Yandex GPT Error: {response.text} (code: {response.status_code})')
-                return "Something went wrong with Yandex GPT. Please try again later.", messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
-        except self.requests.exceptions.ConnectionError as e:
+                return "Something went wrong with Yandex GPT. Please try again later.", messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
+        except CircuitOpenError as e:
+            logger.error(f'Yandex GPT is unavailable: {e}')
+            return 'Yandex API service is temporarily unavailable. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
+        except self.aiohttp.ClientConnectionError as e:
             logger.error(f'Connection error to Yandex API: {e}')
-            return 'Yandex API service is not available. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return 'Yandex API service is not available. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
+        except asyncio.TimeoutError as e:
+            logger.error(f'Yandex API request timed out (user {id})')
+            return 'Yandex API service is not responding. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         except Exception as e:
             logger.error(f'Something went wrong with attempt to get response from Yandex GPT: {e}')
-            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # add response to chat history
         messages.append({"role": "assistant", "content": str(response)})
         # save chat history to file
@@ -717,6 +903,68 @@ class YandexEngine:
             response += '\nIt seems like you reached length limit of chat session. You can continue, but I advice you to /delete session.'
         return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens}
     
+    def model_uri(self, model, catalog_id):
+        '''
+        Get model URI in format gpt://<folder_ID>/yandexgpt/latest
+        '''
+        if model.startswith('gpt://') or model.startswith('ds://'):
+            # if model is already in correct format
+            return model
+        # if model is not in correct format, add gpt://<folder_ID>/ to the beginning
+        return f"gpt://{catalog_id}/{model}"
+
+    def get_member(self, section):
+        '''
+        Create pool member for config section with key and catalog ID (and optionally model)
+        '''
+        catalog_id = get_option(section, "CatalogID")
+        model = get_option(section, "ChatModel") if section != "YandexGPT" else None
+        headers = {
+                'Content-Type': 'application/json',
+                'Authorization': f"Api-Key {get_option(section, 'SecretKey')}",
+                'x-folder-id': catalog_id,
+            }
+        if self.chat_vars['RequestLogging'] == False:
+            headers['x-data-logging-enabled'] = 'false'
+        # pooled async session (requests do not block the event loop)
+        client = AsyncHTTPClient(
+            headers=headers,
+            timeout=self.chat_vars['RequestTimeout'],
+            connect_timeout=self.chat_vars['ConnectTimeout'],
+            max_concurrent=self.chat_vars['MaxConcurrentRequests'],
+            name=section.lower(),
+            )
+        if model is None:
+            model = self.config.get("YandexGPT", "ChatModel")
+        return PoolMember(section, client=client, model=self.model_uri(model, catalog_id), settings={"CatalogID": catalog_id})
+
+    async def post(self, payload, summary=False):
+        '''
+        Send request to Yandex API through the pool of keys with retries of transient errors (429, 5xx, timeouts, connection errors)
+        Model URI of the payload is set for the catalog of the chosen key
+        If retries are over, the last response is returned as is
+        '''
+        async def request(member):
+            if summary:
+                model = f"gpt://{member.settings['CatalogID']}/{self.chat_vars['SummarisationModel']}"
+            else:
+                model = member.model
+            response = await member.client.post(self.chat_vars['Endpoint'], json=dict(payload, modelUri=model))
+            if response.status_code in [401, 403, 429] or response.status_code >= 500:
+                raise HTTPStatusError(response)
+            return response
+        try:
+            return await self.pool.run(request)
+        except HTTPStatusError as e:
+            return e.response
+
+    async def close(self):
+        '''
+        Close HTTP sessions
+        '''
+        for member in self.pool.members:
+            await member.client.close()
+
     async def revise_messages(self, messages):
         '''
         Format messages for Yandex API
@@ -755,7 +1003,7 @@ class YandexEngine:
                 ]
             }
             
-            response = self.requests.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
+            response = await self.post(payload, summary=True)
             
             if response.status_code == 200:
                 logger.debug(f'Yandex GPT response: {response.text}')
@@ -799,23 +1047,31 @@ class YandexEngine:
         '''
         Count tokens in messages via tiktoken
         '''
+        costs = await self.count_message_tokens(messages)
+        if costs is None:
+            return None
+        tokens = sum(costs)
+        logger.debug(f'Messages were counted for tokens: {tokens}')
+        return tokens
+
+    async def count_message_tokens(self, messages):
+        '''
+        Count tokens of every message via tiktoken
+        Output: list of token counts (in the same order as messages) or None
+        '''
         try:
             # If messages empty
             if messages is None:
                 logger.debug('Messages are empty')
                 return None
-            if len(messages) == 0:
-                return 0
-            # Count the number of tokens
-            tokens = 0
+            costs = []
             for message in messages:
                 # Check if there is images in message and leave only text
                 if self.vision:
                     message, trimmed = await self.leave_only_text(message)
                 text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
-            logger.debug(f'Messages were counted for tokens: {tokens}')
-            return tokens
+                costs.append(self.token_counter.count(text))
+            return costs
         except Exception as e:
             logger.exception('Could not count tokens in text')
             return None
@@ -832,6 +1088,7 @@ class AnthropicEngine:
         from anthropic import AsyncAnthropic
         import anthropic 
         self.anthropic = anthropic
+        self.AsyncAnthropic = AsyncAnthropic
         import configparser
         self.config = configparser.SafeConfigParser({
             "ChatModel": "claude-3-haiku-20240307",
@@ -848,6 +1105,7 @@ class AnthropicEngine:
             "ImageSize": 512,
             "SummarizeTooLong": False,
             "FunctionCalling": False,
+            "PromptCaching": True,
             })
         self.config.read('./data/.config', encoding='utf-8')   
         # check if alternative API base is used
@@ -859,13 +1117,12 @@ class AnthropicEngine:
                 self.base_url = None
         # Set up the API 
         # TODO: working with other parameters
-        proxy = self.config.get("Anthropic", "Proxy") if self.config.has_option("Anthropic", "Proxy") else None
-        # proxy = {"http://": proxy, "https://": proxy} if proxy else None
-        self.client = AsyncAnthropic(
-            api_key=self.config.get("Anthropic", "SecretKey"),
-            base_url=self.base_url,
-            proxies=proxy,
-        )
+        # functions that get headers of every API response (e.g. rate limit budgets)
+        self.response_hooks = []
+        # keys and endpoints from [Anthropic] and [Anthropic.<name>] sections
+        self.pool = ClientPool('anthropic', [self.get_member(section) for section in pool_sections("Anthropic")])
+        # main client (image descriptions)
+        self.client = self.pool.members[0].client
         self.text_initiation, self.speech_initiation = text, speech
         self.function_calling = False
         self.text_init() if self.text_initiation else None        
@@ -876,6 +1133,7 @@ class AnthropicEngine:
         self.fallback_enc_base = 'cl100k_base'
         logger.info(f"Loading encoding for `{self.fallback_enc_base}` for estimating token usage")
         self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
 
         logger.info('Anthropic Engine was initialized')
 
@@ -897,6 +1155,11 @@ class AnthropicEngine:
         self.summarize_too_long = self.config.getboolean("Anthropic", "SummarizeTooLong") 
         self.model_completion_price = float(self.config.get("Anthropic", "ChatModelCompletionPrice")) 
         self.model_prompt_price = float(self.config.get("Anthropic", "ChatModelPromptPrice")) 
+        # prompt caching: system prompt, tools and history are cached between turns
+        # cache writes cost 25% more than prompt tokens, cache reads cost 10% of them
+        self.prompt_caching = self.config.getboolean("Anthropic", "PromptCaching")
+        self.cache_write_price = float(self.config.get("Anthropic", "CacheWritePrice")) if self.config.has_option("Anthropic", "CacheWritePrice") else self.model_prompt_price * 1.25
+        self.cache_read_price = float(self.config.get("Anthropic", "CacheReadPrice")) if self.config.has_option("Anthropic", "CacheReadPrice") else self.model_prompt_price * 0.1
 
         self.vision = self.config.getboolean("Anthropic", "Vision")
         self.function_calling = self.config.getboolean("Anthropic", "FunctionCalling") 
@@ -919,6 +1182,10 @@ class AnthropicEngine:
             print('Function calling (tool use) is enabled')
             print('-- Function calling is used to call functions from chat. It can be changed in the self.config file.')
             print('-- Learn more: https://docs.anthropic.com/claude/docs/tool-use\n')
+        if self.prompt_caching:
+            print('Prompt caching is enabled')
+            print('-- System prompt, tools and chat history are cached between messages, so long sessions are faster and cheaper. It can be changed in the self.config file.')
+            print('-- Learn more: https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching\n')
 
     async def revise_messages(self, messages):
         '''
@@ -926,8 +1193,10 @@ class AnthropicEngine:
         Input:
             * messages - list of dictionaries with messages
         Output:
-            * system_prompt - system message
+            * system_prompt - system message (list of blocks with cache breakpoint if prompt caching is enabled)
             * new_messages - list of dictionaries with revised messages
+        If prompt caching is enabled, cache breakpoints are placed on the system prompt and on the
+        last two user turns (rolling boundary: the previous turn reads the cache, the last one writes it)
         '''
         try:
             new_messages = [{"role": "user", "content": []}]
@@ -974,6 +1243,9 @@ class AnthropicEngine:
 
                 if type(current_content) == str:
                     current_content = [{"type": "text", "text": current_content}]
+                else:
+                    # copy, so chat history is not changed when messages are merged
+                    current_content = list(current_content)
 
                 if last_role == current_role:
                     # extend the last message
@@ -982,24 +1254,89 @@ class AnthropicEngine:
                     new_messages.append({"role": current_role, "content": current_content})
 
                 last_role = current_role
+            if self.prompt_caching:
+                if system_prompt != "":
+                    system_prompt = [self.cached({"type": "text", "text": system_prompt})]
+                user_messages = [message for message in new_messages if message['role'] == 'user' and len(message['content']) > 0]
+                for message in user_messages[-2:]:
+                    # content can be the list from chat history, so it is copied
+                    message['content'] = message['content'][:-1] + [self.cached(message['content'][-1])]
             return system_prompt, new_messages
         except Exception as e:
             logger.error(f'Could not revise messages for Anthropic: {e}')
             return "", None
+
+    def cached(self, block):
+        '''
+        Copy of content block (or tool definition) with cache breakpoint
+        '''
+        return dict(block, cache_control={"type": "ephemeral"})
+
+    def get_usage(self, usage):
+        '''
+        Token usage of response
+        Output: {"prompt": int, "completion": int, "cache_read": int, "cache_write": int}
+        Prompt tokens do not include cached ones, they are priced differently
+        '''
+        return {
+            "prompt": int(usage.input_tokens),
+            "completion": int(usage.output_tokens),
+            "cache_read": int(getattr(usage, 'cache_read_input_tokens', None) or 0),
+            "cache_write": int(getattr(usage, 'cache_creation_input_tokens', None) or 0),
+        }
         
+    def get_member(self, section):
+        '''
+        Create pool member for config section with key, endpoint and (optionally) model
+        APIBase and Proxy are taken from [Anthropic] if they are not set in the section
+        '''
+        member = PoolMember(section, model=get_option(section, "ChatModel") if section != "Anthropic" else None)
+        base_url = get_option(section, "APIBase", "Anthropic")
+        if base_url is not None and base_url.lower() in ['default', '', 'none', 'false']:
+            base_url = None
+        proxy = get_option(section, "Proxy", "Anthropic")
+        if proxy:
+            member.client = self.AsyncAnthropic(
+                api_key=get_option(section, "SecretKey"),
+                base_url=base_url,
+                proxies=proxy,
+                # retries are done by chatutils.resilience (with circuit breaker)
+                max_retries=0,
+            )
+        else:
+            member.client = self.AsyncAnthropic(
+                api_key=get_option(section, "SecretKey"),
+                base_url=base_url,
+                http_client=httpx.AsyncClient(event_hooks={"response": [member.on_response, self.on_response]}),
+                max_retries=0,
+            )
+        return member
+
+    async def on_response(self, response):
+        '''
+        Pass headers of API response to response hooks
+        '''
+        if len(self.pool.members) > 1:
+            # headers describe budget of one key, pool keeps them per member
+            return
+        for hook in self.response_hooks:
+            try:
+                hook(response.headers)
+            except Exception as e:
+                logger.debug(f'Response hook failed: {e}')
+
     async def detect_function_called(self, response):
         '''
-        Detect function called in response
+        Detect functions called in response
         Input:
             * response - response from Anthropic API
         Output:
-            * response - revised response if function was called, otherwise the same response
+            * response - ('function', calls, tokens, text) if functions were called, where calls are
+              [{"id": str, "name": str, "args": dict}, ...] (all tool_use blocks of the response),
+              otherwise the same response
         '''
         response_message = None
-        function_name = None
-        function_args = None
         text = None
-        tool_id = None
         try:
             logger.debug(f'Detecting function called in response: "{response}"')
             if response is None:
@@ -1011,27 +1348,44 @@ class AnthropicEngine:
             if len(self.function_calling_tools) == 0:
                 return response
             
-            text = None
             if response.stop_reason == 'tool_use':
                 logger.debug(f'Function was called in response')
+                calls = []
                 for content in response.content:
                     if type(content) == self.anthropic.types.TextBlock:
-                        text = content.text
+                        text = content.text if text is None else text + content.text
                     if type(content) == self.anthropic.types.ToolUseBlock:
-                        function_name = content.name
-                        function_args = content.input
-                        tool_id = content.id
-                tokens = {
-                    "prompt": response.usage.input_tokens,
-                    "completion": response.usage.output_tokens
-                }
-                return ('function', function_name, function_args, tokens, text, tool_id)
+                        calls.append({"id": content.id, "name": content.name, "args": content.input})
+                tokens = self.get_usage(response.usage)
+                return ('function', calls, tokens, text)
             return response
         except Exception as e:
             logger.error(f'Could not detect function called: {e}. Response: {response_message}')
             return response
 
-    async def chat(self, id=0, messages=None, attempt=0):
+    def tool_messages(self, calls, text, results):
+        '''
+        Messages for chat history with tool calls of the model and their results
+        Learn more: https://docs.anthropic.com/claude/docs/tool-use-examples
+        Input:
+            * calls - tool calls (see detect_function_called)
+            * text - text of the model that came with the calls
+            * results - results of the calls in the same order ({"content": str, ...})
+        Output: assistant message with tool_use blocks and user message with tool_result blocks
+        '''
+        message_content = []
+        if text is not None and len(text) > 0:
+            message_content.append({"type": "text", "text": text})
+        for call in calls:
+            message_content.append({"type": "tool_use", "id": call["id"], "name": call["name"], "input": call["args"]})
+        results_content = [{
+            "type": "tool_result",
+            "tool_use_id": call["id"],
+            "content": str(result["content"]),
+        } for call, result in zip(calls, results)]
+        return [{"role": "assistant", "content": message_content}, {"role": "user", "content": results_content}]
+
+    async def chat(self, id=0, messages=None, attempt=0, messages_tokens=None, stream_callback=None, use_tools=True):
         '''
         Chat with Claude
         Input id of user and message
@@ -1043,10 +1397,14 @@ class AnthropicEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * messages_tokens - number of tokens in messages if it is already known (e.g. after trimming)
+          * stream_callback - async function that gets pieces of the answer while it is generated (optional)
+          * use_tools - let the model call tools (False - it has to answer with text, e.g. when tool rounds are over)
         Output:
             * response - response from Claude (just text of last reply)
             * messages - messages from Claude (all messages - list of dictionaries with last message at the end)
-            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int})
+            * tokens - number of tokens used in response (dict - {"prompt": int, "completion": int}),
+              it has "error": True if response is an error message
             If not successful returns None
         If messages tokens are more than 80% of max_tokens, it will be trimmed. 20% of tokens are left for response.
         '''
@@ -1057,69 +1415,85 @@ class AnthropicEngine:
         prompt_tokens, completion_tokens = 0, 0
         # get response from Claude
         try:
-            messages_tokens = await self.count_tokens(messages)
+            if messages_tokens is None:
+                messages_tokens = await self.count_tokens(messages)
             if messages_tokens is None:
                 messages_tokens = 0
 
             # user_id = hashlib.sha1(str(id).encode("utf-8")).hexdigest() if self.end_user_id else None
-            requested_tokens = min(self.max_tokens, self.max_tokens - messages_tokens)
-            requested_tokens = max(requested_tokens, 50)
+            requested_tokens = completion_budget(self.max_tokens, messages_tokens)
             system_prompt, new_messages = await self.revise_messages(messages)
+            request = {
+                "model": self.model,
+                "temperature": self.temperature,
+                "max_tokens": requested_tokens,
+                "system": system_prompt,
+                "messages": new_messages,
+            }
+            if self.function_calling:
+                request["tools"] = self.function_calling_tools
+                if not use_tools:
+                    request["tool_choice"] = {"type": "none"}
+                if self.prompt_caching and self.function_calling_tools:
+                    # tools go before the system prompt, breakpoint on the last tool caches all of them
+                    request["tools"] = self.function_calling_tools[:-1] + [self.cached(self.function_calling_tools[-1])]
+            # answer that was partly streamed to user can not be retried
+            streamed = []
+            async def request_completion(member):
+                member_request = dict(request, model=member.model or self.model)
+                if stream_callback is not None:
+                    # final message has the same shape as a regular response
+                    async with member.client.messages.stream(**member_request) as stream:
+                        async for text in stream.text_stream:
+                            streamed.append(text)
+                            await stream_callback(text)
+                        return await stream.get_final_message()
+                return await member.client.messages.create(**member_request)
+            response = await self.pool.run(request_completion, retry_if=lambda e: len(streamed) == 0)
             if self.function_calling:
-                response = await self.client.messages.create(
-                        model=self.model,
-                        temperature=self.temperature, 
-                        max_tokens=requested_tokens,
-                        system=system_prompt,
-                        messages=new_messages,
-                        tools=self.function_calling_tools,
-                )
                 response = await self.detect_function_called(response)
                 if response is not None:
                     if type(response) == tuple:
                         if response[0] == 'function':
-                            logger.info(f'Function {response[1]} was called by user {id}')
-                            return response, messages, response[3]
-            else:
-                response = await self.client.messages.create(
-                        model=self.model,
-                        temperature=self.temperature, 
-                        max_tokens=requested_tokens,
-                        system=system_prompt,
-                        messages=new_messages
-                )
-            prompt_tokens = int(response.usage.input_tokens)
-            completion_tokens = int(response.usage.output_tokens)
+                            logger.info(f'Functions {", ".join(call["name"] for call in response[1])} were called by user {id}')
+                            return response, messages, response[2]
+            usage = self.get_usage(response.usage)
+            prompt_tokens = usage['prompt']
+            completion_tokens = usage['completion']
             # Delete images from chat history
             if self.vision and self.delete_image_after_chat:
                 messages, token_usage = await self.delete_images(messages)
                 prompt_tokens += int(token_usage['prompt'])
                 completion_tokens += int(token_usage['completion'])
 
+        # if provider is down
+        except CircuitOpenError as e:
+            logger.error(f'Anthropic is unavailable: {e}')
+            return 'Anthropic service is temporarily unavailable. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if connection problems
         except self.anthropic.APIConnectionError as e:
             logger.error(f'Anthropic APIConnectionError: {e}')
-            return 'Anthropic service is not available. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return 'Anthropic service is not available. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if ratelimit is reached
         except self.anthropic.RateLimitError as e:
             logger.error(f'Anthropic RateLimitError: {e}')
-            return 'Service is getting rate limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return 'Service is getting rate limited. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if chat is too long
         except self.anthropic.BadRequestError as e:
             if 'does not exist' in str(e):
                 logger.error(f'Invalid model error for model {self.model}')
-                return 'Something went wrong with an attempt to use the model. Please contact the administrator.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens} 
+                return 'Something went wrong with an attempt to use the model. Please contact the administrator.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True} 
             logger.error(f'Invalid request error: {e}')
             if self.chat_deletion or attempt > 0:
                 logger.debug(f'Chat session for user {id} was deleted due to an error')
                 messages = messages[0]
-                return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}  
+                return 'We had to reset your chat session due to an error. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}  
             else:
-                return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+                return 'Something went wrong. You can try to /delete session and start a new one.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # if something else
         except Exception as e:
             logger.error(f'Could not get response from Claude: {e}')
-            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
+            return None, messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens, "error": True}
         # process response
         response = response.content[0].text
         # add response to chat history
@@ -1133,31 +1507,35 @@ class AnthropicEngine:
         if attempt == 1:
             # if chat is too long, return response and advice to delete session
             response += '\nIt seems like you reached length limit of chat session. You can continue, but I advice you to /delete session.'
-        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens}
+        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens, "cache_read": usage['cache_read'], "cache_write": usage['cache_write']}
 
     async def summary(self, text, size=400):
         '''
         Make summary of text
         Input text and size of summary (in tokens)
         '''
-        # Get a summary prompt
-        system_prompt = f'You are very great at summarizing text to fit in {size//30} sentenses. Answer with summary only.'
-        summary = []
-        summary.append({"role": "user", "content": 'Make a summary:\n' + str(text)})
-        # Get the response from the API
-        requested_tokens = min(size, self.max_tokens)
-        response = await self.client.messages.create(
-                model=self.model,
-                temperature=self.temperature, 
-                max_tokens=requested_tokens,
-                system=system_prompt,
-                messages=summary
-        )
-        prompt_tokens = int(response.usage.input_tokens)
-        completion_tokens = int(response.usage.output_tokens)
-        response = response.content[0].text 
-        # Return the response
-        return response, {"prompt": prompt_tokens, "completion": completion_tokens}
+        try:
+            # Get a summary prompt
+            system_prompt = f'You are very great at summarizing text to fit in {size//30} sentenses. Answer with summary only.'
+            summary = []
+            summary.append({"role": "user", "content": 'Make a summary:\n' + str(text)})
+            # Get the response from the API
+            requested_tokens = min(size, self.max_tokens)
+            response = await self.pool.run(lambda member: member.client.messages.create(
+                    model=member.model or self.model,
+                    temperature=self.temperature, 
+                    max_tokens=requested_tokens,
+                    system=system_prompt,
+                    messages=summary
+            ))
+            prompt_tokens = int(response.usage.input_tokens)
+            completion_tokens = int(response.usage.output_tokens)
+            response = response.content[0].text 
+            # Return the response
+            return response, {"prompt": prompt_tokens, "completion": completion_tokens}
+        except Exception as e:
+            logger.exception('Could not summarize text')
+            return None, {"prompt": 0, "completion": 0}
 
     async def chat_summary(self, messages, short=False):
         '''
@@ -1169,10 +1547,10 @@ class AnthropicEngine:
                 return None
             text = ''
             prompt_tokens, completion_tokens = 0, 0
+            # images are described at once (descriptions are cached by image content)
+            descriptions = await asyncio.gather(*[self.describe_image(message) for message in messages[1:]])
             # Concatenate all messages into a single string
-            for i in range(1, len(messages)):
-                message = messages[i]
-                image_description, token_usage = await self.describe_image(message)
+            for message, (image_description, token_usage) in zip(messages[1:], descriptions):
                 if image_description is None:
                     text += message['role'] + ': ' + str(message['content']) + '\n'
                 else:
@@ -1198,23 +1576,31 @@ class AnthropicEngine:
         '''
         Count tokens in messages via tiktoken
         '''
+        costs = await self.count_message_tokens(messages)
+        if costs is None:
+            return None
+        tokens = sum(costs)
+        logger.debug(f'Messages were counted for tokens: {tokens}')
+        return tokens
+
+    async def count_message_tokens(self, messages):
+        '''
+        Count tokens of every message via tiktoken
+        Output: list of token counts (in the same order as messages) or None
+        '''
         try:
             # If messages empty
             if messages is None:
                 logger.debug('Messages are empty')
                 return None
-            if len(messages) == 0:
-                return 0
-            # Count the number of tokens
-            tokens = 0
+            costs = []
             for message in messages:
                 # Check if there is images in message and leave only text
                 if self.vision:
                     message, trimmed = await self.leave_only_text(message)
                 text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
-            logger.debug(f'Messages were counted for tokens: {tokens}')
-            return tokens
+                costs.append(self.token_counter.count(text))
+            return costs
         except Exception as e:
             logger.exception('Could not count tokens in text')
             return None
@@ -1229,7 +1615,10 @@ class AnthropicEngine:
             message_copy = message.copy()
             # Check if there is images in message
             trimmed = False
-            if 'content' in message_copy and type(message_copy['content']) == list:
+            # tool_use and tool_result messages have no images and must stay as they are
+            has_images = 'content' in message_copy and type(message_copy['content']) == list and \
+                any(type(item) == dict and item.get('type') in ['image_url', 'image'] for item in message_copy['content'])
+            if has_images:
                 # Leave only text in message
                 for i in range(len(message_copy['content'])):
                     if message_copy['content'][i]['type'] == 'text':
@@ -1247,7 +1636,7 @@ class AnthropicEngine:
         '''
         if self.vision == False:
             # no need to describe
-            return None
+            return None, {"prompt": 0, "completion": 0}
         try:
             prompt_tokens, completion_tokens = 0, 0
             summary = None
@@ -1273,8 +1662,8 @@ class AnthropicEngine:
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": image_url,
+                                "media_type": image_url['url'].split(';base64,')[0].split(':')[1],
+                                "data": image_url['url'].split(';base64,')[1],
                             },
                         }
                     ]
@@ -1307,15 +1696,20 @@ class AnthropicEngine:
         try:
             tokens_prompt, tokens_completion = 0, 0
             # Check if there is images in messages
+            images = []
             for i in range(len(messages)):
                 # Leave only text in message
                 text, trimmed = await self.leave_only_text(messages[i])
                 if trimmed == False:
                     # no images in message
                     continue
-                text = text['content'] 
+                images.append((i, text['content']))
+            if self.image_description:
+                # images are described at once (descriptions are cached by image content)
+                descriptions = await asyncio.gather(*[self.describe_image(messages[i]) for i, text in images])
+            for n, (i, text) in enumerate(images):
                 if self.image_description:
-                    image_description, token_usage = await self.describe_image(messages[i])
+                    image_description, token_usage = descriptions[n]
                     tokens_prompt += int(token_usage['prompt'])
                     tokens_completion += int(token_usage['completion'])
                     text += f'\n<There was an image here, but it was deleted. Image description: {image_description} Resend the image if you needed.>'
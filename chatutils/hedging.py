@@ -0,0 +1,208 @@
+# Description: Hedged requests to a secondary text engine for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Hedging")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import asyncio
+from collections import deque
+
+
+class LatencyTracker:
+    '''
+    Recent latencies of the primary engine
+    Hedge delay is the given percentile of them (clamped to min_delay..max_delay),
+    initial_delay is used until min_samples latencies are known.
+    '''
+    def __init__(self, percentile=95, window=200, min_samples=20, initial_delay=5.0, min_delay=1.0, max_delay=30.0):
+        self.percentile = percentile
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def delay(self):
+        if len(self.samples) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(self.samples)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return min(max(ordered[index], self.min_delay), self.max_delay)
+
+
+def plain_history(messages):
+    '''
+    Check if messages can be sent to another engine as is (no tool calls, images or other engine-specific content)
+    '''
+    for message in messages:
+        if message.get('role') not in ['system', 'user', 'assistant'] or type(message.get('content')) != str:
+            return False
+    return True
+
+
+class Hedger:
+    '''
+    Sends the request to the secondary engine if the primary one is slower than usual
+    Primary request is started at once. If it has not answered (or started streaming) after
+    the hedge delay, the same request is sent to the secondary engine. The first successful answer wins,
+    the other request is cancelled (error messages of engines do not win). When answers are streamed,
+    the engine that sends text first wins.
+    '''
+    def __init__(self, secondary, tracker):
+        '''
+        Input:
+            * secondary - secondary text engine (function calling is not used with it)
+            * tracker - LatencyTracker of the primary engine
+        '''
+        self.secondary = secondary
+        self.tracker = tracker
+        self.requests = 0
+        self.hedged = 0
+        self.secondary_wins = 0
+
+    async def run(self, primary, secondary, stream_callback=None, prompt_estimate=0):
+        '''
+        Run hedged request
+        Input:
+            * primary, secondary - functions f(stream_callback) that return coroutine of engine.chat
+            * stream_callback - async function that gets pieces of the answer (optional)
+            * prompt_estimate - prompt tokens of the request, they are counted for a cancelled request
+              (provider may bill the prompt even if the answer was not received)
+        Output: response, messages and token usage of the winner, token usage is
+            {"prompt": int, "completion": int, "cache_read": int, "cache_write": int, "hedge_prompt": int, "hedge_completion": int}
+            where hedge_* are tokens used by the secondary engine
+        '''
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = {}
+        owner = []
+        first_text = []
+        self.requests += 1
+
+        def callback(name):
+            if stream_callback is None:
+                return None
+            async def on_text(text):
+                if len(owner) == 0:
+                    owner.append(name)
+                    if name == 'primary':
+                        first_text.append(loop.time() - started)
+                    # the other answer will not be shown, so it is not needed
+                    other = tasks.get('secondary' if name == 'primary' else 'primary')
+                    if other is not None and not other.done():
+                        other.cancel()
+                if owner[0] == name:
+                    await stream_callback(text)
+            return on_text
+
+        def succeeded(task):
+            # engines return error messages as answers, they are marked in token usage
+            if task.cancelled() or task.exception() is not None:
+                return False
+            response, messages, token_usage = task.result()
+            return response is not None and not (token_usage or {}).get('error', False)
+
+        def record(task):
+            # time to the first text when streaming, time to the answer otherwise
+            # (for a cancelled request it is a lower bound)
+            self.tracker.add(first_text[0] if len(first_text) > 0 else loop.time() - started)
+
+        tasks['primary'] = asyncio.create_task(primary(callback('primary')))
+        tasks['primary'].add_done_callback(record)
+        try:
+            delay = self.tracker.delay()
+            await asyncio.wait([tasks['primary']], timeout=delay)
+            if not tasks['primary'].done() and len(owner) == 0:
+                self.hedged += 1
+                logger.info(f'Primary engine did not answer in {delay:.1f}s, request is sent to the secondary engine')
+                tasks['secondary'] = asyncio.create_task(secondary(callback('secondary')))
+            winner = None
+            pending = set(tasks.values())
+            while winner is None and len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for name, task in tasks.items():
+                    if task in done and succeeded(task):
+                        winner = name
+                        break
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        usage = {"prompt": 0, "completion": 0, "cache_read": 0, "cache_write": 0, "hedge_prompt": 0, "hedge_completion": 0}
+        for name, task in tasks.items():
+            prefix = '' if name == 'primary' else 'hedge_'
+            if task.cancelled() or task.exception() is not None or task.result()[2] is None:
+                usage[prefix + 'prompt'] += prompt_estimate if task.cancelled() else 0
+                continue
+            token_usage = task.result()[2]
+            usage[prefix + 'prompt'] += int(token_usage['prompt'])
+            usage[prefix + 'completion'] += int(token_usage['completion'])
+            if name == 'primary':
+                usage['cache_read'] += int(token_usage.get('cache_read', 0))
+                usage['cache_write'] += int(token_usage.get('cache_write', 0))
+            else:
+                # cached prompt of the secondary engine is counted as its prompt
+                usage['hedge_prompt'] += int(token_usage.get('cache_read', 0)) + int(token_usage.get('cache_write', 0))
+
+        if winner is None:
+            # nobody answered successfully, result of the primary engine is returned (it has error message if any)
+            winner = 'primary'
+            if (tasks['primary'].cancelled() or tasks['primary'].exception() is not None) and 'secondary' in tasks:
+                winner = 'secondary'
+            task = tasks[winner]
+            if task.cancelled() or task.exception() is not None:
+                return None, None, usage
+        if winner == 'secondary':
+            self.secondary_wins += 1
+            logger.info(f'Secondary engine answered first ({self.secondary_wins} of {self.hedged} hedged requests)')
+        response, messages = tasks[winner].result()[:2]
+        return response, messages, usage
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "secondary_wins": self.secondary_wins,
+            "delay": round(self.tracker.delay(), 2),
+        }
+
+
+def get_hedging_settings():
+    '''
+    Settings of the optional [Hedging] section (None if hedging is not enabled)
+    '''
+    if not config.has_section("Hedging"):
+        return None
+    if config.has_option("Hedging", "Enabled") and not config.getboolean("Hedging", "Enabled"):
+        return None
+    def get(option, default):
+        return config.getfloat("Hedging", option) if config.has_option("Hedging", option) else default
+    return {
+        "Engine": config.get("Hedging", "Engine") if config.has_option("Hedging", "Engine") else "Anthropic",
+        "Percentile": get("Percentile", 95),
+        "InitialDelay": get("InitialDelay", 5.0),
+        "MinDelay": get("MinDelay", 1.0),
+        "MaxDelay": get("MaxDelay", 30.0),
+        "Window": int(get("Window", 200)),
+        "MinSamples": int(get("MinSamples", 20)),
+    }
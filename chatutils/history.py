@@ -0,0 +1,105 @@
+# Description: Chat history trimming for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-History")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+from itertools import accumulate
+
+
+def completion_budget(max_tokens, prompt_tokens, min_tokens=50):
+    '''
+    Number of tokens that can be requested for the response
+    '''
+    return max(min(max_tokens, max_tokens - prompt_tokens), min_tokens)
+
+def starts_group(message):
+    '''
+    Check if message starts a new group of messages (user turn)
+    User turn is followed by assistant replies and function/tool calls and results,
+    Anthropic tool results are sent as user messages, but they belong to the previous turn
+    '''
+    if message.get('role') != 'user':
+        return False
+    content = message.get('content')
+    if type(content) == list:
+        for item in content:
+            if type(item) == dict and item.get('type') == 'tool_result':
+                return False
+    return True
+
+
+class HistoryTrimmer:
+    '''
+    Trims chat history to the token budget in one pass
+    Token costs of messages are counted once, then cumulative sums are used to find
+    the earliest group start (user turn) from which the rest of the history fits
+    into target_ratio * max_tokens. System message (first message) is always kept.
+    '''
+    def __init__(self, max_tokens, target_ratio=0.8):
+        self.max_tokens = max_tokens
+        self.target = int(max_tokens * target_ratio)
+
+    def plan(self, messages, costs):
+        '''
+        Find where to cut the history
+        Input:
+            * messages - chat history (system message first)
+            * costs - token counts of messages (see engine.count_message_tokens)
+        Output:
+            * start - index of the first message to keep after the system message
+            * tokens - number of tokens in the trimmed history
+        '''
+        head = 1 if len(messages) > 0 and messages[0]['role'] == 'system' else 0
+        head_tokens = sum(costs[:head])
+        total = sum(costs)
+        # prefix[i] - tokens in messages[:i], so messages[i:] cost total - prefix[i]
+        prefix = [0] + list(accumulate(costs))
+        start = None
+        for i in range(head, len(messages)):
+            if not starts_group(messages[i]):
+                continue
+            start = i
+            if head_tokens + total - prefix[i] <= self.target:
+                break
+        if start is None:
+            # there are no user turns, nothing can be cut safely
+            return head, total
+        return start, head_tokens + total - prefix[start]
+
+    def trim(self, messages, costs, system_message=None, system_tokens=0):
+        '''
+        Trim messages to the token budget
+        Input:
+            * messages, costs - chat history and token counts of messages
+            * system_message - system message to add if history does not start with it
+            * system_tokens - token count of system_message
+        Output:
+            * messages - trimmed chat history (new list)
+            * tokens - number of tokens in the trimmed history
+        '''
+        start, tokens = self.plan(messages, costs)
+        if len(messages) > 0 and messages[0]['role'] == 'system':
+            trimmed = [messages[0]] + messages[start:]
+        elif system_message is not None:
+            trimmed = [system_message] + messages[start:]
+            tokens += system_tokens
+        else:
+            trimmed = messages[start:]
+        logger.debug(f'Trimmed {len(messages) - len(trimmed)} messages, {tokens} tokens left')
+        return trimmed, tokens
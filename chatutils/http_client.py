@@ -0,0 +1,228 @@
+# Description: Shared async HTTP client for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-HTTP")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import json
+import time
+import asyncio
+import aiohttp
+import urllib.parse
+from collections import OrderedDict
+
+
+class HTTPResponse:
+    '''
+    Response of HTTP request (body is already read, so connection is returned to the pool)
+    truncated is True if only the first max_bytes of the body were read
+    '''
+    def __init__(self, status_code, text, headers=None, content=None, truncated=False):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers if headers is not None else {}
+        self.content = content
+        self.truncated = truncated
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncHTTPClient:
+    '''
+    Async HTTP client with a single pooled aiohttp session
+    Connections are kept alive and reused, number of simultaneous requests is limited
+    by max_concurrent (requests over the limit wait for a free slot without blocking the event loop).
+    Session is created on the first request or by start (it should be created inside the running event loop).
+    '''
+    def __init__(self, headers=None, timeout=60, connect_timeout=10, max_concurrent=10, keepalive_timeout=30, name='http',
+                 read_timeout=None, limit_per_host=0, dns_cache_ttl=300, max_hosts=100):
+        '''
+        Input:
+            * headers - default headers for every request
+            * timeout - total timeout of a request in seconds
+            * connect_timeout - timeout of connection in seconds
+            * max_concurrent - maximum number of simultaneous requests (and pooled connections)
+            * keepalive_timeout - how long idle connections are kept in the pool
+            * name - name of the client for logs
+            * read_timeout - maximum time between two reads of the response in seconds (None - not limited)
+            * limit_per_host - maximum number of connections to one host (0 - not limited)
+            * dns_cache_ttl - how long resolved addresses are cached in seconds
+            * max_hosts - number of recently used hosts with their own stats (least recently used are forgotten)
+        '''
+        self.headers = headers if headers is not None else {}
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.max_concurrent = max_concurrent
+        self.keepalive_timeout = keepalive_timeout
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.name = name
+        self.session = None
+        self.semaphore = None
+        self.stats = {"requests": 0, "failures": 0, "active": 0, "waiting": 0, "time": 0.0}
+        self.hosts = OrderedDict()
+        self.max_hosts = max_hosts
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.dns_cache_ttl)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, headers=self.headers)
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+            logger.debug(f'HTTP session "{self.name}" was created (max concurrent requests: {self.max_concurrent}, per host: {self.limit_per_host})')
+        return self.session
+
+    async def start(self):
+        '''
+        Create session in advance (should be called when event loop is running)
+        '''
+        self.get_session()
+
+    async def request(self, method, url, binary=False, max_bytes=None, content_types=None, **kwargs):
+        '''
+        Send request and read the whole response
+        Input:
+            * method - HTTP method
+            * url - URL of request
+            * binary - read response as bytes (HTTPResponse.content) instead of text
+            * max_bytes - read only the first max_bytes of the body (it is streamed, the rest is not downloaded)
+            * content_types - allowed content types (e.g. ['text/html']), body of other responses is not read
+              (HTTPResponse.content and text are None)
+            * kwargs - arguments of aiohttp request (json, data, headers, params, ...)
+        Output: HTTPResponse
+        Raises aiohttp.ClientError or asyncio.TimeoutError
+        '''
+        session = self.get_session()
+        host = self.host_stats(urllib.parse.urlsplit(str(url)).hostname or '')
+        self.stats["waiting"] += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.stats["waiting"] -= 1
+        started = time.monotonic()
+        self.stats["requests"] += 1
+        self.stats["active"] += 1
+        host["requests"] += 1
+        host["active"] += 1
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                # headers stay case-insensitive
+                if content_types is not None and response.content_type not in content_types:
+                    logger.debug(f'Body of {url} was not read, content type: {response.content_type}')
+                    return HTTPResponse(response.status, None, response.headers.copy())
+                if max_bytes is not None:
+                    chunks, size = [], 0
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size >= max_bytes:
+                            break
+                    content = b''.join(chunks)[:max_bytes]
+                    truncated = size >= max_bytes and not response.content.at_eof()
+                    if binary:
+                        return HTTPResponse(response.status, None, response.headers.copy(), content, truncated)
+                    try:
+                        text = content.decode(response.charset or 'utf-8', errors='replace')
+                    except LookupError:
+                        text = content.decode('utf-8', errors='replace')
+                    return HTTPResponse(response.status, text, response.headers.copy(), content, truncated)
+                if binary:
+                    content = await response.read()
+                    return HTTPResponse(response.status, None, response.headers.copy(), content)
+                text = await response.text()
+                return HTTPResponse(response.status, text, response.headers.copy())
+        except BaseException:
+            self.stats["failures"] += 1
+            host["failures"] += 1
+            raise
+        finally:
+            self.semaphore.release()
+            self.stats["active"] -= 1
+            host["active"] -= 1
+            self.stats["time"] += time.monotonic() - started
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def close(self):
+        '''
+        Close session and all pooled connections
+        '''
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.debug(f'HTTP session "{self.name}" was closed')
+        self.session = None
+
+    def host_stats(self, hostname):
+        '''
+        Stats of the host (URLs come from users and search results, so only recently used hosts are kept)
+        '''
+        host = self.hosts.get(hostname)
+        if host is None:
+            host = self.hosts[hostname] = {"requests": 0, "failures": 0, "active": 0}
+        self.hosts.move_to_end(hostname)
+        if len(self.hosts) > self.max_hosts:
+            # hosts with requests in progress are kept
+            for name in [name for name, stats in self.hosts.items() if stats["active"] == 0][:len(self.hosts) - self.max_hosts]:
+                del self.hosts[name]
+        return host
+
+    def get_stats(self):
+        '''
+        Pool metrics: requests (total, failed, active, waiting for a free slot), average time of request,
+        pooled connections (idle and in use) and requests per host
+        '''
+        stats = dict(self.stats)
+        stats["average_time"] = round(stats.pop("time") / stats["requests"], 3) if stats["requests"] > 0 else 0
+        connector = self.session.connector if self.session is not None and not self.session.closed else None
+        stats["connections"] = {
+            "limit": self.max_concurrent,
+            "limit_per_host": self.limit_per_host,
+            "idle": sum(len(connections) for connections in getattr(connector, '_conns', {}).values()) if connector is not None else 0,
+            "in_use": len(getattr(connector, '_acquired', ())) if connector is not None else 0,
+        }
+        stats["hosts"] = {host: dict(host_stats) for host, host_stats in self.hosts.items()}
+        return stats
+
+
+web_client = None
+
+def get_web_client():
+    '''
+    HTTP client shared by web tools (search, URL opening) for the whole process
+    Settings are taken from the optional [HTTP] section
+    '''
+    global web_client
+    if web_client is None:
+        def get(option, default):
+            return config.getfloat("HTTP", option) if config.has_option("HTTP", option) else default
+        read_timeout = get("ReadTimeout", 15)
+        web_client = AsyncHTTPClient(
+            timeout=get("Timeout", 30),
+            connect_timeout=get("ConnectTimeout", 10),
+            read_timeout=read_timeout if read_timeout > 0 else None,
+            max_concurrent=int(get("MaxConnections", 20)),
+            limit_per_host=int(get("MaxConnectionsPerHost", 4)),
+            keepalive_timeout=get("KeepAlive", 30),
+            dns_cache_ttl=int(get("DNSCacheTTL", 300)),
+            name='web',
+            )
+    return web_client
@@ -25,11 +25,16 @@ import asyncio
 import json
 import time
 
+from chatutils.ratelimit import RateLimiter
+from chatutils.http_client import AsyncHTTPClient
+from chatutils.poller import OperationPoller
+from chatutils.resilience import with_retries, CircuitOpenError, TransientHTTPError
+
 
 ######## OpenAI Engine ########
 
 class DalleEngine:
-    def __init__(self, api_key, base_url=None):
+    def __init__(self, api_key, base_url=None, persistence=None):
         '''
         Initialize OpenAI API for DALL-E
         '''
@@ -39,6 +44,8 @@ class DalleEngine:
         self.client = AsyncOpenAI(
             api_key=api_key,
             base_url=base_url,
+            # retries are done by chatutils.resilience (with circuit breaker)
+            max_retries=0,
         )
         import configparser
         self.config = configparser.SafeConfigParser({
@@ -62,7 +69,7 @@ class DalleEngine:
         print('Image generation via DALL-E is enabled')
         print('-- Image generation is used to create images from text. It can be changed in the config file.')
         if self.settings["ImageRateLimitCount"] > 0 and self.settings["ImageRateLimitTime"] > 0:
-            self.image_rate_limit = {}
+            self.image_rate_limit = RateLimiter(window=self.settings["ImageRateLimitTime"], location='./data/tech/image_ratelimit.pickle', persistence=persistence, name='image_ratelimit')
             print(f'-- Image generation is rate limited (only {self.settings["ImageRateLimitCount"]} images per {self.settings["ImageRateLimitTime"]} seconds are allowed).')
         if self.settings["ImageGenerationPrice"] > 0:
             print(f'-- Image generation cost is {self.settings["ImageGenerationPrice"]} per image.')
@@ -147,7 +154,7 @@ class DalleEngine:
                 return None, 'No text prompt was given. Please try again.'
             revised_prompt, b64_image = None, None
             user_id = hashlib.sha1(str(id).encode("utf-8")).hexdigest() if self.end_user_id else None
-            response = await self.client.images.generate(
+            response = await with_retries(lambda: self.client.images.generate(
                         model=self.settings["ImageGenModel"],
                         prompt=prompt,
                         size=size,
@@ -156,7 +163,7 @@ class DalleEngine:
                         response_format="b64_json",
                         style=style,
                         user=str(user_id)
-                    )
+                    ), 'openai-images')
             if response.data[0].b64_json:
                 b64_image = response.data[0].b64_json
             if revision:
@@ -166,6 +173,9 @@ class DalleEngine:
                     logger.warning(f'Could not get revised prompt: {e}')
                     revised_prompt = None
             return b64_image, revised_prompt
+        except CircuitOpenError as e:
+            logger.error(f'Image generation is unavailable: {e}')
+            return None, 'Image generation is temporarily unavailable. Please try again later.'
         except self.openai.BadRequestError as e:
             logger.error('OpenAI BadRequestError: ' + str(e))
             if 'content_policy_violation' in str(e):
@@ -178,13 +188,14 @@ class DalleEngine:
             logger.exception('Could not imagine image from text')
             return None, None
         
-    async def generate_image(self, prompt, image_orientation=None, image_style=None):
+    async def generate_image(self, prompt, image_orientation=None, image_style=None, id='function'):
         '''
         Generate image from text prompt
         Input:
             * prompt - text prompt
             * orientation - orientation of image (landscape, portrait, default is None - square)
             * style - style of image (natural or vivid, default is None - vivid)
+            * id - id of user (image is counted in rate limit of user, 'function' - not rate limited)
         '''
         try:
             logger.debug(f'Generating image from prompt: {prompt}, orientation: {image_orientation}, style: {image_style}')
@@ -200,7 +211,7 @@ class DalleEngine:
             if image_style is not None:
                 if image_style == 'natural':
                     style = 'natural'
-            b64_image, revised_prompt = await self.imagine(prompt, id='function', size=size, style=style, n=1, quality="standard", revision=True)
+            b64_image, revised_prompt = await self.imagine(prompt, id=id, size=size, style=style, n=1, quality="standard", revision=True)
             return (b64_image, revised_prompt)
         except Exception as e:
             logger.exception('Could not generate image')
@@ -217,17 +228,8 @@ class DalleEngine:
                 return True
             if self.settings["ImageRateLimitCount"] <= 0 or self.settings["ImageRateLimitTime"] <= 0:
                 return True
-            if id not in self.image_rate_limit:
-                self.image_rate_limit[id] = []
-            # add current time to the list
-            current_time = time.time()
-            self.image_rate_limit[id].append(current_time)
-            # remove old times
-            self.image_rate_limit[id] = [t for t in self.image_rate_limit[id] if current_time - t < self.settings["ImageRateLimitTime"]]
-            # check if count is not exceeded
-            if len(self.image_rate_limit[id]) > self.settings["ImageRateLimitCount"]:
-                return False
-            return True
+            # check if count is not exceeded (request is counted only if it is allowed)
+            return self.image_rate_limit.hit(id, self.settings["ImageRateLimitCount"])
         except Exception as e:
             logger.error(f'Could not check image rate limit due to an error: {e}')
             return True
@@ -237,14 +239,14 @@ class DalleEngine:
 ######## Stability Engine ########
 
 class StabilityEngine:
-    def __init__(self, api_key):
+    def __init__(self, api_key, persistence=None):
         '''
         Initialize Stability Engine
         '''
         from random import randint
         self.randint = randint
-        import requests
-        self.requests = requests
+        import aiohttp
+        self.aiohttp = aiohttp
         import configparser
         self.config = configparser.SafeConfigParser({
             "ImageGenURL": "https://api.stability.ai/v2beta/stable-image/generate/core",
@@ -254,6 +256,7 @@ class StabilityEngine:
             "ImageRateLimitTime": 0,
             "NegativePrompt": "None",
             "Seed": -1,
+            "RequestTimeout": 120,
         })
         self.config.read('./data/.config', encoding='utf-8')
         self.settings = self.load_image_generation_settings()
@@ -264,11 +267,12 @@ class StabilityEngine:
             "Authorization": f"Bearer {api_key}",
             "accept": "application/json",
         }
+        self.client = AsyncHTTPClient(headers=self.headers, timeout=self.settings["RequestTimeout"], name='stability')
 
         print('Image generation via Stability Engine is enabled')
         print('-- Image generation is used to create images from text. It can be changed in the config file.')
         if self.settings["ImageRateLimitCount"] > 0 and self.settings["ImageRateLimitTime"] > 0:
-            self.image_rate_limit = {}
+            self.image_rate_limit = RateLimiter(window=self.settings["ImageRateLimitTime"], location='./data/tech/image_ratelimit.pickle', persistence=persistence, name='image_ratelimit')
             print(f'-- Image generation is rate limited (only {self.settings["ImageRateLimitCount"]} images per {self.settings["ImageRateLimitTime"]} seconds are allowed).')
         if self.settings["ImageGenerationPrice"] > 0:
             print(f'-- Image generation cost is {self.settings["ImageGenerationPrice"]} per image.')
@@ -289,6 +293,7 @@ class StabilityEngine:
             if settings["NegativePrompt"] == "None":
                 settings["NegativePrompt"] = None
             settings["Seed"] = int(self.config.get("ImageGeneration", "Seed"))
+            settings["RequestTimeout"] = self.config.getfloat("ImageGeneration", "RequestTimeout")
             settings["ImageGenerationStyle"] = "standard" # not supported by Stability Engine
             settings["ImageGenerationQuality"] = "standard" # not supported by Stability Engine
             return settings
@@ -373,14 +378,15 @@ class StabilityEngine:
             data["prompt"] = prompt
             data["output_format"] = output_format
 
-            response = self.requests.post(
-                self.settings["ImageGenURL"],
-                headers=self.headers,
-                files={
-                    "none": ''
-                },
-                data=data,
-            )
+            def get_form():
+                # multipart/form-data request (API does not accept urlencoded form)
+                # form can be sent only once, so it is built for every attempt
+                form = self.aiohttp.FormData()
+                for key, value in data.items():
+                    form.add_field(key, str(value))
+                form.add_field("none", b'', filename="none")
+                return form
+            response = await self.post(data=get_form)
 
             if response.status_code == 200:
                 response_data = response.json()
@@ -395,7 +401,7 @@ class StabilityEngine:
                     return None, f'Could not generate image. Please try again.'
             elif response.status_code == 400:
                 logger.error(f'Stability BadRequestError: {response.text}')
-                logger.debug(f'Stability request data: {response.request.body}')
+                logger.debug(f'Stability request data: {data}')
                 return None, 'Your request was rejected for some reason. Please try later or contact support.'
             elif response.status_code == 403:
                 logger.error(f'Stability ContentModerationError: {response.text}')
@@ -406,11 +412,14 @@ class StabilityEngine:
             else:
                 logger.error(f'Stability Error: {response.text}')
                 return None, 'Could not generate image. Please try again.'
+        except CircuitOpenError as e:
+            logger.error(f'Stability is unavailable: {e}')
+            return None, 'Image generation is temporarily unavailable. Please try again later.'
         except Exception as e:
             logger.exception('Could not imagine image from text with Stability Engine')
             return None, None
         
-    async def generate_image(self, prompt, image_orientation=None, image_style=None):
+    async def generate_image(self, prompt, image_orientation=None, image_style=None, id='function'):
         '''
         Generate image from text prompt
         Input:
@@ -418,6 +427,7 @@ class StabilityEngine:
             * orientation - orientation of image (landscape, portrait, default is None - square)
                 if horizontal, use 16:9 ratio, if vertical, use 9:16 ratio
             * style - style of image (natural or vivid - NOT supported by Stability Engine)
+            * id - id of user (image is counted in rate limit of user, 'function' - not rate limited)
         '''
         try:
             logger.debug(f'Generating image from prompt: {prompt}, orientation: {image_orientation}, style: {image_style}')
@@ -429,12 +439,33 @@ class StabilityEngine:
                     ratio = '16:9'
                 if image_orientation == 'portrait':
                     ratio = '9:16'
-            b64_image, revised_prompt = await self.imagine(prompt, id='function', ratio=ratio, negative_prompt=None, seed=0, output_format='jpeg')
+            b64_image, revised_prompt = await self.imagine(prompt, id=id, ratio=ratio, negative_prompt=None, seed=0, output_format='jpeg')
             return (b64_image, revised_prompt)
         except Exception as e:
             logger.exception('Could not generate image with Stability Engine')
             return None
 
+    async def post(self, data):
+        '''
+        Send generation request with retries of transient errors (429, 5xx, timeouts, connection errors)
+        Input data is a function that builds the form. If retries are over, the last response is returned as is
+        '''
+        async def request():
+            response = await self.client.post(self.settings["ImageGenURL"], data=data())
+            if response.status_code == 429 or response.status_code >= 500:
+                raise TransientHTTPError(response)
+            return response
+        try:
+            return await with_retries(request, 'stability')
+        except TransientHTTPError as e:
+            return e.response
+
+    async def close(self):
+        '''
+        Close HTTP session
+        '''
+        await self.client.close()
+
     async def image_rate_limit_check(self, id):
         '''
         Check if image generation is not rate limited
@@ -446,17 +477,8 @@ class StabilityEngine:
                 return True
             if self.settings["ImageRateLimitCount"] <= 0 or self.settings["ImageRateLimitTime"] <= 0:
                 return True
-            if id not in self.image_rate_limit:
-                self.image_rate_limit[id] = []
-            # add current time to the list
-            current_time = time.time()
-            self.image_rate_limit[id].append(current_time)
-            # remove old times
-            self.image_rate_limit[id] = [t for t in self.image_rate_limit[id] if current_time - t < self.settings["ImageRateLimitTime"]]
-            # check if count is not exceeded
-            if len(self.image_rate_limit[id]) > self.settings["ImageRateLimitCount"]:
-                return False
-            return True
+            # check if count is not exceeded (request is counted only if it is allowed)
+            return self.image_rate_limit.hit(id, self.settings["ImageRateLimitCount"])
         except Exception as e:
             logger.error(f'Could not check image rate limit due to an error: {e}')
             return True
@@ -465,14 +487,14 @@ class StabilityEngine:
 ######## Yandex ART Engine ########
 
 class YandexEngine:
-    def __init__(self, api_key):
+    def __init__(self, api_key, persistence=None):
         '''
-        Initialize Stability Engine
+        Initialize Yandex ART Engine
         '''
         from random import randint
         self.randint = randint
-        import requests
-        self.requests = requests
+        import aiohttp
+        self.aiohttp = aiohttp
         import configparser
         self.config = configparser.SafeConfigParser({
             "ImageGenModel": "yandex-art/latest",
@@ -483,6 +505,10 @@ class YandexEngine:
             "ImageRateLimitTime": 0,
             "Seed": 0,
             "RequestLogging": False,
+            "RequestTimeout": 60,
+            "PollInitialDelay": 2,
+            "PollMaxDelay": 10,
+            "PollTimeout": 90,
         })
         self.config.read('./data/.config', encoding='utf-8')
         self.settings = self.load_image_generation_settings()
@@ -496,6 +522,15 @@ class YandexEngine:
         }
         if self.settings['RequestLogging'] == False:
             self.headers['x-data-logging-enabled'] = 'false'
+        self.client = AsyncHTTPClient(headers=self.headers, timeout=self.settings["RequestTimeout"], name='yandexart')
+        # all pending generations are checked by a single background task
+        self.poller = OperationPoller(
+            self.fetch_operation,
+            initial_delay=self.settings["PollInitialDelay"],
+            max_delay=self.settings["PollMaxDelay"],
+            timeout=self.settings["PollTimeout"],
+            name='YandexART',
+            )
 
         if self.settings['ImageGenModel'].startswith('art://'):
             # if model is already in correct format (art://<folder_ID>/yandex-art/latest)
@@ -507,7 +542,7 @@ class YandexEngine:
         print('Image generation via YandexART is enabled')
         print('-- Image generation is used to create images from text. It can be changed in the config file.')
         if self.settings["ImageRateLimitCount"] > 0 and self.settings["ImageRateLimitTime"] > 0:
-            self.image_rate_limit = {}
+            self.image_rate_limit = RateLimiter(window=self.settings["ImageRateLimitTime"], location='./data/tech/image_ratelimit.pickle', persistence=persistence, name='image_ratelimit')
             print(f'-- Image generation is rate limited (only {self.settings["ImageRateLimitCount"]} images per {self.settings["ImageRateLimitTime"]} seconds are allowed).')
         if self.settings["ImageGenerationPrice"] > 0:
             print(f'-- Image generation cost is {self.settings["ImageGenerationPrice"]} per image.')
@@ -528,6 +563,10 @@ class YandexEngine:
             settings["RequestLogging"] = self.config.getboolean("ImageGeneration", "RequestLogging") 
             settings["CatalogID"] = self.config.get("ImageGeneration", "CatalogID")
             settings["ImageGenModel"] = self.config.get("ImageGeneration", "ImageGenModel")
+            settings["RequestTimeout"] = self.config.getfloat("ImageGeneration", "RequestTimeout")
+            settings["PollInitialDelay"] = self.config.getfloat("ImageGeneration", "PollInitialDelay")
+            settings["PollMaxDelay"] = self.config.getfloat("ImageGeneration", "PollMaxDelay")
+            settings["PollTimeout"] = self.config.getfloat("ImageGeneration", "PollTimeout")
             settings["ImageGenerationStyle"] = "standard" # not supported by Yandex ART
             settings["ImageGenerationQuality"] = "standard" # not supported by Yandex ART
             settings["ImageGenerationSize"] = "1:1" # not supported by Yandex ART
@@ -536,40 +575,34 @@ class YandexEngine:
             logger.error(f'Could not load image generation settings due: {e}')
             return None
 
-    async def check_image_generation(self, operation_id, delay=3, iterations=10):
-        '''
-        Generation takes some time, so we need to check if image was generated every <delay> seconds
+    async def fetch_operation(self, operation_id):
+        '''
+        Check operation of image generation once
+        Output: (done, base64 image or None)
+        '''
+        response = await self.client.get(f'{self.settings["ImageCheckURL"]}/{operation_id}')
+        if response.status_code != 200:
+            logger.error(f'YandexART Error: Could not check image generation (status code: {response.status_code}). Response: {response.text}')
+            return True, None
+        response_data = response.json()
+        if "response" in response_data:
+            if "image" in response_data["response"]:
+                return True, response_data["response"]["image"]
+        elif "done" in response_data:
+            if response_data["done"] == False:
+                return False, None
+        logger.error(f'YandexART Error: Could not check image generation. Response: {response_data}')
+        return True, None
+
+    async def check_image_generation(self, operation_id):
+        '''
+        Generation takes some time, so operation is checked by the poller
+        (with growing delays until PollTimeout is reached)
         Input:
             * operation_id - id of operation
-            * delay - delay between checks
-            * iterations - number of iterations to check - if image is not generated after that, return None
-        '''
-        check_generation = True
-        i = 0
-        while check_generation:
-            response = self.requests.get(
-                f'{self.settings["ImageCheckURL"]}/{operation_id}',
-                headers=self.headers,
-            )
-            if response.status_code == 200:
-                response_data = response.json()
-                if "response" in response_data:
-                    if "image" in response_data["response"]:
-                        return response_data["response"]["image"]
-                elif "done" in response_data:
-                    if response_data["done"] == False:
-                        if i >= iterations:
-                            logger.error(f'YandexART: Image generation took too long. Iterations: {i}. Delay: {delay}.')
-                            return None
-                        logger.debug(f'YandexART: Image is not ready yet. Iteration: {i}/{iterations}.')
-                        i += 1
-                        await asyncio.sleep(delay)
-                else:
-                    logger.error(f'YandexART Error: Could not check image generation. Response: {response_data}')
-                    return None                    
-            else:
-                logger.error(f'YandexART Error: Could not check image generation (status code: {response.status_code}). Response: {response.text}')
-                return None
+        Output: base64 image or None
+        '''
+        return await self.poller.wait(operation_id)
         
     async def imagine(self, prompt, id=0, seed=-1, revision=False):
         '''
@@ -609,11 +642,7 @@ class YandexEngine:
                 data["generationOptions"]["seed"] = str(seed)
 
             logger.debug(f'YandexART request. Prompt: {prompt}. Seed: {seed}.')
-            response = self.requests.post(
-                self.settings["ImageGenURL"],
-                headers=self.headers,
-                json=data,
-            )
+            response = await self.post(json=data)
 
             if response.status_code == 200:
                 # we should check API if image was done
@@ -631,7 +660,7 @@ class YandexEngine:
                 return image, revised_prompt
             elif response.status_code == 400:
                 logger.error(f'YandexART BadRequestError: {response.text}')
-                logger.debug(f'YandexART request data: {response.request.body}')
+                logger.debug(f'YandexART request data: {data}')
                 return None, 'Request was rejected. Please try later or contact support.'
             elif response.status_code == 403:
                 logger.error(f'YandexART ContentModerationError: {response.text}')
@@ -642,29 +671,55 @@ class YandexEngine:
             else:
                 logger.error(f'YandexART Error: {response.text}. Code: {response.status_code}')
                 return None, 'Could not generate image. Please try again later or contact support.'
+        except CircuitOpenError as e:
+            logger.error(f'YandexART is unavailable: {e}')
+            return None, 'Image generation is temporarily unavailable. Please try again later.'
         except Exception as e:
             logger.exception(f'Could not imagine image from text with Yandex ART: {e}')
             return None, None
     
-    async def generate_image(self, prompt, image_orientation=None, image_style=None):
+    async def generate_image(self, prompt, image_orientation=None, image_style=None, id='function'):
         '''
         Generate image from text prompt
         Input:
             * prompt - text prompt
             * orientation - orientation of image (landscape, portrait, default is None - square)
             * style - style of image (natural or vivid, default is None - vivid)
+            * id - id of user (image is counted in rate limit of user, 'function' - not rate limited)
         '''
         try:
             logger.debug(f'Generating image from prompt: {prompt}, orientation: {image_orientation}, style: {image_style}')
             if prompt is None:
                 return None, None
             seed = self.settings["Seed"]
-            b64_image, revised_prompt = await self.imagine(prompt, id='function', seed=seed)
+            b64_image, revised_prompt = await self.imagine(prompt, id=id, seed=seed)
             return (b64_image, revised_prompt)
         except Exception as e:
             logger.exception('Could not generate image with Yandex ART')
             return None
         
+    async def post(self, json):
+        '''
+        Send generation request with retries of transient errors (429, 5xx, timeouts, connection errors)
+        If retries are over, the last response is returned as is
+        '''
+        async def request():
+            response = await self.client.post(self.settings["ImageGenURL"], json=json)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise TransientHTTPError(response)
+            return response
+        try:
+            return await with_retries(request, 'yandexart')
+        except TransientHTTPError as e:
+            return e.response
+
+    async def close(self):
+        '''
+        Stop polling and close HTTP session
+        '''
+        await self.poller.close()
+        await self.client.close()
+
     async def image_rate_limit_check(self, id):
         '''
         Check if image generation is not rate limited
@@ -676,17 +731,8 @@ class YandexEngine:
                 return True
             if self.settings["ImageRateLimitCount"] <= 0 or self.settings["ImageRateLimitTime"] <= 0:
                 return True
-            if id not in self.image_rate_limit:
-                self.image_rate_limit[id] = []
-            # add current time to the list
-            current_time = time.time()
-            self.image_rate_limit[id].append(current_time)
-            # remove old times
-            self.image_rate_limit[id] = [t for t in self.image_rate_limit[id] if current_time - t < self.settings["ImageRateLimitTime"]]
-            # check if count is not exceeded
-            if len(self.image_rate_limit[id]) > self.settings["ImageRateLimitCount"]:
-                return False
-            return True
+            # check if count is not exceeded (request is counted only if it is allowed)
+            return self.image_rate_limit.hit(id, self.settings["ImageRateLimitCount"])
         except Exception as e:
             logger.error(f'Could not check image rate limit due to an error: {e}')
             return True
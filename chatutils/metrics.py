@@ -10,9 +10,15 @@ Metrics include:
     - Cost per user
 '''
 import pickle
+import sqlite3
+import json
 import time
 
-chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
+chats = {}
+db = sqlite3.connect('../data/tech/chats.db')
+for userid, body in db.execute('SELECT user_id, body FROM messages ORDER BY user_id, seq'):
+    chats.setdefault(json.loads(userid), []).append(json.loads(body))
+db.close()
 stats = pickle.load(open('../data/tech/stats.pickle', 'rb'))
 rates = pickle.load(open('../data/tech/ratelimit.pickle', 'rb'))
 
@@ -0,0 +1,147 @@
+# Description: Write-behind persistence for SirChatalot state
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Persistence")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import atexit
+import pickle
+import asyncio
+
+
+def pickle_writer(location):
+    '''
+    Create function that writes payload to pickle file
+    File is replaced atomically, so it is never left half-written
+    '''
+    def write(payload):
+        tmp_location = location + '.tmp'
+        with open(tmp_location, 'wb') as f:
+            pickle.dump(payload, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, location)
+    return write
+
+
+class WriteBehind:
+    '''
+    Write-behind persistence
+    State owners register a target (snapshot + write functions) and mark it dirty on every change.
+    Dirty targets are flushed by a background task every FlushInterval seconds
+    (or earlier if there are MaxPendingChanges changes):
+        * snapshot() is called in the event loop and should be cheap (copy of the state)
+        * write(snapshot) is called in a worker thread
+    Everything is flushed on stop() and at interpreter exit.
+    '''
+    def __init__(self, interval=None, max_pending=None):
+        self.interval = interval if interval is not None else (config.getfloat("Persistence", "FlushInterval") if config.has_option("Persistence", "FlushInterval") else 2.0)
+        self.max_pending = max_pending if max_pending is not None else (config.getint("Persistence", "MaxPendingChanges") if config.has_option("Persistence", "MaxPendingChanges") else 100)
+        self.targets = {}
+        self.dirty = set()
+        self.pending = 0
+        self.task = None
+        self.lock = None
+        self.wakeup = None
+        atexit.register(self.flush_sync)
+        logger.info(f'Write-behind persistence was initialized (flush interval: {self.interval}s, max pending changes: {self.max_pending})')
+
+    def register(self, name, snapshot, write):
+        '''
+        Register persisted state
+        Input:
+            * name - unique name of the state
+            * snapshot - function that returns a copy of the state to write
+            * write - function that writes the snapshot (runs in a worker thread)
+        '''
+        self.targets[name] = (snapshot, write)
+
+    def mark_dirty(self, name):
+        '''
+        Mark state as changed, it will be written with the next flush
+        '''
+        self.dirty.add(name)
+        self.pending += 1
+        if self.pending >= self.max_pending and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def start(self):
+        '''
+        Start background flushing (should be called from the running event loop)
+        '''
+        if self.task is not None:
+            return
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+        logger.debug('Write-behind persistence was started')
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        '''
+        Write all dirty states (in a worker thread)
+        '''
+        if len(self.dirty) == 0:
+            return
+        async with self.lock:
+            names, self.dirty, self.pending = self.dirty, set(), 0
+            for name in names:
+                snapshot, write = self.targets[name]
+                try:
+                    await asyncio.to_thread(write, snapshot())
+                except Exception as e:
+                    logger.exception(f'Could not write state "{name}", it will be retried')
+                    self.dirty.add(name)
+
+    async def stop(self):
+        '''
+        Stop background flushing and write everything that is left
+        '''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.lock is not None:
+            await self.flush()
+        else:
+            self.flush_sync()
+        logger.debug('Write-behind persistence was stopped')
+
+    def flush_sync(self):
+        '''
+        Write all dirty states in the current thread (used when there is no event loop)
+        '''
+        names, self.dirty, self.pending = self.dirty, set(), 0
+        for name in names:
+            snapshot, write = self.targets[name]
+            try:
+                write(snapshot())
+            except Exception as e:
+                logger.exception(f'Could not write state "{name}"')
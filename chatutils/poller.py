@@ -0,0 +1,148 @@
+# Description: Polling of long-running operations for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Poller")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import asyncio
+import random
+
+
+class PendingOperation:
+    def __init__(self, operation_id, future, delay, deadline, next_check):
+        self.operation_id = operation_id
+        self.future = future
+        self.delay = delay
+        self.deadline = deadline
+        self.next_check = next_check
+
+
+class OperationPoller:
+    '''
+    Polls many long-running operations (e.g. YandexART image generation) from a single background task
+    Every operation is checked with exponential backoff and jitter until it is done or its deadline is reached.
+    Callers just await wait(operation_id), cancelling the caller removes the operation.
+    Background task is started on the first operation and exits when nothing is pending.
+    '''
+    def __init__(self, fetch, initial_delay=1.0, max_delay=10.0, factor=1.6, jitter=0.2, timeout=60.0, name='poller'):
+        '''
+        Input:
+            * fetch - coroutine function fetch(operation_id) -> (done, result), exceptions mean that operation failed
+            * initial_delay - delay before the first check (seconds)
+            * max_delay - maximum delay between checks (seconds)
+            * factor - delay multiplier after every check
+            * jitter - random part of delay (0.2 - up to +-20%)
+            * timeout - default deadline of an operation (seconds)
+            * name - name of the poller for logs
+        '''
+        self.fetch = fetch
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.name = name
+        self.pending = {}
+        self.task = None
+        self.wakeup = None
+
+    def with_jitter(self, delay):
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def wait(self, operation_id, timeout=None):
+        '''
+        Wait for the result of operation
+        Output: result returned by fetch or None if operation failed or deadline was reached
+        '''
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        timeout = timeout if timeout is not None else self.timeout
+        future = loop.create_future()
+        self.pending[operation_id] = PendingOperation(operation_id, future, self.initial_delay, now + timeout, now + self.with_jitter(self.initial_delay))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        else:
+            self.wakeup.set()
+        try:
+            return await future
+        finally:
+            # remove operation if caller was cancelled
+            operation = self.pending.get(operation_id)
+            if operation is not None and operation.future is future:
+                del self.pending[operation_id]
+
+    async def check(self, operation):
+        '''
+        Check operation once and schedule the next check if it is not done
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            done, result = await self.fetch(operation.operation_id)
+        except Exception as e:
+            logger.error(f'{self.name}: could not check operation {operation.operation_id}: {e}')
+            done, result = True, None
+        if operation.future.done():
+            return
+        if done:
+            operation.future.set_result(result)
+            return
+        now = loop.time()
+        if now >= operation.deadline:
+            logger.error(f'{self.name}: operation {operation.operation_id} took too long')
+            operation.future.set_result(None)
+            return
+        operation.delay = min(operation.delay * self.factor, self.max_delay)
+        operation.next_check = min(now + self.with_jitter(operation.delay), operation.deadline)
+        logger.debug(f'{self.name}: operation {operation.operation_id} is not ready yet, next check in {operation.next_check - now:.1f}s')
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # forget finished and cancelled operations
+            for operation_id in [k for k, v in self.pending.items() if v.future.done()]:
+                del self.pending[operation_id]
+            if len(self.pending) == 0:
+                return
+            now = loop.time()
+            due = [operation for operation in self.pending.values() if operation.next_check <= now]
+            if len(due) > 0:
+                await asyncio.gather(*[self.check(operation) for operation in due])
+                continue
+            next_check = min(operation.next_check for operation in self.pending.values())
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(next_check - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        '''
+        Stop polling, waiting callers get None
+        '''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for operation in self.pending.values():
+            if not operation.future.done():
+                operation.future.set_result(None)
+        self.pending = {}
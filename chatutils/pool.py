@@ -0,0 +1,204 @@
+# Description: Pool of API keys and endpoints of a provider for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Pool")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import time
+
+from chatutils.resilience import with_retries, get_breaker, is_transient, status_code, CircuitOpenError
+from chatutils.scheduler import parse_reset
+
+# how long a member with a rejected key (401, 402, 403) is not used
+EjectTime = config.getfloat("Resilience", "EjectTime") if config.has_option("Resilience", "EjectTime") else 300.0
+
+
+def pool_sections(provider):
+    '''
+    Config sections of a provider: main section and sections of additional keys
+    ([OpenAI], [OpenAI.pool1], [OpenAI.openrouter], ...)
+    '''
+    sections = [provider] if config.has_section(provider) else []
+    return sections + sorted(section for section in config.sections() if section.startswith(provider + '.'))
+
+def get_option(section, option, fallback_section=None):
+    '''
+    Get option of a pool section (or of fallback section if it is not set), None if it is not set anywhere
+    '''
+    for name in [section, fallback_section]:
+        if name is not None and config.has_option(name, option):
+            return config.get(name, option)
+    return None
+
+
+class PoolMember:
+    '''
+    One key (and endpoint) of a provider
+    Member is unhealthy while its circuit breaker is open or it is ejected
+    (rejected key or exhausted request quota reported by headers).
+    '''
+    def __init__(self, name, client=None, model=None, settings=None):
+        '''
+        Input:
+            * name - name of member (config section), also name of its circuit breaker (lowercase)
+            * client - API client of member
+            * model - model of member if it differs from the engine model (e.g. OpenRouter model names)
+            * settings - other settings of member (e.g. catalog ID for Yandex)
+        '''
+        self.name = name
+        self.client = client
+        self.model = model
+        self.settings = settings if settings is not None else {}
+        self.breaker = get_breaker(name.lower())
+        self.outstanding = 0
+        self.remaining = None
+        self.ejected_until = 0
+        self.requests = 0
+        self.failures = 0
+
+    def healthy(self, now):
+        if now < self.ejected_until:
+            return False
+        return self.breaker.ready(now)
+
+    def eject(self, seconds, reason):
+        self.ejected_until = max(self.ejected_until, time.monotonic() + seconds)
+        logger.warning(f'Pool member "{self.name}" is ejected for {seconds:.0f}s: {reason}')
+
+    async def on_response(self, response):
+        '''
+        Response hook for httpx clients
+        '''
+        self.update_from_headers(response.headers)
+
+    def update_from_headers(self, headers):
+        '''
+        Remember remaining request quota of the key (OpenAI x-ratelimit-*, Anthropic anthropic-ratelimit-*)
+        '''
+        try:
+            for remaining, reset in [
+                ('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+                ('anthropic-ratelimit-requests-remaining', 'anthropic-ratelimit-requests-reset'),
+                ]:
+                if remaining not in headers:
+                    continue
+                self.remaining = int(headers[remaining])
+                if self.remaining <= 0:
+                    wait = parse_reset(headers.get(reset))
+                    if wait:
+                        self.eject(wait, 'request quota is exhausted')
+        except Exception as e:
+            logger.debug(f'Could not parse rate limit headers of "{self.name}": {e}')
+
+    def get_state(self):
+        return {
+            "healthy": self.healthy(time.monotonic()),
+            "outstanding": self.outstanding,
+            "remaining": self.remaining,
+            "requests": self.requests,
+            "failures": self.failures,
+            "circuit": self.breaker.state,
+        }
+
+
+class ClientPool:
+    '''
+    Spreads requests of a provider between several keys and endpoints
+    Request goes to the healthy member with the least outstanding requests (ties are broken
+    by the remaining request quota, then in turns). If a member fails with a transient error
+    or its key is rejected, the request fails over to the next member. Retries with backoff
+    are done only on the last member that is left.
+    '''
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+        self.turn = 0
+        logger.info(f'Pool "{name}" was initialized with {len(members)} members: {", ".join(member.name for member in members)}')
+
+    def pick(self, exclude=()):
+        '''
+        Choose member for the next request (None if there are no healthy members)
+        '''
+        now = time.monotonic()
+        # rotate members so that idle ones are used in turns
+        self.turn = (self.turn + 1) % len(self.members)
+        members = self.members[self.turn:] + self.members[:self.turn]
+        candidates = [member for member in members if member not in exclude and member.healthy(now)]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda member: (member.outstanding, -(member.remaining or 0)))
+
+    async def run(self, func, retry_if=None):
+        '''
+        Send request with fail over between members
+        Input:
+            * func - coroutine function func(member) that sends the request with member.client
+            * retry_if - additional check if error can be retried (see resilience.with_retries)
+        Output: result of func
+        Raises the last error if all members failed, CircuitOpenError if there are no healthy members
+        '''
+        tried = []
+        error = None
+        while True:
+            member = self.pick(tried)
+            if member is None:
+                if error is not None:
+                    raise error
+                raise CircuitOpenError(self.name, self.retry_in())
+            tried.append(member)
+            # while other members are left, failing over is faster than waiting for backoff
+            last = self.pick(tried) is None
+            member.outstanding += 1
+            member.requests += 1
+            try:
+                return await with_retries(lambda: func(member), member.breaker.name, retry_if=retry_if, max_retries=None if last else 0)
+            except CircuitOpenError as e:
+                error = error if error is not None else e
+            except Exception as e:
+                if retry_if is not None and not retry_if(e):
+                    raise
+                code = status_code(e)
+                if code in [401, 402, 403] and len(self.members) > 1:
+                    member.eject(EjectTime, f'key was rejected (HTTP {code})')
+                elif not is_transient(e):
+                    raise
+                member.failures += 1
+                error = e
+                if not last:
+                    logger.warning(f'Pool "{self.name}": member "{member.name}" failed ({type(e).__name__}: {e}), failing over')
+            finally:
+                member.outstanding -= 1
+
+    def retry_in(self):
+        '''
+        Seconds until the first member becomes healthy again
+        '''
+        now = time.monotonic()
+        waits = []
+        for member in self.members:
+            wait = max(member.ejected_until - now, 0)
+            if member.breaker.state == 'open':
+                wait = max(wait, member.breaker.recovery_time - (now - member.breaker.opened_at))
+            waits.append(wait)
+        return min(waits) if len(waits) > 0 else 0
+
+    def get_state(self):
+        '''
+        State of all members ({name: {...}})
+        '''
+        return {member.name: member.get_state() for member in self.members}
@@ -20,10 +20,21 @@ logger.addHandler(handler)
 
 import pickle
 import os
+import asyncio
 from pydub import AudioSegment
 from datetime import datetime
 
 from chatutils.audio_engines import get_audio_engine
+from chatutils.storage import ChatStore
+from chatutils.persistence import WriteBehind, pickle_writer
+from chatutils.history import HistoryTrimmer
+from chatutils.scheduler import get_schedulers
+from chatutils.hedging import Hedger, LatencyTracker, get_hedging_settings, plain_history
+from chatutils.cache import SummaryCache, ImageDescriptionCache, get_cache_settings
+from chatutils.http_client import get_web_client
+from chatutils.resilience import get_breakers_state
+from chatutils.tools import ToolRegistry, get_tools_settings
+from chatutils.summarizer import MapReduceSummarizer
 # Support: OpenAI API, YandexGPT API, Claude API
 from chatutils.engines import OpenAIEngine, YandexEngine, AnthropicEngine
 
@@ -36,20 +47,39 @@ class ChatProc:
         self.log_chats = config.getboolean("Logging", "LogChats") if config.has_option("Logging", "LogChats") else False
         self.model_prompt_price, self.model_completion_price = 0, 0
         self.audio_format, self.s2t_model_price = ".wav", 0
-        if text == "openai":
-            self.text_engine = OpenAIEngine(text=True)
-        elif text == "yagpt" or text == "yandexgpt" or text == "yandex":
-            self.text_engine = YandexEngine(text=True)
-        elif text == "claude" or text == "anthropic":
-            self.text_engine = AnthropicEngine(text=True)
-        else:
-            logger.error("Unknown text engine: {}".format(text))
-            raise Exception("Unknown text engine: {}".format(text))
+        # state is written in background (see start/stop)
+        self.persistence = WriteBehind()
+        # requests to providers are queued fairly between users and kept within rate budgets
+        self.schedulers = get_schedulers()
+        self.text_engine = self.load_text_engine(text)
         
+        if hasattr(self.text_engine, 'response_hooks'):
+            self.text_engine.response_hooks.append(self.schedulers["text"].update_from_headers)
         self.model_prompt_price = self.text_engine.model_prompt_price
         self.model_completion_price = self.text_engine.model_completion_price
         self.max_tokens = self.text_engine.max_tokens
         self.summarize_too_long = self.text_engine.summarize_too_long
+        # cached prompt tokens are counted and priced separately
+        self.prompt_caching = getattr(self.text_engine, 'prompt_caching', False)
+        # history is trimmed to 80% of max_tokens, 20% of tokens are left for response
+        # in block mode it is trimmed deeper and less often, so the prompt prefix stays the same
+        # for many turns and provider prompt caching works
+        self.trim_mode = config.get("History", "TrimMode").lower() if config.has_option("History", "TrimMode") else "turn"
+        trim_ratio = 0.8
+        if self.trim_mode == "block":
+            trim_ratio = config.getfloat("History", "BlockTrimRatio") if config.has_option("History", "BlockTrimRatio") else 0.5
+        self.history_trimmer = HistoryTrimmer(self.max_tokens, target_ratio=trim_ratio)
+        # summaries of the same texts are made once (see SummaryCache)
+        cache_settings = get_cache_settings()
+        self.summary_cache = SummaryCache(max_size=cache_settings["SummaryCacheSize"], ttl=cache_settings["SummaryCacheTTL"])
+        self.summary_cache.wrap(self.text_engine)
+        self.summary_disk_cache = cache_settings["SummaryDiskCache"]
+        # descriptions of images are made once for every image (see ImageDescriptionCache)
+        self.image_description_cache = None
+        if getattr(self.text_engine, 'vision', False):
+            self.image_description_cache = ImageDescriptionCache(max_size=cache_settings["ImageDescriptionCacheSize"], concurrency=cache_settings["DescribeConcurrency"])
+            self.image_description_cache.wrap(self.text_engine)
+        self.image_description_disk_cache = cache_settings["ImageDescriptionDiskCache"]
         
         self.vision = self.text_engine.vision
         if self.vision:
@@ -75,6 +105,12 @@ class ChatProc:
             self.text_engine.function_calling_tools = self.function_calling_tools
             logger.debug(f'Function calling is enabled')
 
+        # slow answers of the text engine can be hedged with a secondary engine
+        self.hedger = None
+        hedging = get_hedging_settings()
+        if hedging is not None:
+            self.load_hedging(hedging)
+
         self.speech_engine = None
         if speech is not None:
             try:
@@ -103,17 +139,94 @@ class ChatProc:
 
         self.file_summary_tokens = int(config.get("Files", "MaxSummaryTokens")) if config.has_option("Files", "MaxSummaryTokens") else (self.max_tokens // 2)
         self.max_file_length = int(config.get("Files", "MaxFileLength")) if config.has_option("Files", "MaxFileLength") else 10000
+        # long files are summarized by chunks (see MapReduceSummarizer)
+        self.file_chunk_tokens = int(config.get("Files", "ChunkTokens")) if config.has_option("Files", "ChunkTokens") else (self.max_tokens * 3 // 4)
+        self.file_summary_concurrency = int(config.get("Files", "SummaryConcurrency")) if config.has_option("Files", "SummaryConcurrency") else 4
 
-        # load chat history from file
-        self.chats_location = "./data/tech/chats.pickle"
-        self.chats = self.load_pickle(self.chats_location)
+        # load chat history from database (old chats.pickle is imported on first start)
+        self.chats_location = "./data/tech/chats.db"
+        self.chat_store = ChatStore(self.chats_location, legacy_location="./data/tech/chats.pickle", persistence=self.persistence)
+        self.chats = self.chat_store.chats
+        # token counts of messages are memoized and kept in the same database
+        self.text_engine.token_counter.bind(self.chat_store)
+        if self.hedger is not None:
+            self.hedger.secondary.token_counter.bind(self.chat_store)
+        if self.summary_disk_cache:
+            self.summary_cache.bind(self.chat_store)
+        if self.image_description_cache is not None and self.image_description_disk_cache:
+            self.image_description_cache.bind(self.chat_store)
         # load statistics from file
         self.stats_location = "./data/tech/stats.pickle"
         self.stats = self.load_pickle(self.stats_location)
+        self.persistence.register('stats', lambda: {id: dict(stats) for id, stats in self.stats.items()}, pickle_writer(self.stats_location))
 
         if self.log_chats:
             logger.info('* Chat history is logged *')
 
+    async def start(self):
+        '''
+        Start background tasks (should be called when event loop is running)
+        '''
+        await self.persistence.start()
+        if getattr(self, 'webengine', None) is not None or getattr(self, 'urlopener', None) is not None:
+            await get_web_client().start()
+
+    async def stop(self):
+        '''
+        Stop background tasks, close connections and write all pending changes
+        '''
+        logger.info(f'Circuit breakers: {get_breakers_state()}')
+        if hasattr(self.text_engine, 'pool'):
+            logger.info(f'Text engine pool: {self.text_engine.pool.get_state()}')
+        if hasattr(self.text_engine, 'close'):
+            await self.text_engine.close()
+        if self.hedger is not None and hasattr(self.hedger.secondary, 'close'):
+            await self.hedger.secondary.close()
+        if self.image_engine is not None and hasattr(self.image_engine, 'close'):
+            await self.image_engine.close()
+        if getattr(self, 'webengine', None) is not None or getattr(self, 'urlopener', None) is not None:
+            logger.info(f'Web HTTP client stats: {get_web_client().get_stats()}')
+            await get_web_client().close()
+        await self.persistence.stop()
+
+    def load_text_engine(self, text):
+        '''
+        Create text engine by its name
+        '''
+        if text == "openai":
+            return OpenAIEngine(text=True)
+        elif text == "yagpt" or text == "yandexgpt" or text == "yandex":
+            return YandexEngine(text=True)
+        elif text == "claude" or text == "anthropic":
+            return AnthropicEngine(text=True)
+        else:
+            logger.error("Unknown text engine: {}".format(text))
+            raise Exception("Unknown text engine: {}".format(text))
+
+    def load_hedging(self, settings):
+        '''
+        Load secondary text engine for hedged requests (see chatutils.hedging)
+        '''
+        try:
+            secondary = self.load_text_engine(settings["Engine"].lower())
+            # tool calls are processed for the primary engine only
+            secondary.function_calling = False
+            secondary.vision = False
+            tracker = LatencyTracker(
+                percentile=settings["Percentile"],
+                window=settings["Window"],
+                min_samples=settings["MinSamples"],
+                initial_delay=settings["InitialDelay"],
+                min_delay=settings["MinDelay"],
+                max_delay=settings["MaxDelay"],
+                )
+            self.hedger = Hedger(secondary, tracker)
+            print(f'Hedging is enabled, secondary engine: {settings["Engine"]}')
+            print(f'-- Slow answers (slower than {settings["Percentile"]:g}th percentile of recent answers) are requested from the secondary engine too. The first answer is used.\n')
+        except Exception as e:
+            logger.exception('Could not load secondary engine for hedging, hedging is disabled')
+            self.hedger = None
+
     def load_function_calling(self, text):
         '''
         Load function calling tools
@@ -126,27 +239,89 @@ class ChatProc:
             tools_config = AnthropicConfig()
         self.webengine = None
         self.urlopener = None
-        self.available_functions = {}
-        self.function_calling_tools = []
+        # all tool calls of an answer are run at once, results are sent back in one request
+        tools_settings = get_tools_settings()
+        self.tools_max_rounds = max(tools_settings["MaxRounds"], 1)
+        self.tools = ToolRegistry(timeout=tools_settings["Timeout"])
         if self.image_generation:
-            self.available_functions["generate_image"] = self.image_engine.generate_image
-            self.function_calling_tools.append(tools_config.image_generation)
+            self.tools.register("generate_image", self.tool_generate_image, tools_config.image_generation, timeout=tools_settings["ImageTimeout"])
         if 'Web' in config:
             if config.has_option("Web", "SearchEngine"):
                 if str(config.get("Web", "SearchEngine")).lower() == "google":
                     from chatutils.web_engines import GoogleEngine
                     self.webengine = GoogleEngine()
                     logger.debug(f'Web search engine is set to Google')
-                    self.available_functions["web_search"] = self.webengine.search
-                    self.function_calling_tools.append(tools_config.web_search)
+                    self.tools.register("web_search", self.tool_web_search, tools_config.web_search)
             if config.has_option("Web", "UrlOpen"):
                 if config.getboolean("Web", "UrlOpen"):
                     from chatutils.web_engines import URLOpen
                     self.urlopener = URLOpen()
                     self.url_summary = config.getboolean("Web", "URLSummary") if config.has_option("Web", "URLSummary") else False
                     logger.debug(f'URL opener is enabled, URL summary is set to {self.url_summary}')
-                    self.available_functions["url_opener"] = self.urlopener.open_url
-                    self.function_calling_tools.append(tools_config.url_opener)
+                    self.tools.register("url_opener", self.tool_url_opener, tools_config.url_opener)
+            # search and reading of top results in one tool call
+            if self.webengine is not None and config.has_option("Web", "Research") and config.getboolean("Web", "Research"):
+                from chatutils.web_engines import URLOpen, WebResearch
+                self.webresearch = WebResearch(self.webengine, self.urlopener if self.urlopener is not None else URLOpen())
+                logger.debug(f'Web research is enabled')
+                self.tools.register("web_research", self.tool_web_research, tools_config.web_research)
+        self.function_calling_tools = self.tools.schemas()
+
+    async def tool_generate_image(self, args, context):
+        '''
+        Tool: generate image (image is sent to user as the answer)
+        '''
+        async with self.schedulers["image"].slot(context["id"]):
+            image, text = await self.image_engine.generate_image(
+                prompt = args.get("prompt"),
+                image_orientation = args.get("image_orientation"),
+                image_style = args.get("image_style"),
+                id = context["id"],
+            )
+        if image is not None:
+            await self.add_stats(id=context["id"], images_generated=1)
+            return {"content": f"Image was generated from the prompt: {args.get('prompt')} (Revised prompt: {text})", "image": (image, text)}
+        if text is not None:
+            return {"content": f'Image was not generated. {text}'}
+        logger.error(f'Function was called, but image was not generated')
+        return {"content": 'Image was not generated, something went wrong'}
+
+    async def tool_web_search(self, args, context):
+        '''
+        Tool: search the web
+        '''
+        results = await self.webengine.search(query = args.get("query"))
+        if results is None:
+            return {"content": 'Error while searching the web'}
+        return {"content": f"Web search results for: {args.get('query')}: {results}"}
+
+    async def tool_web_research(self, args, context):
+        '''
+        Tool: search the web and read the top results
+        '''
+        text = await self.webresearch.research(args.get("query"))
+        if text is None:
+            return {"content": 'Error while searching the web'}
+        return {"content": f"Web research for: {args.get('query')}\n{text}"}
+
+    async def tool_url_opener(self, args, context):
+        '''
+        Tool: open URL (content is summarized if URLSummary is set)
+        '''
+        # link from the user message may be opened already
+        content = await self.urlopener.open_prefetched(args.get("url"), context.get("prefetch"))
+        tokens = {"prompt": 0, "completion": 0}
+        if content is None:
+            content = 'Error while opening the URL or there was no content'
+        elif self.url_summary:
+            # create summary of the content (only the page is summarized, so the summary is cached for everyone)
+            logger.debug(f'Attempting to summarize the content of the URL ({len(content)})')
+            content, tokens = await self.engine_summary(context["id"], content)
+            if content is None:
+                content = 'Error while summarizing the content of the URL'
+            else:
+                return {"content": f"URL ({args.get('url')}) opened for the user message: {context.get('message')}. Summary of the content: {content}", "tokens": tokens}
+        return {"content": f"URL ({args.get('url')}) opened. Content: {content}", "tokens": tokens}
 
     def load_image_generation(self):
         '''
@@ -173,7 +348,7 @@ class ChatProc:
                         base_url = None
                     if base_url == 'None':
                         base_url = None
-                    self.image_engine = DalleEngine(api_key, base_url)
+                    self.image_engine = DalleEngine(api_key, base_url, persistence=self.persistence)
                 elif config.get("ImageGeneration", "Engine").lower() in ["stability"]:
                     # OpenAI Stability
                     from chatutils.image_engines import StabilityEngine
@@ -183,7 +358,7 @@ class ChatProc:
                     else:
                         logger.error("No API key provided for image generation")
                         raise Exception("No API key provided for image generation")
-                    self.image_engine = StabilityEngine(api_key)
+                    self.image_engine = StabilityEngine(api_key, persistence=self.persistence)
                 elif config.get("ImageGeneration", "Engine").lower() in ["yandex", "yandexart"]:
                     # Yandex Art
                     from chatutils.image_engines import YandexEngine
@@ -193,7 +368,7 @@ class ChatProc:
                     else:
                         logger.error("No API key provided for image generation")
                         raise Exception("No API key provided for image generation")
-                    self.image_engine = YandexEngine(api_key)
+                    self.image_engine = YandexEngine(api_key, persistence=self.persistence)
                 else:
                     logger.error(f"Unknown image generation engine {config.get('ImageGeneration', 'Engine')}")
                     raise Exception(f"Unknown image generation engine {config.get('ImageGeneration', 'Engine')}")
@@ -216,7 +391,7 @@ class ChatProc:
                         base_url = None
                     if base_url == 'None':
                         base_url = None
-                    self.image_engine = DalleEngine(api_key, base_url)
+                    self.image_engine = DalleEngine(api_key, base_url, persistence=self.persistence)
                 else:
                     logger.debug("Image generation is disabled (deprecated) - Parameter is set to False")
             else:
@@ -229,13 +404,14 @@ class ChatProc:
         self.image_generation_quality = self.image_engine.settings["ImageGenerationQuality"]
         self.image_generation_price = self.image_engine.settings["ImageGenerationPrice"]
 
-    async def speech_to_text(self, file_path):
+    async def speech_to_text(self, file_path, id=None):
         try:
             if self.speech_engine is None:
                 return None
             
             logger.debug(f"TranscribeOnly setting in speech_to_text: {self.speech_engine.settings['TranscribeOnly']}")
-            transcript = await self.speech_engine.transcribe(file_path)
+            async with self.schedulers["audio"].slot(id):
+                transcript = await self.speech_engine.transcribe(file_path)
             return transcript
         except Exception as e:
             logger.exception('Could not convert speech to text')
@@ -250,7 +426,7 @@ class ChatProc:
             audio = AudioSegment.from_file(file_path)
             audio_duration = len(audio) / 1000.0  # Duration in seconds
 
-            transcript = await self.speech_to_text(file_path)
+            transcript = await self.speech_to_text(file_path, id=id)
             if transcript is None:
                 logger.error('Could not convert audio/video to text')
                 return 'Sorry, I could not convert your audio/video to text.'
@@ -283,7 +459,7 @@ class ChatProc:
                 return 'Sorry, speech-to-text is not available.'
             # convert voice to text
             if audio_file is not None:
-                transcript = await self.speech_to_text(audio_file)
+                transcript = await self.speech_to_text(audio_file, id=id)
             else:
                 logger.error('No audio file provided for voice chat')
                 return None
@@ -316,8 +492,8 @@ class ChatProc:
                     return False
                 new_chat = True
 
-            messages = self.chats[id]
-            messages.append({
+            # save image to chat history
+            self.chat_store.append(id, {
                 "role": "user", 
                 "content": [
                     {
@@ -330,10 +506,6 @@ class ChatProc:
             })
             # Add flag that there is an image without caption
             self.pending_images[id] = True
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
             return True
         except Exception as e:
             logger.exception('Could not add image to chat for user: ' + str(id))
@@ -365,10 +537,8 @@ class ChatProc:
                 "type": "text",
                 "text": caption,
             })
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save changed message to chat history
+            self.chat_store.update(id, -1)
             return True
         except Exception as e:
             logger.exception('Could not add caption to image for user: ' + str(id))
@@ -392,15 +562,9 @@ class ChatProc:
             # if function calling is enabled, then add information about it
             if self.function_calling:
                 style += '\n# You have function calling (tools) enabled'
-            # get messages if chat exists
-            if id in self.chats:
-                messages = self.chats[id]
-            else:
-                messages = [{"role": "system", "content": style}]
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # create chat history if chat does not exist
+            if id not in self.chats:
+                self.chat_store.save(id, [{"role": "system", "content": style}])
             return True
         except Exception as e:
             logger.exception('Could not init style for user: ' + str(id))
@@ -420,12 +584,8 @@ class ChatProc:
                 if not success:
                     logger.error('Could not init style for user: ' + str(id))
                     return False
-            messages = self.chats[id]
-            messages.append(message)
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save message to chat history
+            self.chat_store.append(id, message)
             return True
         except Exception as e:
             logger.error(f'Could not add message to chat history for user {id}: {e}')
@@ -446,10 +606,8 @@ class ChatProc:
                 if not success:
                     logger.error('Could not init style for user: ' + str(id))
                     return False
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save chat history (only changed messages are written)
+            self.chat_store.save(id, messages)
             logger.debug(f'Chat history for user {id} was saved successfully')
             return True
         except Exception as e:
@@ -463,33 +621,74 @@ class ChatProc:
         '''
         return await self.text_engine.count_tokens(messages)
     
-    async def chat_summary(self, messages):
+    async def chat_summary(self, messages, id=None):
         '''
         Chat with GPT to summarize messages
         Input messages
         '''
-        return await self.text_engine.chat_summary(messages)
+        async with self.schedulers["text"].slot(id, tokens=await self.count_tokens(messages) or 0):
+            return await self.text_engine.chat_summary(messages)
+
+    async def engine_chat(self, id, messages, messages_tokens=None, stream_callback=None, use_tools=True):
+        '''
+        Send messages to the text engine (request waits for its turn in the scheduler)
+        use_tools=False asks the engine to answer with text only (tool rounds are over)
+        Output is the same as in text_engine.chat
+        '''
+        estimate = messages_tokens if messages_tokens is not None else await self.count_tokens(messages)
+        async with self.schedulers["text"].slot(id, tokens=estimate or 0) as ticket:
+            if self.hedger is not None and plain_history(messages):
+                # engines add the answer to the list of messages, so each of them gets a copy
+                history = messages
+                response, messages, token_usage = await self.hedger.run(
+                    lambda callback: self.text_engine.chat(id=id, messages=list(history), messages_tokens=messages_tokens, stream_callback=callback),
+                    lambda callback: self.hedger.secondary.chat(id=id, messages=list(history), stream_callback=callback),
+                    stream_callback=stream_callback,
+                    prompt_estimate=estimate or 0,
+                    )
+                if messages is None:
+                    messages = history[:-1]
+            else:
+                kwargs = {} if use_tools else {"use_tools": False}
+                response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages, messages_tokens=messages_tokens, stream_callback=stream_callback, **kwargs)
+            if token_usage is not None:
+                # cache reads do not count towards rate limits, cache writes do
+                ticket.used(int(token_usage['prompt']) + int(token_usage['completion']) + int(token_usage.get('cache_write', 0)))
+        return response, messages, token_usage
+
+    async def engine_summary(self, id, text, size=None):
+        '''
+        Summarize text with the text engine (request waits for its turn in the scheduler)
+        '''
+        kwargs = {"size": size} if size is not None else {}
+        # rough estimate, text is not encoded just for scheduling
+        async with self.schedulers["text"].slot(id, tokens=len(str(text)) // 4 + (size or 0)):
+            return await self.text_engine.summary(text, **kwargs)
 
-    async def trim_messages(self, messages, trim_count=1):
+    async def trim_messages(self, messages):
         '''
-        Trim messages (delete first trim_count messages)
+        Trim messages to fit into the token budget (see HistoryTrimmer)
+        Whole user turns are dropped from the beginning of the chat
         Do not trim system message (role == 'system', id == 0)
+        Output: trimmed messages and number of tokens in them
         '''
         try:
             if messages is None or len(messages) <= 1:
                 logger.warning('Could not trim messages')
-                return None
-            system_message = messages[0] if messages[0]['role'] == 'system' else {"role": "system", "content": self.system_message}
-            messages = messages[1:] if messages[0]['role'] == 'system' else messages
-            logger.debug(f'Deleting messages: {messages[:trim_count]}')
-            messages = messages[trim_count:]
-            messages.insert(0, system_message)
-            return messages
+                return None, None
+            costs = await self.text_engine.count_message_tokens(messages)
+            if costs is None:
+                return None, None
+            system_message = {"role": "system", "content": self.system_message}
+            system_tokens = 0
+            if messages[0]['role'] != 'system':
+                system_tokens = await self.count_tokens([system_message])
+            return self.history_trimmer.trim(messages, costs, system_message=system_message, system_tokens=system_tokens)
         except Exception as e:
             logger.error(f'Could not trim messages: {e}')
-            return None
+            return None, None
         
-    async def summarize_messages(self, messages, leave_messages=2):
+    async def summarize_messages(self, messages, leave_messages=2, id=None):
         '''
         Summarize messages (leave only last leave_messages messages)
         Do not summarize system message (role == 'system', id == 0)
@@ -503,7 +702,7 @@ class ChatProc:
             logger.debug(f'Summarizing {len(messages)} messages, leaving only {len(last_messages)} last messages')
             messages = messages[1:-leave_messages] if messages[0]['role'] == 'system' else messages[:-leave_messages]
             # summarize messages
-            summary, token_usage = await self.chat_summary(messages)
+            summary, token_usage = await self.chat_summary(messages, id=id)
             messages = []
             messages.append(system_message)
             messages.append({
@@ -518,16 +717,22 @@ class ChatProc:
             logger.error(f'Could not summarize messages: {e}')
             return None, {"prompt": 0, "completion": 0}
 
-    async def chat(self, id=0, message="Hi! Who are you?", style=None):
+    async def chat(self, id=0, message="Hi! Who are you?", style=None, stream_callback=None):
         '''
         Chat with GPT
         Input:
             * id - id of user
             * message - message to chat with GPT
             * style - style of chat (default: None)
+            * stream_callback - async function that gets pieces of the answer while it is generated (default: None)
+              Final answer is still returned, statistics and history are saved once at the end
         '''
+        # links from the message are opened while the first answer is generated
+        prefetch = {}
         try:
             prompt_tokens, completion_tokens = 0, 0
+            # cached prompt tokens and tokens used by the secondary engine of hedged requests
+            extra_tokens = {"cache_read": 0, "cache_write": 0, "hedge_prompt": 0, "hedge_completion": 0}
             # Init style if it is not set
             if id not in self.chats:
                 success = await self.init_style(id=id, style=style)
@@ -550,175 +755,77 @@ class ChatProc:
                 messages_tokens = 0
             if messages_tokens > self.max_tokens:
                 if not self.summarize_too_long:
-                    while await self.count_tokens(messages) > int(self.max_tokens*0.8):
-                        messages = await self.trim_messages(messages)
+                    messages, messages_tokens = await self.trim_messages(messages)
                 else:
-                    messages, token_usage = await self.summarize_messages(messages)
+                    messages, token_usage = await self.summarize_messages(messages, id=id)
                     prompt_tokens += int(token_usage['prompt'])
                     completion_tokens += int(token_usage['completion'])
+                    messages_tokens = None
                 if messages is None:
                     return 'There was an error due to a long conversation. Please, contact the administrator or /delete your chat history.'
 
+            if self.function_calling and getattr(self, 'urlopener', None) is not None and "url_opener" in self.tools:
+                prefetch = self.urlopener.prefetch(message)
             # Wait for response
-            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
+            response, messages, token_usage = await self.engine_chat(id=id, messages=messages, messages_tokens=messages_tokens, stream_callback=stream_callback)
             # add statistics
             if token_usage is not None:
                 prompt_tokens += int(token_usage['prompt'])
                 completion_tokens += int(token_usage['completion'])
-            # TODO: check if function was called
-            if self.function_calling:
-                if type(response) == tuple:
-                    if response[0] == 'function':
-                        function_name, function_args = response[1], response[2]
-                        corresponding_text, tool_id = response[4], response[5]
-                        logger.debug(f'Function was called: "{function_name}" with arguments: "{function_args}". Corresponding text: "{corresponding_text}". Tool ID: {tool_id}')
-                        if response[1] == 'generate_image':
-                            # call function to generate image
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                prompt = function_args.get("prompt"),
-                                image_orientation = function_args.get("image_orientation"),
-                                image_style = function_args.get("image_style"),
-                            )
-                            image, text = function_response[0], function_response[1]
-                            if image is not None:
-                                # add to chat history
-                                if type(self.text_engine) == AnthropicEngine:
-                                    # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                    # assistant:
-                                    message_content = []
-                                    if corresponding_text is not None:
-                                        if len(corresponding_text) > 0:
-                                            message_content.append({"type": "text", "text": corresponding_text})
-                                    message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "assistant", "content": message_content})
-                                    # user (function response)
-                                    message_content = [{
-                                        "type": "tool_result",
-                                        "tool_use_id": tool_id,
-                                        "content": f"Image was generated from the prompt: {function_args.get('prompt')} (Revised prompt: {text})",
-                                    }]
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "user", "content": message_content})  
-                                else:
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "function", "name": function_name, "content": str(text)})
-                                # add statistics
-                                await self.add_stats(id=id, images_generated=1)
-                                response = ('image', image, text)
-                            elif image is None and text is not None:
-                                response = f'Image was not generated. {text}'
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": response})
-                            else:
-                                response = 'Sorry, something went wrong.'
-                                logger.error(f'Function was called, but image was not generated: {response}')
-                        elif response[1] == 'web_search':
-                            # call function to search the web
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                query = function_args.get("query"),
-                            )
-                            if function_response is None:
-                                function_response = 'Error while searching the web'
-                            if type(self.text_engine) == AnthropicEngine:
-                                # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                # assistant:
-                                message_content = []
-                                if corresponding_text is not None:
-                                    if len(corresponding_text) > 0:
-                                        message_content.append({"type": "text", "text": corresponding_text})
-                                message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": message_content})
-                                # user (function response)
-                                message_content = [{
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_id,
-                                    "content": f"Web search results for: {function_args.get('query')}: {function_response}",
-                                }]
-                                await self.add_to_chat_history(id=id,
-                                    message={"role": "user", "content": message_content})
-                            else:
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "function", "name": function_name, "content": str(function_response)})
-                            # Push response to LLM again
-                            messages = self.chats[id]
-                            logger.debug(f'Pushing response to LLM again')
-                            logger.debug(f'messages: {messages}')
-                            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
-                            # add statistics
-                            if token_usage is not None:
-                                prompt_tokens += int(token_usage['prompt'])
-                                completion_tokens += int(token_usage['completion'])
-                            if response is None:
-                                response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
-                            else:
-                                await self.save_chat(id=id, messages=messages)
-                        elif response[1] == 'url_opener':
-                            # call function to open URL
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                url = function_args.get("url"),
-                            )
-                            if function_response is None:
-                                function_response = 'Error while opening the URL or there was no content'
-                            elif self.url_summary:
-                                # create summary of the content
-                                logger.debug(f'Attempting to summarize the content of the URL ({len(function_response)})')
-                                function_response, token_usage = await self.text_engine.summary(f'User message: {message}. Text from URL: {function_response}')
-                                if function_response is None:
-                                    function_response = 'Error while summarizing the content of the URL'
-                                else:
-                                    prompt_tokens += int(token_usage['prompt'])
-                                    completion_tokens += int(token_usage['completion'])
-                            else:
-                                pass
-                            if type(self.text_engine) == AnthropicEngine:
-                                # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                # assistant:
-                                message_content = []
-                                if corresponding_text is not None:
-                                    if len(corresponding_text) > 0:
-                                        message_content.append({"type": "text", "text": corresponding_text})
-                                message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": message_content})
-                                # user (function response)
-                                message_content = [{
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_id,
-                                    "content": f"URL ({function_args.get('url')}) opened. Content: {function_response}",
-                                }]
-                                await self.add_to_chat_history(id=id,
-                                    message={"role": "user", "content": message_content})
-                            else:
-                                await self.add_to_chat_history(
-                                    id=id, 
-                                    message={"role": "function", "name": function_name, "content": f"URL content: {function_response}"}
-                                    )
-                            # Push response to LLM again
-                            messages = self.chats[id]
-                            logger.debug(f'Pushing response of URL opener to LLM again: {function_response}')
-                            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
-                            # add statistics
-                            if token_usage is not None:
-                                prompt_tokens += int(token_usage['prompt'])
-                                completion_tokens += int(token_usage['completion'])
-                            if response is None:
-                                response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
-                            else:
-                                await self.save_chat(id=id, messages=messages)
-            else:
+                for key in extra_tokens:
+                    extra_tokens[key] += int(token_usage.get(key, 0))
+            if type(response) != tuple or response[0] != 'function':
                 # save chat history
                 await self.save_chat(id=id, messages=messages)
+            # all tool calls of the answer are run at once and their results are sent back in one request,
+            # after MaxRounds rounds the model has to answer without tools
+            rounds = 0
+            while self.function_calling and type(response) == tuple and response[0] == 'function':
+                if rounds >= self.tools_max_rounds:
+                    # model asked for tools although it should not (calls are not added to history)
+                    logger.warning(f'Tools were called after {rounds} rounds, answer is not received')
+                    response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
+                    break
+                rounds += 1
+                calls, corresponding_text = response[1], response[3]
+                logger.debug(f'Functions were called (round {rounds}): {calls}. Corresponding text: "{corresponding_text}"')
+                results = await self.tools.run(calls, context={"id": id, "message": message, "prefetch": prefetch})
+                for result in results:
+                    if result.get("tokens") is not None:
+                        prompt_tokens += int(result["tokens"]['prompt'])
+                        completion_tokens += int(result["tokens"]['completion'])
+                for tool_message in self.text_engine.tool_messages(calls, corresponding_text, results):
+                    await self.add_to_chat_history(id=id, message=tool_message)
+                images = [result["image"] for result in results if result.get("image") is not None]
+                if len(images) > 0:
+                    # generated image is the answer
+                    response = ('image', images[0][0], images[0][1])
+                    break
+                # Push results to LLM again
+                messages = self.chats[id]
+                logger.debug(f'Pushing results of {len(calls)} tool calls to LLM again')
+                response, messages, token_usage = await self.engine_chat(id=id, messages=messages, stream_callback=stream_callback, use_tools=rounds < self.tools_max_rounds)
+                # add statistics
+                if token_usage is not None:
+                    prompt_tokens += int(token_usage['prompt'])
+                    completion_tokens += int(token_usage['completion'])
+                    for key in extra_tokens:
+                        extra_tokens[key] += int(token_usage.get(key, 0))
+                if response is None:
+                    response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
+                elif type(response) != tuple:
+                    await self.save_chat(id=id, messages=messages)
             # add statistics
-            await self.add_stats(id=id, prompt_tokens_used=prompt_tokens, completion_tokens_used=completion_tokens)
+            await self.add_stats(id=id, prompt_tokens_used=prompt_tokens, completion_tokens_used=completion_tokens,
+                cache_read_tokens_used=extra_tokens['cache_read'], cache_write_tokens_used=extra_tokens['cache_write'],
+                hedge_prompt_tokens_used=extra_tokens['hedge_prompt'], hedge_completion_tokens_used=extra_tokens['hedge_completion'])
             return response
         except Exception as e:
             logger.exception('Could not get answer to message: ' + message + ' from user: ' + str(id))
             return 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
+        finally:
+            if len(prefetch) > 0:
+                self.urlopener.cancel_prefetch(prefetch)
         
     async def imagine(self, id=0, prompt=None, add_to_chat=True):
         '''
@@ -743,7 +850,8 @@ class ChatProc:
             if '--revision' in prompt:
                 prompt = prompt.replace('--revision', '')
                 revision = True
-            image, text = await self.image_engine.imagine(prompt=prompt, id=0, revision=True)
+            async with self.schedulers["image"].slot(id):
+                image, text = await self.image_engine.imagine(prompt=prompt, id=id, revision=True)
             if image is not None:
                 # add statistics
                 await self.add_stats(id=id, images_generated=1)
@@ -780,7 +888,7 @@ class ChatProc:
             logger.debug(f'Could not load file: {filepath}. Created new file.')
             return payload
         
-    async def add_stats(self, id=None, speech2text_seconds=None, messages_sent=None, voice_messages_sent=None, prompt_tokens_used=None, completion_tokens_used=None, images_generated=None):
+    async def add_stats(self, id=None, speech2text_seconds=None, messages_sent=None, voice_messages_sent=None, prompt_tokens_used=None, completion_tokens_used=None, images_generated=None, hedge_prompt_tokens_used=None, hedge_completion_tokens_used=None, cache_read_tokens_used=None, cache_write_tokens_used=None):
         '''
         Add statistics (tokens used, messages sent, voice messages sent) by user
         Input:
@@ -791,13 +899,17 @@ class ChatProc:
             * prompt_tokens_used - tokens used for prompt
             * completion_tokens_used - tokens used for completion
             * images_generated - images generated
+            * hedge_prompt_tokens_used - prompt tokens used by the secondary engine of hedged requests
+            * hedge_completion_tokens_used - completion tokens used by the secondary engine of hedged requests
+            * cache_read_tokens_used - prompt tokens read from the provider cache
+            * cache_write_tokens_used - prompt tokens written to the provider cache
         '''
         try:
             if id is None:
                 logger.debug('Could not add stats. No ID provided')
                 return None
             if id not in self.stats:
-                self.stats[id] = {'Tokens used': 0, 'Speech to text seconds': 0, 'Messages sent': 0, 'Voice messages sent': 0, 'Prompt tokens used': 0, 'Completion tokens used': 0, 'Images generated': 0}
+                self.stats[id] = {'Tokens used': 0, 'Speech to text seconds': 0, 'Messages sent': 0, 'Voice messages sent': 0, 'Prompt tokens used': 0, 'Completion tokens used': 0, 'Images generated': 0, 'Hedged prompt tokens used': 0, 'Hedged completion tokens used': 0, 'Cache read tokens': 0, 'Cache write tokens': 0}
             self.stats[id]['Messages sent'] += messages_sent if messages_sent is not None else 0
             if self.speech_engine:
                 self.stats[id]['Speech to text seconds'] += round(speech2text_seconds) if speech2text_seconds is not None else 0
@@ -806,8 +918,14 @@ class ChatProc:
             self.stats[id]['Completion tokens used'] += completion_tokens_used if completion_tokens_used is not None else 0
             if self.image_generation:
                 self.stats[id]['Images generated'] += images_generated if images_generated is not None else 0
-            # save statistics to file (unsafe way)
-            pickle.dump(self.stats, open(self.stats_location, "wb"))
+            if self.hedger is not None:
+                self.stats[id]['Hedged prompt tokens used'] += hedge_prompt_tokens_used if hedge_prompt_tokens_used is not None else 0
+                self.stats[id]['Hedged completion tokens used'] += hedge_completion_tokens_used if hedge_completion_tokens_used is not None else 0
+            if self.prompt_caching:
+                self.stats[id]['Cache read tokens'] += cache_read_tokens_used if cache_read_tokens_used is not None else 0
+                self.stats[id]['Cache write tokens'] += cache_write_tokens_used if cache_write_tokens_used is not None else 0
+            # statistics will be saved to file in background
+            self.persistence.mark_dirty('stats')
         except KeyError as e:
             logger.error('Could not add statistics for user: ' + str(id))
             # add key to stats and try again
@@ -815,10 +933,7 @@ class ChatProc:
             key_missing = str(e).split('\'')[1]
             current_stats[key_missing] = 0
             self.stats[id] = current_stats
-            try:
-                pickle.dump(self.stats, open(self.stats_location, "wb"))
-            except Exception as e:
-                logger.error('Could not add statistics for user after adding keys: ' + str(id))
+            self.persistence.mark_dirty('stats')
         except Exception as e:
             logger.error('Could not add statistics for user: ' + str(id))
 
@@ -845,6 +960,15 @@ class ChatProc:
                     if self.speech_engine is None:
                         if key in ['Speech to text seconds', 'Voice messages sent']:
                             continue
+                    if self.hedger is None:
+                        if key in ['Hedged prompt tokens used', 'Hedged completion tokens used']:
+                            continue
+                    if not self.prompt_caching:
+                        if key in ['Cache read tokens', 'Cache write tokens']:
+                            continue
+                    elif self.text_engine.cache_write_price is None:
+                        if key == 'Cache write tokens':
+                            continue
                     statisitics += key + ': ' + str(value) + '\n'
                 if self.speech_engine:
                     cost += self.stats[id]['Speech to text seconds'] / 60 * self.s2t_model_price
@@ -852,6 +976,12 @@ class ChatProc:
                 cost += self.stats[id]['Completion tokens used'] / 1000 * self.model_completion_price
                 if self.image_generation:
                     cost += self.stats[id]['Images generated'] * self.image_generation_price
+                if self.prompt_caching:
+                    cost += self.stats[id]['Cache read tokens'] / 1000 * self.text_engine.cache_read_price
+                    cost += self.stats[id]['Cache write tokens'] / 1000 * (self.text_engine.cache_write_price or 0)
+                if self.hedger is not None:
+                    cost += self.stats[id]['Hedged prompt tokens used'] / 1000 * self.hedger.secondary.model_prompt_price
+                    cost += self.stats[id]['Hedged completion tokens used'] / 1000 * self.hedger.secondary.model_completion_price
                 statisitics += '\nAppoximate cost of usage is $' + str(round(cost, 2))
                 return statisitics
             return None
@@ -862,10 +992,7 @@ class ChatProc:
             key_missing = str(e).split('\'')[1]
             current_stats[key_missing] = 0
             self.stats[id] = current_stats
-            try:
-                pickle.dump(self.stats, open(self.stats_location, "wb"))
-            except Exception as e:
-                logger.error(f'Could not get statistics for user {id} after adding keys: {e}')
+            self.persistence.mark_dirty('stats')
             if counter > 6:
                 return 'There was an error while getting statistics. Please, try again.'
             return await self.get_stats(id=id, counter=counter+1) # recursive call
@@ -915,8 +1042,7 @@ class ChatProc:
                 return False
             if self.log_chats:
                 await self.dump_chat(id=id, plain=True)
-            del self.chats[id]
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            self.chat_store.delete(id)
             return True
         except Exception as e:
             logger.exception('Could not delete chat history for user: ' + str(id))
@@ -954,8 +1080,7 @@ class ChatProc:
             sessions = pickle.load(open("./data/chats/" + str(id) + ".pickle", "rb"))
             messages = sessions[chatname]
             # overwrite chat history
-            self.chats[id] = messages
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            self.chat_store.save(id, messages)
             return True
         except Exception as e:
             logger.exception('Could not load session for user: ' + str(id))
@@ -994,15 +1119,14 @@ class ChatProc:
                 messages = self.chats[id]
             else:
                 messages = [{"role": "system", "content": style}]
-            # change style
-            if messages[0]['role'] == 'system':
+            # change style and save chat history
+            if messages[0]['role'] == 'system' and id in self.chats:
                 messages[0]['content'] = style 
+                self.chat_store.update(id, 0)
+            elif messages[0]['role'] == 'system':
+                self.chat_store.save(id, messages)
             else:
-                messages.insert(0, {"role": "system", "content": style})
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+                self.chat_store.save(id, [{"role": "system", "content": style}] + messages)
             return True
         except Exception as e:
             logger.exception('Could not change style for user: ' + str(id))
@@ -1018,29 +1142,30 @@ class ChatProc:
             # if text length is more than self.max_file_length then return message
             if len(text) > self.max_file_length:
                 return 'Text is too long. Please, send a shorter text.'
-            # if text is than self.max_tokens // 2, then make summary
-            maxlength = round(self.file_summary_tokens) * 4 - 32
-            if len(text) > maxlength:
-                # to do that we split text into chunks with length no more than maxlength and make summary for each chunk
-                # do that until we have summary with length no more than maxlength
-                depth = 0
-                chunklength = self.max_tokens * 4 - 80
-                while len(text) > maxlength:
-                    if depth == sumdepth:
-                        # cut text to maxlength and return
-                        text = text[:maxlength]
-                        break
-                    depth += 1
-                    chunks = [text[i:i+chunklength] for i in range(0, len(text), chunklength)]
-                    text = ''
-                    for chunk in chunks:
-                        text += await self.text_engine.summary(chunk, size=self.file_summary_tokens) + '\n'
+            # if text is longer than self.file_summary_tokens, then make summary
+            encoding = self.text_engine.token_counter.encoding
+            count = lambda text: len(encoding.encode(text, disallowed_special=()))
+            if await asyncio.to_thread(count, text) > self.file_summary_tokens:
+                # chunks are summarized at once, then their summaries are summarized the same way
+                # until the summary fits (at most sumdepth rounds, then text is cut)
+                summarizer = MapReduceSummarizer(
+                    lambda chunk, size: self.engine_summary(id, chunk, size=size),
+                    count,
+                    chunk_tokens=self.file_chunk_tokens,
+                    target_tokens=self.file_summary_tokens,
+                    concurrency=self.file_summary_concurrency,
+                    max_depth=sumdepth,
+                    )
+                text, token_usage = await summarizer.run(text)
+                await self.add_stats(id=id, prompt_tokens_used=token_usage['prompt'], completion_tokens_used=token_usage['completion'])
+                if text is None:
+                    return 'Sorry, I could not summarize the file. Please try again or contact the administrator.'
                 text = '# Summary from recieved file: #\n' + text
             else:
-                # if text is shorter than self.max_tokens // 2, then do not make summary
+                # if text is shorter than self.file_summary_tokens, then do not make summary
                 text = '# Text from recieved file: #\n' + text
             # chat with GPT
-            response = self.chat(id=id, message=text)
+            response = await self.chat(id=id, message=text)
             return response
         except Exception as e:
             logger.exception('Could not process file for user: ' + str(id))
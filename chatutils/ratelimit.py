@@ -0,0 +1,109 @@
+# Description: Rate limiting for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-RateLimit")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import time
+import pickle
+from collections import deque
+
+from chatutils.persistence import pickle_writer
+
+
+class RateLimiter:
+    '''
+    Sliding window rate limiter
+    Keeps a queue of timestamps for every user in memory, old timestamps are dropped
+    from the head of the queue, so every check is O(1) amortized.
+    State is saved to pickle file ({user_id: [timestamps]}) with write-behind persistence,
+    so limits survive restarts.
+    '''
+    def __init__(self, window, location=None, persistence=None, name='ratelimit'):
+        '''
+        Input:
+            * window - time window in seconds
+            * location - pickle file to load and save state (optional)
+            * persistence - WriteBehind instance to save state in background (optional)
+            * name - name of the state for persistence
+        '''
+        self.window = window
+        self.location = location
+        self.persistence = persistence
+        self.name = name
+        self.events = self.load()
+        if self.persistence is not None and self.location is not None:
+            self.persistence.register(self.name, self.snapshot, pickle_writer(self.location))
+        logger.debug(f'Rate limiter "{self.name}" was initialized (window: {self.window}s, users: {len(self.events)})')
+
+    def load(self):
+        '''
+        Load state from pickle file if exists
+        '''
+        events = {}
+        if self.location is None or not os.path.exists(self.location):
+            return events
+        try:
+            with open(self.location, 'rb') as f:
+                payload = pickle.load(f)
+            now = time.time()
+            for user_id, timestamps in payload.items():
+                queue = deque(sorted(t for t in timestamps if t > now - self.window))
+                if len(queue) > 0:
+                    events[user_id] = queue
+        except Exception as e:
+            logger.error(f'Could not load rate limits from {self.location}: {e}')
+        return events
+
+    def snapshot(self):
+        return {user_id: list(queue) for user_id, queue in self.events.items() if len(queue) > 0}
+
+    def prune(self, user_id, now=None):
+        '''
+        Drop timestamps that are out of the window, return queue of user
+        '''
+        now = time.time() if now is None else now
+        queue = self.events.get(user_id)
+        if queue is None:
+            queue = deque()
+            self.events[user_id] = queue
+        edge = now - self.window
+        while len(queue) > 0 and queue[0] <= edge:
+            queue.popleft()
+        return queue
+
+    def hit(self, user_id, limit):
+        '''
+        Register request of user if limit is not exceeded
+        Return True if request is allowed, False if user is rate limited
+        '''
+        now = time.time()
+        queue = self.prune(user_id, now)
+        if len(queue) >= limit:
+            return False
+        queue.append(now)
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self.name)
+        return True
+
+    def usage(self, user_id):
+        '''
+        Number of requests of user in the current window
+        '''
+        return len(self.prune(user_id))
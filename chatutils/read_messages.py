@@ -1,6 +1,12 @@
 import pickle
+import sqlite3
+import json
 
-chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
+chats = {}
+db = sqlite3.connect('../data/tech/chats.db')
+for userid, body in db.execute('SELECT user_id, body FROM messages ORDER BY user_id, seq'):
+    chats.setdefault(json.loads(userid), []).append(json.loads(body))
+db.close()
 
 print('\n')
 
@@ -0,0 +1,177 @@
+# Description: Access registry (whitelist, banlist, rates and chat modes) for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Registry")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import time
+import codecs
+
+
+class WatchedFile:
+    '''
+    File that is parsed once and reloaded only when it was changed (mtime or size)
+    File is checked not more often than every check_interval seconds
+    '''
+    def __init__(self, path, loader, default=None, check_interval=1.0):
+        self.path = path
+        self.loader = loader
+        self.default = default
+        self.check_interval = check_interval
+        self.signature = None
+        self.last_check = 0
+        self.value = default
+        self.reload()
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def reload(self):
+        '''
+        Load file (default value is used if file does not exist or could not be parsed)
+        '''
+        self.last_check = time.monotonic()
+        self.signature = self.stat()
+        if self.signature is None:
+            self.value = self.default() if callable(self.default) else self.default
+            return self.value
+        try:
+            self.value = self.loader(self.path)
+            logger.debug(f'File {self.path} was loaded')
+        except Exception as e:
+            logger.exception(f'Could not load file: {self.path}')
+            self.value = self.default() if callable(self.default) else self.default
+        return self.value
+
+    def get(self):
+        '''
+        Get parsed value (reload file if it was changed)
+        '''
+        now = time.monotonic()
+        if now - self.last_check >= self.check_interval:
+            self.last_check = now
+            if self.stat() != self.signature:
+                self.reload()
+        return self.value
+
+    def touch(self):
+        '''
+        Remember current state of the file after it was changed by the bot itself
+        '''
+        self.signature = self.stat()
+
+
+def read_ids(path):
+    '''
+    Read set of user ids (one per line)
+    '''
+    with codecs.open(path, 'r', 'utf-8') as f:
+        return set(line.strip() for line in f if line.strip() != '')
+
+def read_rates(path):
+    '''
+    Read rates from the txt file
+    Example of txt (user_id, number of requests per time stated in config file):
+    123465,100
+    456789,200
+    '''
+    user_rates = {}
+    with codecs.open(path, 'r', 'utf-8') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            user_id, rate = line.split(',')
+            user_rates[int(user_id)] = int(rate)
+    return user_rates
+
+def read_chat_modes(path):
+    '''
+    Read chat modes from a ini file. Returns a dict with the chat mode names as keys and a dict with the description and system message as values.
+    INI example:
+        [Alice]
+        Description = Alice is empathetic and friendly
+        SystemMessage = You are a empathetic and friendly woman named Alice, who answers helpful, funny and a bit flirty.
+    '''
+    chat_modes = configparser.ConfigParser()
+    chat_modes.read(path, encoding='utf-8')
+    modes = {}
+    for mode in chat_modes.sections():
+        modes[mode] = {
+            'Desc': chat_modes[mode]['Description'],
+            'SystemMessage': chat_modes[mode]['SystemMessage']
+        }
+    return modes
+
+
+class AccessRegistry:
+    '''
+    Registry of whitelist, banlist, user rates and chat modes
+    Files are parsed into sets and dicts once and reloaded only when they are changed,
+    so every lookup is O(1). reload() forces reading of all files (e.g. on SIGHUP).
+    '''
+    def __init__(self, whitelist='./data/whitelist.txt', banlist='./data/banlist.txt', rates='./data/rates.txt', chat_modes='./data/chat_modes.ini', check_interval=1.0):
+        self.files = {
+            'whitelist': WatchedFile(whitelist, read_ids, default=set, check_interval=check_interval),
+            'banlist': WatchedFile(banlist, read_ids, default=set, check_interval=check_interval),
+            'rates': WatchedFile(rates, read_rates, default=None, check_interval=check_interval),
+            'chat_modes': WatchedFile(chat_modes, read_chat_modes, default=dict, check_interval=check_interval),
+        }
+        logger.info('Access registry was initialized')
+
+    def reload(self):
+        '''
+        Force reload of all files
+        '''
+        for file in self.files.values():
+            file.reload()
+        logger.info('Access registry was reloaded')
+
+    def is_whitelisted(self, user_id) -> bool:
+        return str(user_id) in self.files['whitelist'].get()
+
+    def is_banned(self, user_id) -> bool:
+        return str(user_id) in self.files['banlist'].get()
+
+    def rates(self):
+        '''
+        Get rates of users ({user_id: limit}) or None if there is no rates file
+        '''
+        return self.files['rates'].get()
+
+    def chat_modes(self):
+        '''
+        Get chat modes ({name: {'Desc': ..., 'SystemMessage': ...}})
+        '''
+        return self.files['chat_modes'].get()
+
+    def add_to_whitelist(self, user_id):
+        '''
+        Add user to whitelist (append to file without re-reading it)
+        '''
+        whitelist = self.files['whitelist']
+        # make sure that changes made by others are not lost
+        whitelist.get()
+        with codecs.open(whitelist.path, "a", "utf-8") as f:
+            f.write(str(user_id)+'\n')
+        whitelist.value.add(str(user_id))
+        whitelist.touch()
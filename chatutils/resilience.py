@@ -0,0 +1,264 @@
+# Description: Retries and circuit breakers for requests to providers for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Resilience")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+
+settings = {
+    "MaxRetries": config.getint("Resilience", "MaxRetries") if config.has_option("Resilience", "MaxRetries") else 3,
+    "BaseDelay": config.getfloat("Resilience", "BaseDelay") if config.has_option("Resilience", "BaseDelay") else 1.0,
+    "MaxDelay": config.getfloat("Resilience", "MaxDelay") if config.has_option("Resilience", "MaxDelay") else 20.0,
+    "FailureThreshold": config.getint("Resilience", "FailureThreshold") if config.has_option("Resilience", "FailureThreshold") else 5,
+    "RecoveryTime": config.getfloat("Resilience", "RecoveryTime") if config.has_option("Resilience", "RecoveryTime") else 30.0,
+    "TrialTimeout": config.getfloat("Resilience", "TrialTimeout") if config.has_option("Resilience", "TrialTimeout") else 120.0,
+}
+
+
+class CircuitOpenError(Exception):
+    '''
+    Provider is considered down, request was not sent
+    '''
+    def __init__(self, name, retry_in):
+        self.name = name
+        self.retry_in = retry_in
+        super().__init__(f'Circuit of "{name}" is open, next attempt in {retry_in:.0f}s')
+
+
+class HTTPStatusError(Exception):
+    '''
+    HTTP response with an error status
+    Response is kept, so it can be processed as usual when retries are over
+    '''
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        super().__init__(f'HTTP {response.status_code}')
+
+
+class TransientHTTPError(HTTPStatusError):
+    '''
+    HTTP response with a status that is worth retrying (429, 5xx)
+    '''
+
+
+class CircuitBreaker:
+    '''
+    Circuit breaker of a provider
+        * closed - requests are sent, consecutive transient failures are counted
+        * open - after FailureThreshold failures requests fail at once for RecoveryTime seconds
+        * half-open - then one trial request is sent, success closes the circuit, failure opens it again
+          (if the trial is cancelled or takes longer than trial_timeout, another trial can be sent)
+    '''
+    def __init__(self, name, failure_threshold=None, recovery_time=None, trial_timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold if failure_threshold is not None else settings["FailureThreshold"]
+        self.recovery_time = recovery_time if recovery_time is not None else settings["RecoveryTime"]
+        self.trial_timeout = trial_timeout if trial_timeout is not None else settings["TrialTimeout"]
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self.trial_started = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def allow(self):
+        '''
+        Check if request can be sent (raises CircuitOpenError if not)
+        '''
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        if self.state == 'open' and now - self.opened_at >= self.recovery_time:
+            self.state = 'half-open'
+            self.trial = False
+            logger.info(f'Circuit of "{self.name}" is half-open')
+        if self.state == 'half-open' and self.trial and now - self.trial_started >= self.trial_timeout:
+            logger.warning(f'Trial request to "{self.name}" did not finish in {self.trial_timeout:g}s, another one is allowed')
+            self.trial = False
+        if self.state == 'half-open' and not self.trial:
+            self.trial = True
+            self.trial_started = now
+            return True
+        self.total_rejected += 1
+        if self.state == 'half-open':
+            raise CircuitOpenError(self.name, max(self.trial_timeout - (now - self.trial_started), 0))
+        raise CircuitOpenError(self.name, max(self.recovery_time - (now - self.opened_at), 0))
+
+    def ready(self, now):
+        '''
+        Check if allow() would let a request through (without taking the trial)
+        '''
+        if self.state == 'open':
+            return now - self.opened_at >= self.recovery_time
+        if self.state == 'half-open':
+            return not self.trial or now - self.trial_started >= self.trial_timeout
+        return True
+
+    def release(self, started):
+        '''
+        Trial request (started at `started`) was cancelled, its result is unknown, so the next request can be a trial
+        '''
+        if self.state == 'half-open' and self.trial and self.trial_started == started:
+            self.trial = False
+
+    def success(self):
+        if self.state != 'closed':
+            logger.info(f'Circuit of "{self.name}" is closed')
+        self.state = 'closed'
+        self.failures = 0
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        if self.state == 'half-open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f'Circuit of "{self.name}" is open after {self.failures} failures')
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+    def get_state(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "total_rejected": self.total_rejected,
+            "open_for": round(time.monotonic() - self.opened_at) if self.state != 'closed' else 0,
+        }
+
+
+breakers = {}
+
+def get_breaker(name):
+    '''
+    Get circuit breaker of provider (one per provider for the whole process)
+    '''
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+def get_breakers_state():
+    '''
+    State of all circuit breakers ({name: {...}})
+    '''
+    return {name: breaker.get_state() for name, breaker in breakers.items()}
+
+
+def status_code(error):
+    code = getattr(error, 'status_code', None)
+    if code is None:
+        code = getattr(getattr(error, 'response', None), 'status_code', None)
+    if code is None:
+        code = getattr(error, 'status', None)
+    return code if type(code) == int else None
+
+def is_transient(error):
+    '''
+    Check if error is worth retrying: rate limits, server errors, timeouts and connection problems
+    Works with errors of OpenAI and Anthropic SDKs, httpx and aiohttp
+    '''
+    if isinstance(error, CircuitOpenError):
+        return False
+    code = status_code(error)
+    if code is not None:
+        return code in [408, 409, 429] or code >= 500
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__
+    return 'Timeout' in name or 'Connection' in name or 'ServerDisconnected' in name
+
+def retry_after(error):
+    '''
+    Delay requested by provider (Retry-After or retry-after-ms headers) in seconds or None
+    '''
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+def backoff(attempt, base_delay=None, max_delay=None):
+    '''
+    Exponential backoff with full jitter
+    '''
+    base_delay = base_delay if base_delay is not None else settings["BaseDelay"]
+    max_delay = max_delay if max_delay is not None else settings["MaxDelay"]
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+async def with_retries(func, name, retry_if=None, max_retries=None):
+    '''
+    Call provider with retries
+    Input:
+        * func - coroutine function without arguments that sends the request
+        * name - name of provider (circuit breaker)
+        * retry_if - additional check if error can be retried (e.g. nothing was streamed yet)
+        * max_retries - number of retries (Resilience.MaxRetries by default)
+    Transient errors are retried with exponential backoff and jitter (or as long as Retry-After says),
+    other errors are raised at once. CircuitOpenError is raised if provider is down.
+    '''
+    breaker = get_breaker(name)
+    max_retries = max_retries if max_retries is not None else settings["MaxRetries"]
+    attempt = 0
+    while True:
+        breaker.allow()
+        # allow() lets only the trial request through a half-open circuit
+        trial = breaker.trial_started if breaker.state == 'half-open' else None
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            if trial is not None:
+                breaker.release(trial)
+            raise
+        except Exception as e:
+            if not is_transient(e):
+                # provider is up, request itself is wrong
+                breaker.success()
+                raise
+            breaker.failure()
+            if attempt >= max_retries or (retry_if is not None and not retry_if(e)) or breaker.state == 'open':
+                raise
+            delay = retry_after(e)
+            if delay is None:
+                delay = backoff(attempt)
+            elif delay > settings["MaxDelay"]:
+                # provider asks to wait too long, user should not wait for it
+                raise
+            attempt += 1
+            logger.warning(f'Request to "{name}" failed ({type(e).__name__}: {e}), retry {attempt}/{max_retries} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            continue
+        breaker.success()
+        return result
@@ -0,0 +1,287 @@
+# Description: Scheduler of requests to providers (LLM, images, audio) for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Scheduler")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import re
+import time
+import asyncio
+from datetime import datetime
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+
+
+def parse_reset(value):
+    '''
+    Parse reset time from rate limit headers, returns seconds from now or None
+    OpenAI: "1s", "6m0s", "20ms", "1h2m3.5s"
+    Anthropic: RFC 3339 timestamp ("2024-05-01T12:00:30Z")
+    '''
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if len(parts) > 0 and ''.join(number + unit for number, unit in parts) == value:
+        multipliers = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        return sum(float(number) * multipliers[unit] for number, unit in parts)
+    try:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(reset_at.timestamp() - time.time(), 0)
+    except ValueError:
+        return None
+
+
+class Window:
+    '''
+    Sliding one-minute window of used requests or tokens
+    Limit 0 means unlimited. Limit and remaining quota can be updated from response headers.
+    '''
+    def __init__(self, limit=0, period=60.0):
+        self.limit = limit
+        self.period = period
+        self.events = deque()
+        self.used = 0
+        # provider reported that quota is exhausted until this moment (monotonic time)
+        self.blocked_until = 0
+
+    def prune(self, now):
+        while len(self.events) > 0 and self.events[0][0] <= now - self.period:
+            self.used -= self.events.popleft()[1]
+
+    def wait_time(self, now, amount):
+        '''
+        Seconds to wait until amount can be used (0 if it can be used now)
+        '''
+        wait = max(self.blocked_until - now, 0)
+        if self.limit <= 0:
+            return wait
+        self.prune(now)
+        # request that is bigger than the whole limit waits for an empty window
+        amount = min(amount, self.limit)
+        if self.used + amount <= self.limit:
+            return wait
+        # find the moment when enough old events leave the window
+        used = self.used
+        for event in self.events:
+            used -= event[1]
+            if used + amount <= self.limit:
+                return max(wait, event[0] + self.period - now)
+        return max(wait, self.period)
+
+    def add(self, now, amount):
+        event = [now, amount]
+        self.events.append(event)
+        self.used += amount
+        return event
+
+    def correct(self, event, amount):
+        '''
+        Replace estimated amount with the real one
+        '''
+        now = time.monotonic()
+        self.prune(now)
+        if event[0] > now - self.period:
+            self.used += amount - event[1]
+        event[1] = amount
+
+    def update(self, limit=None, remaining=None, reset=None):
+        '''
+        Update window from provider headers
+        '''
+        if limit is not None and limit > 0:
+            self.limit = limit
+        if remaining is not None and remaining <= 0 and reset is not None:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+
+class Ticket:
+    '''
+    Admission to send a request (see RequestScheduler.slot)
+    '''
+    def __init__(self, user_id, tokens):
+        self.user_id = user_id
+        self.tokens = tokens
+        self.future = None
+        self.granted = False
+        self.requests_event = None
+        self.tokens_event = None
+
+    def used(self, tokens):
+        '''
+        Report tokens that were actually used by the request
+        '''
+        self.tokens = tokens
+
+
+class RequestScheduler:
+    '''
+    Admission control in front of a provider
+    Requests wait in per-user queues and are dispatched round-robin between users,
+    so one user with many requests does not delay everyone else. A request is sent only if there is a free concurrency slot and requests-per-minute
+    and tokens-per-minute budgets allow it. Budgets are set in config and updated from
+    rate limit headers of responses (see update_from_headers).
+    '''
+    def __init__(self, name, rpm=0, tpm=0, max_concurrent=8):
+        self.name = name
+        self.requests = Window(rpm)
+        self.tokens = Window(tpm)
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.queues = OrderedDict()
+        self.timer = None
+        logger.info(f'Scheduler "{name}" was initialized (RPM: {rpm or "unlimited"}, TPM: {tpm or "unlimited"}, concurrency: {max_concurrent})')
+
+    def stats(self):
+        '''
+        Current state of the scheduler
+        '''
+        now = time.monotonic()
+        self.requests.prune(now)
+        self.tokens.prune(now)
+        return {
+            "active": self.active,
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "users_waiting": len(self.queues),
+            "requests_last_minute": self.requests.used,
+            "tokens_last_minute": self.tokens.used,
+            "rpm_limit": self.requests.limit,
+            "tpm_limit": self.tokens.limit,
+        }
+
+    @asynccontextmanager
+    async def slot(self, user_id, tokens=0):
+        '''
+        Wait for admission and hold it while the request is running
+        Usage:
+            async with scheduler.slot(user_id, tokens=estimate) as ticket:
+                response = await ...
+                ticket.used(real_tokens)
+        '''
+        ticket = await self.acquire(user_id, tokens)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def acquire(self, user_id, tokens=0):
+        ticket = Ticket(user_id, tokens)
+        ticket.future = asyncio.get_running_loop().create_future()
+        if user_id not in self.queues:
+            self.queues[user_id] = deque()
+        self.queues[user_id].append(ticket)
+        self.dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.granted:
+                self.release(ticket)
+            else:
+                self.remove(ticket)
+            raise
+        return ticket
+
+    def remove(self, ticket):
+        queue = self.queues.get(ticket.user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if len(queue) == 0:
+                del self.queues[ticket.user_id]
+
+    def next_ticket(self):
+        for user_id, queue in self.queues.items():
+            return queue[0]
+        return None
+
+    def pop(self, ticket):
+        queue = self.queues.pop(ticket.user_id)
+        queue.popleft()
+        if len(queue) > 0:
+            # user goes to the end of the line
+            self.queues[ticket.user_id] = queue
+
+    def dispatch(self):
+        '''
+        Admit waiting requests while there are free slots and budget
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.active < self.max_concurrent:
+            ticket = self.next_ticket()
+            if ticket is None:
+                return
+            now = time.monotonic()
+            wait = max(self.requests.wait_time(now, 1), self.tokens.wait_time(now, ticket.tokens))
+            if wait > 0:
+                logger.debug(f'Scheduler "{self.name}": budget is exhausted, next request in {wait:.1f}s')
+                self.timer = asyncio.get_running_loop().call_later(wait, self.dispatch)
+                return
+            self.pop(ticket)
+            self.active += 1
+            ticket.granted = True
+            ticket.requests_event = self.requests.add(now, 1)
+            ticket.tokens_event = self.tokens.add(now, ticket.tokens)
+            ticket.future.set_result(ticket)
+
+    def release(self, ticket):
+        if not ticket.granted:
+            return
+        ticket.granted = False
+        self.active -= 1
+        self.tokens.correct(ticket.tokens_event, ticket.tokens)
+        self.dispatch()
+
+    def update_from_headers(self, headers):
+        '''
+        Update budgets from rate limit headers (OpenAI x-ratelimit-*, Anthropic anthropic-ratelimit-*)
+        '''
+        try:
+            for prefix in ['x-ratelimit-', 'anthropic-ratelimit-']:
+                for kind, window in [('requests', self.requests), ('tokens', self.tokens)]:
+                    if prefix == 'x-ratelimit-':
+                        limit, remaining, reset = f'{prefix}limit-{kind}', f'{prefix}remaining-{kind}', f'{prefix}reset-{kind}'
+                    else:
+                        limit, remaining, reset = f'{prefix}{kind}-limit', f'{prefix}{kind}-remaining', f'{prefix}{kind}-reset'
+                    if remaining not in headers:
+                        continue
+                    window.update(
+                        limit=int(headers[limit]) if limit in headers else None,
+                        remaining=int(headers[remaining]),
+                        reset=parse_reset(headers.get(reset)),
+                        )
+        except Exception as e:
+            logger.debug(f'Could not parse rate limit headers: {e}')
+
+
+def get_schedulers():
+    '''
+    Create schedulers for text, image and audio providers from the [Scheduler] config section
+    '''
+    def get(option, default):
+        return config.getint("Scheduler", option) if config.has_option("Scheduler", option) else default
+    max_concurrent = get("MaxConcurrentRequests", 8)
+    return {
+        "text": RequestScheduler("text", rpm=get("RequestsPerMinute", 0), tpm=get("TokensPerMinute", 0), max_concurrent=max_concurrent),
+        "image": RequestScheduler("image", rpm=get("ImageRequestsPerMinute", 0), max_concurrent=get("MaxConcurrentImageRequests", 2)),
+        "audio": RequestScheduler("audio", rpm=get("AudioRequestsPerMinute", 0), max_concurrent=max_concurrent),
+    }
@@ -0,0 +1,259 @@
+# Description: Chat history storage for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Storage")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import json
+import pickle
+import sqlite3
+import threading
+
+
+class ChatStore:
+    '''
+    Chat history storage
+    Every message is stored as a separate row in SQLite database (WAL mode),
+    so adding a message to the chat is a single small insert instead of
+    rewriting histories of all users.
+    Chats are also kept in memory (self.chats) in the same format as before:
+    {user_id: [{"role": "system", "content": "..."}, ...]}
+    If persistence (WriteBehind) is provided, changes are queued and written
+    to the database in batches from a worker thread, otherwise they are written at once.
+    All changes go through a separate writer connection (one thread at a time), reads in
+    the event loop use their own connection and see only committed data (WAL).
+    '''
+    def __init__(self, location="./data/tech/chats.db", legacy_location="./data/tech/chats.pickle", persistence=None):
+        self.location = location
+        self.legacy_location = legacy_location
+        self.persistence = None
+        self.chats = {}
+        # messages (objects) that are already written to the database for every user
+        self.persisted = {}
+        # queued database operations (if persistence is used)
+        self.ops = []
+        self.failed_ops = []
+        self.writer = sqlite3.connect(self.location, check_same_thread=False)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        self.writer_lock = threading.Lock()
+        with self.writer:
+            self.writer.execute('''CREATE TABLE IF NOT EXISTS messages (
+                                user_id TEXT NOT NULL,
+                                seq INTEGER NOT NULL,
+                                body TEXT NOT NULL,
+                                PRIMARY KEY (user_id, seq)
+                            )''')
+            self.writer.execute('''CREATE TABLE IF NOT EXISTS token_counts (
+                                digest TEXT PRIMARY KEY,
+                                tokens INTEGER NOT NULL
+                            )''')
+            self.writer.execute('''CREATE TABLE IF NOT EXISTS summaries (
+                                digest TEXT PRIMARY KEY,
+                                summary TEXT NOT NULL,
+                                created REAL NOT NULL
+                            )''')
+            self.writer.execute('''CREATE TABLE IF NOT EXISTS image_descriptions (
+                                digest TEXT PRIMARY KEY,
+                                description TEXT NOT NULL,
+                                created REAL NOT NULL
+                            )''')
+        # connection for reads (event loop only)
+        self.db = sqlite3.connect(self.location)
+        self.load()
+        if len(self.chats) == 0:
+            self.import_pickle(self.legacy_location)
+        if persistence is not None:
+            self.persistence = persistence
+            self.persistence.register('chats', self.snapshot, self.execute)
+        logger.info(f'Chat store was initialized ({len(self.chats)} chats loaded)')
+
+    def load(self):
+        '''
+        Load all chats from the database to memory
+        '''
+        self.chats = {}
+        for user_id, body in self.db.execute('SELECT user_id, body FROM messages ORDER BY user_id, seq'):
+            key = json.loads(user_id)
+            if key not in self.chats:
+                self.chats[key] = []
+            self.chats[key].append(json.loads(body))
+        self.persisted = {key: list(messages) for key, messages in self.chats.items()}
+        return self.chats
+
+    def import_pickle(self, filepath):
+        '''
+        Import chats from the old pickle file (./data/tech/chats.pickle)
+        File is renamed after import, so it is imported only once
+        '''
+        if filepath is None or not os.path.exists(filepath):
+            return False
+        try:
+            with open(filepath, 'rb') as f:
+                chats = pickle.load(f)
+            for id, messages in chats.items():
+                self.save(id, messages)
+            os.replace(filepath, filepath + '.imported')
+            logger.info(f'Imported {len(chats)} chats from {filepath}')
+            return True
+        except Exception as e:
+            logger.exception(f'Could not import chats from {filepath}')
+            return False
+
+    def _key(self, id):
+        return json.dumps(id)
+
+    def _insert(self, id, start, messages):
+        rows = [(self._key(id), start + i, json.dumps(message, ensure_ascii=False)) for i, message in enumerate(messages)]
+        return ('INSERT OR REPLACE INTO messages (user_id, seq, body) VALUES (?, ?, ?)', rows)
+
+    def _delete(self, id, start=0):
+        return ('DELETE FROM messages WHERE user_id = ? AND seq >= ?', [(self._key(id), start)])
+
+    def write(self, *ops):
+        '''
+        Write operations to the database (or queue them if persistence is used)
+        Serialization is done here, so queued operations do not depend on later changes of messages
+        '''
+        if self.persistence is None:
+            self.execute(list(ops))
+        else:
+            self.ops.extend(ops)
+            self.persistence.mark_dirty('chats')
+
+    def snapshot(self):
+        '''
+        Take queued operations (called by persistence in the event loop)
+        '''
+        ops, self.ops, self.failed_ops = self.failed_ops + self.ops, [], []
+        return ops
+
+    def execute(self, ops):
+        '''
+        Execute operations in a single transaction (with the writer connection)
+        '''
+        if len(ops) == 0:
+            return
+        try:
+            with self.writer_lock, self.writer:
+                for query, rows in ops:
+                    self.writer.executemany(query, rows)
+        except Exception:
+            self.failed_ops = ops
+            raise
+
+    def append(self, id, message):
+        '''
+        Add message to the end of the chat
+        '''
+        if id not in self.chats:
+            self.chats[id] = []
+        if id not in self.persisted:
+            self.persisted[id] = []
+        self.chats[id].append(message)
+        self.write(self._insert(id, len(self.persisted[id]), [message]))
+        self.persisted[id].append(message)
+
+    def save(self, id, messages):
+        '''
+        Save chat of user
+        Only messages that differ from the stored ones are written:
+        the common head of the chat is kept, the rest is replaced
+        '''
+        persisted = self.persisted.get(id, [])
+        common = 0
+        for old, new in zip(persisted, messages):
+            if old is not new:
+                break
+            common += 1
+        ops = []
+        if common < len(persisted):
+            ops.append(self._delete(id, common))
+        if common < len(messages):
+            ops.append(self._insert(id, common, messages[common:]))
+        self.write(*ops)
+        self.chats[id] = messages
+        self.persisted[id] = list(messages)
+
+    def update(self, id, index):
+        '''
+        Rewrite a single message that was changed in place
+        '''
+        messages = self.chats[id]
+        if index < 0:
+            index += len(messages)
+        self.write(self._insert(id, index, [messages[index]]))
+
+    def delete(self, id):
+        '''
+        Delete chat of user
+        '''
+        self.write(self._delete(id))
+        self.chats.pop(id, None)
+        self.persisted.pop(id, None)
+
+    def load_token_counts(self, limit):
+        '''
+        Load token counts of messages (see TokenCounter), only the latest `limit` counts are kept
+        '''
+        self.write(('DELETE FROM token_counts WHERE rowid NOT IN (SELECT rowid FROM token_counts ORDER BY rowid DESC LIMIT ?)', [(limit,)]))
+        return self.db.execute('SELECT digest, tokens FROM (SELECT rowid, digest, tokens FROM token_counts ORDER BY rowid DESC LIMIT ?) ORDER BY rowid', (limit,)).fetchall()
+
+    def save_token_count(self, digest, tokens):
+        '''
+        Save token count of a message
+        '''
+        self.write(('INSERT OR REPLACE INTO token_counts (digest, tokens) VALUES (?, ?)', [(digest, tokens)]))
+
+    def load_summary(self, digest, since):
+        '''
+        Load cached summary (see SummaryCache) made after `since` (timestamp), None if there is none
+        '''
+        row = self.db.execute('SELECT summary FROM summaries WHERE digest = ? AND created >= ?', (digest, since)).fetchone()
+        return row[0] if row is not None else None
+
+    def save_summary(self, digest, summary, created):
+        '''
+        Save summary of a text
+        '''
+        self.write(('INSERT OR REPLACE INTO summaries (digest, summary, created) VALUES (?, ?, ?)', [(digest, summary, created)]))
+
+    def delete_expired_summaries(self, before):
+        '''
+        Delete summaries made before `before` (timestamp)
+        '''
+        self.write(('DELETE FROM summaries WHERE created < ?', [(before,)]))
+
+    def load_image_description(self, digest):
+        '''
+        Load cached description of an image (see ImageDescriptionCache), None if there is none
+        '''
+        row = self.db.execute('SELECT description FROM image_descriptions WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save_image_description(self, digest, description, created):
+        '''
+        Save description of an image
+        '''
+        self.write(('INSERT OR REPLACE INTO image_descriptions (digest, description, created) VALUES (?, ?, ?)', [(digest, description, created)]))
+
+    def close(self):
+        self.db.close()
+        with self.writer_lock:
+            self.writer.close()
@@ -0,0 +1,133 @@
+# Description: Map-reduce summarization of long texts for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Summarizer")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import re
+import asyncio
+
+SentencePattern = re.compile(r'(?<=[.!?])\s+')
+
+
+def split_units(text, count, max_tokens):
+    '''
+    Split text into pieces of no more than max_tokens: paragraphs, then lines and sentences of long paragraphs,
+    then parts of long sentences (cut by characters in proportion to tokens)
+    Output: list of (piece, tokens)
+    '''
+    units = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if len(paragraph) == 0:
+            continue
+        tokens = count(paragraph)
+        if tokens <= max_tokens:
+            units.append((paragraph, tokens))
+            continue
+        for sentence in SentencePattern.split(paragraph.replace('\n', ' ')):
+            tokens = count(sentence)
+            if tokens <= max_tokens:
+                units.append((sentence, tokens))
+                continue
+            step = max(len(sentence) * max_tokens // tokens, 1)
+            for i in range(0, len(sentence), step):
+                units.append((sentence[i:i + step], count(sentence[i:i + step])))
+    return units
+
+def split_chunks(text, count, max_tokens):
+    '''
+    Split text into chunks of no more than max_tokens (by tokenizer count) on paragraph boundaries
+    Input:
+        * text - text to split
+        * count - function that counts tokens in text
+        * max_tokens - maximum number of tokens in chunk
+    Output: list of chunks
+    '''
+    chunks, current, current_tokens = [], [], 0
+    for unit, tokens in split_units(text, count, max_tokens):
+        # paragraphs are joined with an empty line (about 1 token)
+        if len(current) > 0 and current_tokens + tokens + 1 > max_tokens:
+            chunks.append('\n\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(unit)
+        current_tokens += tokens + 1
+    if len(current) > 0:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+
+class MapReduceSummarizer:
+    '''
+    Summarizes long text with map-reduce
+    Text is split into chunks by tokenizer counts on paragraph boundaries, chunks are summarized
+    concurrently (not more than `concurrency` at a time), then summaries are joined and summarized
+    the same way until the text fits into target_tokens (at most max_depth rounds).
+    '''
+    def __init__(self, summarize, count, chunk_tokens, target_tokens, concurrency=4, max_depth=3):
+        '''
+        Input:
+            * summarize - coroutine function summarize(text, size) that returns summary and token usage
+            * count - function that counts tokens in text
+            * chunk_tokens - maximum number of tokens in a chunk
+            * target_tokens - maximum number of tokens in the result
+            * concurrency - maximum number of chunks summarized at the same time
+            * max_depth - maximum number of rounds, the result is cut to target_tokens after them
+        '''
+        self.summarize = summarize
+        self.count = count
+        self.chunk_tokens = max(chunk_tokens, 1)
+        self.target_tokens = max(target_tokens, 1)
+        self.concurrency = max(concurrency, 1)
+        self.max_depth = max_depth
+
+    async def run(self, text):
+        '''
+        Summarize text
+        Output: summary (None if a chunk could not be summarized) and token usage {"prompt": int, "completion": int}
+        '''
+        usage = {"prompt": 0, "completion": 0}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def summarize(chunk, size):
+            async with semaphore:
+                return await self.summarize(chunk, size)
+
+        depth = 0
+        tokens = await asyncio.to_thread(self.count, text)
+        while tokens > self.target_tokens:
+            if depth == self.max_depth:
+                # cut text to target length (by the share of tokens)
+                text = text[:len(text) * self.target_tokens // tokens]
+                break
+            depth += 1
+            chunks = await asyncio.to_thread(split_chunks, text, self.count, self.chunk_tokens)
+            # summaries of all chunks together should fit into the target
+            size = max(self.target_tokens // len(chunks), min(128, self.target_tokens))
+            logger.debug(f'Summarization round {depth}: {tokens} tokens in {len(chunks)} chunks, summary size: {size}')
+            results = await asyncio.gather(*[summarize(chunk, size) for chunk in chunks])
+            for summary, token_usage in results:
+                if token_usage is not None:
+                    usage["prompt"] += int(token_usage['prompt'])
+                    usage["completion"] += int(token_usage['completion'])
+            if any(summary is None for summary, token_usage in results):
+                logger.error(f'{sum(1 for summary, token_usage in results if summary is None)} of {len(chunks)} chunks were not summarized')
+                return None, usage
+            text = '\n\n'.join(summary for summary, token_usage in results)
+            tokens = await asyncio.to_thread(self.count, text)
+        return text, usage
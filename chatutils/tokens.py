@@ -0,0 +1,70 @@
+# Description: Token counting with memoization for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Tokens")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import hashlib
+from collections import OrderedDict
+
+
+class TokenCounter:
+    '''
+    Memoized token counter
+    Number of tokens is kept for every text (by sha1 digest of encoding name and text),
+    so every message of the chat is encoded only once.
+    Memo is a LRU dict limited by max_size entries. If it is bound to the chat store,
+    counts are loaded on start and new ones are saved together with chats.
+    '''
+    def __init__(self, encoding, max_size=None):
+        self.encoding = encoding
+        self.max_size = max_size if max_size is not None else (config.getint("Persistence", "TokenCacheSize") if config.has_option("Persistence", "TokenCacheSize") else 50000)
+        self.memo = OrderedDict()
+        self.store = None
+
+    def bind(self, store):
+        '''
+        Load persisted counts from the chat store and save new ones there
+        '''
+        try:
+            for digest, tokens in store.load_token_counts(self.max_size):
+                self.memo[digest] = tokens
+            self.store = store
+            logger.debug(f'Loaded {len(self.memo)} token counts from the chat store')
+        except Exception as e:
+            logger.exception('Could not load token counts from the chat store')
+
+    def digest(self, text):
+        return hashlib.sha1(f'{self.encoding.name}\0{text}'.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def count(self, text):
+        '''
+        Count tokens in text (text is encoded only if it was not counted before)
+        '''
+        digest = self.digest(text)
+        tokens = self.memo.get(digest)
+        if tokens is not None:
+            self.memo.move_to_end(digest)
+            return tokens
+        tokens = len(self.encoding.encode(text))
+        self.memo[digest] = tokens
+        if len(self.memo) > self.max_size:
+            self.memo.popitem(last=False)
+        if self.store is not None:
+            self.store.save_token_count(digest, tokens)
+        return tokens
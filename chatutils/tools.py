@@ -0,0 +1,124 @@
+# Description: Registry and concurrent execution of tools (function calling) for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Tools")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import time
+import asyncio
+
+
+def get_tools_settings():
+    '''
+    Settings of the optional [Tools] section
+    '''
+    def get(option, default):
+        return config.getfloat("Tools", option) if config.has_option("Tools", option) else default
+    return {
+        "MaxRounds": int(get("MaxRounds", 3)),
+        "Timeout": get("Timeout", 30),
+        "ImageTimeout": get("ImageTimeout", 120),
+    }
+
+
+class Tool:
+    '''
+    Tool that can be called by the text engine
+    '''
+    def __init__(self, name, handler, schema, timeout):
+        '''
+        Input:
+            * name - name of the tool (as in schema)
+            * handler - coroutine function handler(args, context) that returns result of the tool:
+              {"content": str, "image": (image, text) (optional), "tokens": {"prompt": int, "completion": int} (optional)}
+            * schema - definition of the tool for the text engine (see tools_config)
+            * timeout - maximum time of the call in seconds
+        '''
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.timeout = timeout
+        self.calls = 0
+        self.failures = 0
+
+
+class ToolRegistry:
+    '''
+    Tools available to the text engine
+    All tool calls of one answer are run concurrently (every call has a timeout of its tool),
+    so their results can be sent back to the engine in a single request.
+    Errors and timeouts of tools are returned to the engine as results, they do not break the chat.
+    '''
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.tools = {}
+
+    def register(self, name, handler, schema, timeout=None):
+        self.tools[name] = Tool(name, handler, schema, timeout if timeout is not None else self.timeout)
+        logger.debug(f'Tool "{name}" was registered (timeout: {self.tools[name].timeout}s)')
+
+    def schemas(self):
+        '''
+        Definitions of all tools for the text engine
+        '''
+        return [tool.schema for tool in self.tools.values()]
+
+    def __contains__(self, name):
+        return name in self.tools
+
+    def __len__(self):
+        return len(self.tools)
+
+    async def call(self, call, context):
+        '''
+        Run one tool call ({"id": str, "name": str, "args": dict})
+        '''
+        tool = self.tools.get(call["name"])
+        if tool is None:
+            logger.warning(f'Unknown tool was called: {call["name"]}')
+            return {"content": f'Tool "{call["name"]}" is not available'}
+        if type(call["args"]) != dict:
+            return {"content": f'Invalid arguments of tool "{call["name"]}"'}
+        tool.calls += 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(tool.handler(call["args"], context), timeout=tool.timeout)
+            logger.debug(f'Tool "{tool.name}" answered in {time.monotonic() - started:.2f}s')
+            return result
+        except asyncio.TimeoutError:
+            tool.failures += 1
+            logger.warning(f'Tool "{tool.name}" did not answer in {tool.timeout:g}s')
+            return {"content": f'Tool "{tool.name}" did not answer in time'}
+        except Exception as e:
+            tool.failures += 1
+            logger.exception(f'Tool "{tool.name}" failed')
+            return {"content": f'Error while running tool "{tool.name}"'}
+
+    async def run(self, calls, context=None):
+        '''
+        Run tool calls concurrently
+        Input:
+            * calls - list of tool calls [{"id": str, "name": str, "args": dict}, ...]
+            * context - information about the request for handlers (e.g. {"id": user id, "message": text})
+        Output: results in the same order as calls
+        '''
+        context = context if context is not None else {}
+        return await asyncio.gather(*[self.call(call, context) for call in calls])
+
+    def get_stats(self):
+        return {tool.name: {"calls": tool.calls, "failures": tool.failures} for tool in self.tools.values()}
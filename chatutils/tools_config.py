@@ -65,6 +65,24 @@ class OpenAIConfig:
                         }
                     }
 
+    web_research = {
+                        "type": "function",
+                        "function": {
+                            "name": "web_research",
+                            "description": "Search the web and read the top results at once. Returns search results with the most relevant passages from their pages (use it when the answer needs content of pages, not only links)",
+                            "parameters": {
+                                "type": "object",
+                                "properties": {
+                                    "query": {
+                                        "type": "string",
+                                        "description": "Query for web search"
+                                    }
+                                },
+                                "required": ["query"],
+                            }
+                        }
+                    }
+
 class AnthropicConfig:
     """Rewrite the OpenAIConfig class to AnthropicConfig class"""
     def __init__(self) -> None:
@@ -72,8 +90,10 @@ class AnthropicConfig:
         self.image_generation = OpenAIConfig.image_generation['function']
         self.web_search = OpenAIConfig.web_search['function']
         self.url_opener = OpenAIConfig.url_opener['function']
+        self.web_research = OpenAIConfig.web_research['function']
 
         # rename parameters to input_schema
         self.image_generation['input_schema'] = self.image_generation.pop('parameters')
         self.web_search['input_schema'] = self.web_search.pop('parameters')
         self.url_opener['input_schema'] = self.url_opener.pop('parameters')
+        self.web_research['input_schema'] = self.web_research.pop('parameters')
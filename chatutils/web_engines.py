@@ -20,13 +20,161 @@ handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s -
 logger.addHandler(handler)
 
 import os
+import re
+import math
 import asyncio
 import json
 import time
-import aiohttp
 import urllib.parse
+from email.utils import parsedate_to_datetime
 from bs4 import BeautifulSoup
 
+# lxml is much faster than the built-in parser, but it is optional
+try:
+    import lxml
+    HTMLParser = 'lxml'
+except ImportError:
+    HTMLParser = 'html.parser'
+
+from chatutils.cache import TTLCache, SingleFlight
+from chatutils.http_client import get_web_client
+
+# links in user messages (trailing punctuation is not a part of the link)
+URLPattern = re.compile(r'https?://[^\s<>"\'`]+')
+
+def find_urls(text):
+    '''
+    Find links in text (in order of appearance, without duplicates)
+    '''
+    urls = []
+    for url in URLPattern.findall(str(text)):
+        url = url.rstrip('.,;:!?)]}\'"')
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+# query parameters that do not change the page
+TrackingParams = ('utm_', 'fbclid', 'gclid', 'yclid', 'mc_cid', 'mc_eid')
+
+def normalize_url(url):
+    '''
+    Normalize URL for caching: lowercase scheme and host, no default port, fragment and tracking parameters,
+    sorted query parameters
+    '''
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port is not None and (scheme, parts.port) not in [('http', 80), ('https', 443)]:
+        host += f':{parts.port}'
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    query = sorted((name, value) for name, value in query if not name.lower().startswith(TrackingParams))
+    return urllib.parse.urlunsplit((scheme, host, parts.path or '/', urllib.parse.urlencode(query), ''))
+
+# tags without content of the page
+NoiseTags = ['script', 'style', 'noscript', 'template', 'svg', 'iframe', 'form', 'button', 'nav', 'header', 'footer', 'aside']
+# pages of other types are not downloaded
+PageTypes = ['text/html', 'application/xhtml+xml', 'text/plain']
+
+def link_density(node, text_length):
+    '''
+    Share of the text of node that is in links (menus and link lists have high density)
+    '''
+    if text_length == 0:
+        return 1
+    return sum(len(link.get_text(strip=True)) for link in node.find_all('a')) / text_length
+
+def select_content(body):
+    '''
+    Find the element with the main content of the page (readability-style)
+    <article> or <main> is used if it has enough text, otherwise paragraphs give points
+    to their parent (and half of them to grandparent), the element with most points
+    (less the share of links) wins. Whole body is used if there are no paragraphs.
+    '''
+    for node in [body.find('article'), body.find('main'), body.find(attrs={'role': 'main'})]:
+        if node is not None and len(node.get_text(strip=True)) >= 500:
+            return node
+    candidates = {}
+    for paragraph in body.find_all(['p', 'pre']):
+        text = paragraph.get_text(' ', strip=True)
+        if len(text) < 25:
+            continue
+        points = 1 + text.count(',') + min(len(text) // 100, 3)
+        for node, share in [(paragraph.parent, 1), (paragraph.parent.parent if paragraph.parent is not None else None, 0.5)]:
+            if node is None:
+                continue
+            score = candidates.setdefault(id(node), [node, 0])
+            score[1] += points * share
+    best, best_score = body, 0
+    for node, points in candidates.values():
+        points *= 1 - link_density(node, len(node.get_text(strip=True)))
+        if points > best_score:
+            best, best_score = node, points
+    return best
+
+def extract_text(content, encoding=None, content_type='text/html', trim_len=None):
+    '''
+    Get text of the main content of the page (blocking, runs in a worker thread)
+    Input:
+        * content - body of the page (bytes)
+        * encoding - encoding from headers (encoding from <meta> is used if it is None)
+        * content_type - content type of the page
+        * trim_len - maximum length of text, extraction stops when it is reached
+    Output: text of the page in one line or None if there is no text
+    '''
+    if content_type == 'text/plain':
+        try:
+            strings = content.decode(encoding or 'utf-8', errors='replace').split()
+        except LookupError:
+            strings = content.decode('utf-8', errors='replace').split()
+    else:
+        soup = BeautifulSoup(content, HTMLParser, from_encoding=encoding)
+        for tag in soup.find_all(NoiseTags):
+            tag.decompose()
+        body = soup.find('body') or soup
+        strings = select_content(body).stripped_strings
+    # text is collected only up to trim length
+    parts, length = [], 0
+    for string in strings:
+        parts.append(' '.join(string.split()))
+        length += len(parts[-1]) + 1
+        if trim_len is not None and length >= trim_len:
+            break
+    text = ' '.join(parts)
+    if trim_len is not None:
+        text = text[:trim_len]
+    if len(text) < 5:
+        return None
+    return text
+
+def freshness(headers, default_ttl, max_ttl):
+    '''
+    How long (in seconds) response can be used without revalidation according to Cache-Control and Expires headers
+    None if response should not be stored (no-store, private), 0 if it should be revalidated every time (no-cache)
+    '''
+    directives = {}
+    for directive in headers.get('Cache-Control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name] = value.strip('"')
+    # pages are shared between users, so private pages are not stored
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for name in ['s-maxage', 'max-age']:
+        if name in directives:
+            try:
+                return min(max(int(directives[name]), 0), max_ttl)
+            except ValueError:
+                return 0
+    if headers.get('Expires') is not None:
+        try:
+            return min(max(parsedate_to_datetime(headers.get('Expires')).timestamp() - time.time(), 0), max_ttl)
+        except Exception:
+            # invalid date means already expired
+            return 0
+    return default_ttl
+
 class GoogleEngine:
     '''
     Google Search Engine
@@ -38,6 +186,8 @@ class GoogleEngine:
         self.search_results = min(self.search_results, 10)
         self.search_results = max(self.search_results, 1)
         self.base_url = "https://www.googleapis.com/customsearch/v1"
+        # connections are pooled and shared with other web tools
+        self.client = get_web_client()
         logger.info('Google Engine Initialized')
 
     async def format_data(self, data):
@@ -60,11 +210,10 @@ class GoogleEngine:
         }
         try:
             logger.debug(f'Searching for: "{query}". Results number: {self.search_results}')
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.base_url, params=params) as response:
-                    data = await response.json()
-                    data = await self.format_data(data)
-                    return data
+            response = await self.client.get(self.base_url, params=params)
+            data = response.json()
+            data = await self.format_data(data)
+            return data
         except Exception as e:
             logger.error(f'Error while searching: {e}')
             return None
@@ -77,36 +226,244 @@ class URLOpen:
     '''
     def __init__(self):
         self.trim_len = config.getint("Web", "TrimLength") if config.has_option("Web", "TrimLength") else None
-        logger.info(f'URL Open Initialized, trim length: {self.trim_len}')
+        # parsed pages are cached (size is in characters of text), stale pages are revalidated with ETag and Last-Modified
+        self.cache_ttl = config.getint("Web", "URLCacheTTL") if config.has_option("Web", "URLCacheTTL") else 600
+        self.cache_max_ttl = config.getint("Web", "URLCacheMaxTTL") if config.has_option("Web", "URLCacheMaxTTL") else 86400
+        cache_size = config.getint("Web", "URLCacheSize") if config.has_option("Web", "URLCacheSize") else 5000000
+        # only the beginning of big pages is downloaded
+        self.max_page_size = config.getint("Web", "MaxPageSize") if config.has_option("Web", "MaxPageSize") else 2000000
+        # stale pages are kept for revalidation as long as fresh ones at most
+        self.cache = TTLCache(max_size=cache_size, ttl=self.cache_max_ttl, sizeof=lambda entry: len(entry["text"]))
+        self.flights = SingleFlight()
+        self.client = get_web_client()
+        # links from user messages are opened while the model is thinking (it will most likely ask for them)
+        self.prefetch_enabled = config.getboolean("Web", "Prefetch") if config.has_option("Web", "Prefetch") else True
+        self.prefetch_limit = config.getint("Web", "PrefetchLimit") if config.has_option("Web", "PrefetchLimit") else 3
+        self.prefetch_size = config.getint("Web", "PrefetchMaxSize") if config.has_option("Web", "PrefetchMaxSize") else 1000000
+        self.prefetch_semaphore = asyncio.Semaphore(config.getint("Web", "PrefetchConcurrency") if config.has_option("Web", "PrefetchConcurrency") else 4)
+        self.prefetch_stats = {"started": 0, "used": 0, "cancelled": 0}
+        logger.info(f'URL Open Initialized, trim length: {self.trim_len}, cache size: {cache_size}, prefetch: {self.prefetch_enabled}')
 
-    async def parse_data(self, data):
+    async def parse_data(self, data, encoding=None, content_type='text/html'):
+        '''
+        Extract main text of the page (bytes or str) in a worker thread, so the bot is not blocked by big pages
+        '''
         try:
-            soup = BeautifulSoup(data, 'html.parser')
-            body = soup.find('body')
-            text = ''
-            for tag in body.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'a', 'li', 'ul', 'ol', 'blockquote']):
-                text += tag.get_text().strip() + '\n'
-            text = text.replace('\n', ' ')
-            if self.trim_len is not None:
-                text = text[:self.trim_len]
-            if len(text) < 5:
-                text = None
-            return text
+            if type(data) == str:
+                data, encoding = data.encode('utf-8'), 'utf-8'
+            return await asyncio.to_thread(extract_text, data, encoding, content_type, self.trim_len)
         except Exception as e:
             logger.error(f'Error while parsing data: {e}')
             return None
 
-    async def open_url(self, url):
+    async def open_url(self, url, max_bytes=None):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    data = await response.text()
-                    data = await self.parse_data(data)
-                    return data
+            key = normalize_url(url)
+            entry = self.cache.get(key)
+            if entry is not None and entry["fresh_until"] > time.time():
+                logger.debug(f'URL {key} was taken from the cache')
+                return entry["text"]
+            # the same page requested by several users at once is downloaded once
+            # (requests with a smaller size limit, e.g. prefetches, do not share the download with full ones)
+            limit = min(max_bytes or self.max_page_size, self.max_page_size)
+            return await self.flights.run((key, limit), lambda: self.fetch(url, key, entry, limit))
         except Exception as e:
             logger.error(f'Error while opening URL: {e}')
             return None
+
+    def prefetch(self, text):
+        '''
+        Start opening links from text in background
+        Output: {normalized URL: task}, tasks should be cancelled if they are not used (see cancel_prefetch)
+        '''
+        tasks = {}
+        if not self.prefetch_enabled:
+            return tasks
+        for url in find_urls(text)[:self.prefetch_limit]:
+            try:
+                key = normalize_url(url)
+            except ValueError:
+                continue
+            if key not in tasks:
+                tasks[key] = asyncio.create_task(self.prefetch_url(url))
+                self.prefetch_stats["started"] += 1
+        if len(tasks) > 0:
+            logger.debug(f'Prefetching {len(tasks)} links: {", ".join(tasks)}')
+        return tasks
+
+    async def prefetch_url(self, url):
+        async with self.prefetch_semaphore:
+            return await self.open_url(url, max_bytes=self.prefetch_size)
+
+    async def open_prefetched(self, url, tasks):
+        '''
+        Open URL using prefetch task if there is one
+        '''
+        task = tasks.get(normalize_url(url)) if tasks else None
+        if task is None or task.cancelled():
+            return await self.open_url(url)
+        self.prefetch_stats["used"] += 1
+        # shield: timeout of the tool call should not cancel the task, it is cancelled with other prefetches
+        return await asyncio.shield(task)
+
+    def cancel_prefetch(self, tasks):
+        '''
+        Cancel prefetch tasks that are not finished (links were not requested by the model)
+        '''
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+                self.prefetch_stats["cancelled"] += 1
+
+    async def fetch(self, url, key, entry=None, max_bytes=None):
+        '''
+        Download and parse the page, stale cache entry is revalidated (not downloaded again if it is not modified)
+        Page cut by a limit smaller than MaxPageSize is not cached, so it is not returned to requests with the full limit
+        '''
+        max_bytes = min(max_bytes or self.max_page_size, self.max_page_size)
+        headers = {}
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = await self.client.get(url, headers=headers, binary=True, max_bytes=max_bytes, content_types=PageTypes)
+        lifetime = freshness(response.headers, self.cache_ttl, self.cache_max_ttl)
+        if response.status_code == 304 and entry is not None:
+            logger.debug(f'URL {key} was not modified')
+            if lifetime is not None:
+                self.cache.set(key, dict(entry, fresh_until=time.time() + lifetime))
+            return entry["text"]
+        if response.content is None:
+            logger.warning(f'URL {key} was not opened, content type: {response.headers.get("Content-Type")}')
+            return None
+        if response.truncated:
+            logger.debug(f'Only the first {max_bytes} bytes of {key} were downloaded')
+        content_type = response.headers.get('Content-Type', 'text/html').split(';')[0].strip().lower()
+        encoding = None
+        for parameter in response.headers.get('Content-Type', '').split(';')[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name.lower() == 'charset':
+                encoding = value.strip('"\' ')
+        data = await self.parse_data(response.content, encoding, content_type)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        # page that should be revalidated every time is stored only if it can be revalidated
+        cacheable = not response.truncated or max_bytes >= self.max_page_size
+        if cacheable and response.status_code == 200 and data is not None and lifetime is not None and (lifetime > 0 or etag is not None or last_modified is not None):
+            self.cache.set(key, {
+                "text": data,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fresh_until": time.time() + lifetime,
+            })
+        return data
         
+# words and sentence boundaries for ranking of passages
+WordPattern = re.compile(r'\w+', re.UNICODE)
+SentencePattern = re.compile(r'(?<=[.!?])\s+')
+
+def split_passages(text, size=400):
+    '''
+    Split text into passages of about size characters on sentence boundaries
+    '''
+    passages, current = [], ''
+    for sentence in SentencePattern.split(text):
+        if len(current) > 0 and len(current) + len(sentence) > size:
+            passages.append(current)
+            current = ''
+        current = f'{current} {sentence}' if current else sentence
+    if len(current) > 0:
+        passages.append(current)
+    return passages
+
+def rank_passages(query, pages, limit=6, max_length=4000):
+    '''
+    Find passages of pages that are the most relevant to the query (BM25)
+    Input:
+        * query - search query
+        * pages - list of (source, text)
+        * limit - maximum number of passages
+        * max_length - maximum total length of passages
+    Output: list of (source, passage) in order of relevance
+    '''
+    terms = set(word.lower() for word in WordPattern.findall(query) if len(word) > 1)
+    passages = [(source, passage) for source, text in pages for passage in split_passages(text)]
+    if len(terms) == 0 or len(passages) == 0:
+        return []
+    words = [[word.lower() for word in WordPattern.findall(passage)] for source, passage in passages]
+    average = sum(len(passage_words) for passage_words in words) / len(words) or 1
+    frequency = {term: sum(1 for passage_words in words if term in passage_words) for term in terms}
+    scores = []
+    for i, passage_words in enumerate(words):
+        score = 0
+        for term in terms:
+            count = passage_words.count(term)
+            if count == 0:
+                continue
+            idf = math.log(1 + (len(words) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+            score += idf * count * 2.2 / (count + 1.2 * (0.25 + 0.75 * len(passage_words) / average))
+        if score > 0:
+            scores.append((score, i))
+    ranked, length = [], 0
+    for score, i in sorted(scores, reverse=True):
+        if len(ranked) >= limit:
+            break
+        if length + len(passages[i][1]) > max_length:
+            continue
+        ranked.append(passages[i])
+        length += len(passages[i][1])
+    return ranked
+
+
+class WebResearch:
+    '''
+    Web research: search, read the top results at once and return the most relevant passages
+    Saves tool rounds: the model gets content of pages in one call instead of
+    calling web search and then opening links one by one.
+    '''
+    def __init__(self, search_engine, urlopener):
+        '''
+        Input:
+            * search_engine - search engine (GoogleEngine)
+            * urlopener - URLOpen (pages are opened with its cache)
+        '''
+        self.search_engine = search_engine
+        self.urlopener = urlopener
+        self.pages = config.getint("Web", "ResearchPages") if config.has_option("Web", "ResearchPages") else 3
+        self.timeout = config.getfloat("Web", "ResearchTimeout") if config.has_option("Web", "ResearchTimeout") else 10.0
+        self.passages = config.getint("Web", "ResearchPassages") if config.has_option("Web", "ResearchPassages") else 6
+        self.max_length = config.getint("Web", "ResearchLength") if config.has_option("Web", "ResearchLength") else 4000
+        logger.info(f'Web Research Initialized, pages: {self.pages}, timeout: {self.timeout}s')
+
+    async def research(self, query):
+        '''
+        Search the web and read top results
+        Output: text with search results and relevant passages (None if search failed)
+        '''
+        results = await self.search_engine.search(query)
+        if results is None:
+            return None
+        top = results[:self.pages]
+        tasks = [asyncio.create_task(self.urlopener.open_url(result["link"])) for result in top]
+        # pages that are not opened in time are skipped
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout) if len(tasks) > 0 else (set(), set())
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            logger.debug(f'{len(pending)} of {len(tasks)} pages were not opened in {self.timeout:g}s')
+        pages = []
+        for result, task in zip(top, tasks):
+            if task in done and task.result() is not None:
+                pages.append((result["link"], task.result()))
+        passages = await asyncio.to_thread(rank_passages, query, pages, self.passages, self.max_length)
+        text = 'Search results:\n'
+        text += '\n'.join(f'- {result["title"]} ({result["link"]}): {result["snippet"]}' for result in results)
+        if len(passages) > 0:
+            text += '\nRelevant passages from the top pages:\n'
+            text += '\n'.join(f'[{source}] {passage}' for source, passage in passages)
+        return text
+
 if __name__ == "__main__":
     urlopener = URLOpen()
     url = 'https://www.wikipedia.org/'
@@ -6,10 +6,13 @@ import sys
 import os
 import time
 from telegram import ForceReply, Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from telegram.constants import ChatAction
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, SimpleUpdateProcessor
+from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest, RetryAfter
 import codecs
 import pickle
+import signal
+import weakref
 from functools import wraps
 from datetime import datetime
 
@@ -61,9 +64,10 @@ except:
 # check if './data/rates.txt' exists
 if not os.path.exists('./data/rates.txt'):
     logger.warning('File with rates does not exist.')
-    rates_exists = False
-else:
-    rates_exists = True
+
+# whitelist, banlist, rates and chat modes are read once and reloaded only when files are changed
+from chatutils.registry import AccessRegistry
+registry = AccessRegistry()
 
 if config.has_option("Telegram", "AccessCodes"):
     accesscodes = config.get("Telegram", "AccessCodes").split(',') 
@@ -86,6 +90,13 @@ else:
 # Check if bot should reply to message
 message_reply = config.getboolean("Telegram", "ReplyToMessage", fallback=False)
 
+# Number of updates processed at the same time (updates of one user are still processed in order)
+concurrent_updates = config.getint("Telegram", "ConcurrentUpdates", fallback=16)
+
+# Check if answers should be streamed (message is edited while answer is generated)
+stream_answers = config.getboolean("Telegram", "StreamAnswers", fallback=False)
+stream_edit_interval = config.getfloat("Telegram", "StreamEditInterval", fallback=1.5)
+
 # check if file functionality is enabled
 if config.has_section('Files'):
     files_enabled = True
@@ -108,32 +119,8 @@ else:
     max_file_size = max_file_size_limit
     logger.warning(f"Max file size is not set. Setting it to {max_file_size_limit}.")
 
-def get_rates():
-    '''
-    Get rates from the txt file
-    Example of txt (user_id, number of requests per time stated in config file):
-    123465,100
-    456789,200
-    '''
-    try:
-        user_rates = {}
-        # if file exists, read it
-        if os.path.exists('./data/rates.txt'):
-            with codecs.open('./data/rates.txt', 'r', 'utf-8') as f:
-                for line in f:
-                    user_id, rate = line.split(',')
-                    user_rates[int(user_id)] = int(rate)
-        # if file does not exist, return None
-        else:
-            logger.debug('Rates file does not exist.')
-            return None
-        return user_rates
-    except Exception as e:
-        logger.exception('Could not get rates from file.')
-        return None
-
 if config.has_option("Telegram", "RateLimitTime"):
-    user_rates = get_rates()
+    user_rates = registry.rates()
     if user_rates is not None and user_rates != {}:
         print(f"Limits for some ({len(user_rates)}) users are set (0 - unlimited).")
         for user_id, rate in user_rates.items():
@@ -152,6 +139,10 @@ IMAGE_GENERATION = gpt.image_generation
 SPEECH = gpt.speech_engine
 from chatutils.filesproc import FilesProc
 fp = FilesProc()
+from chatutils.ratelimit import RateLimiter
+rate_limiter = None
+if ratelimit_time is not None and ratelimit_time > 0:
+    rate_limiter = RateLimiter(window=ratelimit_time, location='./data/tech/ratelimit.pickle', persistence=gpt.persistence, name='ratelimit')
 
 ################################## Authorization ###############################################
 
@@ -163,8 +154,7 @@ def check_code(code, user_id) -> bool:
     try:
         if code in accesscodes:
             # add user to whitelist if code is correct
-            with codecs.open("./data/whitelist.txt", "a", "utf-8") as f:
-                f.write(str(user_id)+'\n')
+            registry.add_to_whitelist(user_id)
             logger.info('Granted access to user with ID: ' + str(user_id) + '. Code used: ' + code)
             return True
     except Exception as e:
@@ -175,32 +165,10 @@ async def check_user(update, message=None, check_rate=True) -> bool:
     '''
     Check if user has an access
     '''
-    # read banlist
-    if banlist_enabled:
-        try:
-            with codecs.open("./data/banlist.txt", "r", "utf-8") as f:
-                # Read the contents of the file into a list
-                lines = f.readlines()
-            banlist = [line.rstrip('\n') for line in lines]
-        except:
-            logger.exception('No banlist or it is not possible to read it')
-            banlist = []
-
-    # read whitelist
-    if accesscodes is not None:
-        try:
-            with codecs.open("./data/whitelist.txt", "r", "utf-8") as f:
-                # Read the contents of the file into a list
-                lines = f.readlines()
-            whitelist = [line.rstrip('\n') for line in lines]
-        except:
-            logger.warning('No whitelist or it is not possible to read it')
-            whitelist = []
-
     user = update.effective_user
     # check if user is in banlist
     if banlist_enabled:
-        if str(user.id) in banlist:
+        if registry.is_banned(user.id):
             logger.warning("Restricted access to banned user: " + str(user))
             await update.message.reply_text("You are banned.")
             return False
@@ -210,7 +178,7 @@ async def check_user(update, message=None, check_rate=True) -> bool:
         return True
 
     # check if user is in whitelist
-    if str(user.id) not in whitelist:
+    if not registry.is_whitelisted(user.id):
         # if not, check if user sent access code
         if message is not None:
             if check_code(message, user.id):
@@ -241,6 +209,20 @@ async def check_user(update, message=None, check_rate=True) -> bool:
     return True
 
 # Decorator for authorization check
+# updates are processed concurrently, but updates of the same user are processed one by one
+# (lock exists only while someone holds or waits for it)
+user_locks = weakref.WeakValueDictionary()
+
+def user_lock(user_id) -> asyncio.Lock:
+    '''
+    Get lock of user (updates of one user should not change chat history at the same time)
+    '''
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[user_id] = lock
+    return lock
+
 def is_authorized(func):
     '''
     Check if user is authorized to use the bot (in whitelist)
@@ -251,8 +233,15 @@ def is_authorized(func):
     if func_called in ['statistics_command', 'delete_command', 'limit_command']:
         logger.debug(f'Rate limit is not checked for function {func_called}')
         check_rate = False
+    # read-only commands do not wait for other updates of the user
+    ordered = func_called not in ['statistics_command', 'limit_command']
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if not ordered:
+            return await authorized_call(update, context, *args, **kwargs)
+        async with user_lock(update.effective_user.id):
+            return await authorized_call(update, context, *args, **kwargs)
+    async def authorized_call(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         # check if user is in whitelist
         text = update.message.text if update.message is not None else None
         access = await check_user(update, text, check_rate=check_rate)
@@ -264,6 +253,131 @@ def is_authorized(func):
         return await func(update, context, *args, **kwargs)
     return wrapped
 
+class StreamingReply:
+    '''
+    Answer that is shown while it is generated
+    Placeholder message is sent first and then edited with accumulated text not more often
+    than every `interval` seconds (Telegram limits edits). If text is longer than max_length,
+    next part is sent as a new message. Final text is set with finish().
+    '''
+    def __init__(self, update: Update, interval=1.5, max_length=4096, placeholder='...'):
+        self.update = update
+        self.interval = interval
+        self.max_length = max_length
+        self.placeholder = placeholder
+        self.text = ''
+        self.messages = []
+        self.shown = []
+        self.last_edit = 0
+        self.final_attempts = 3
+
+    async def start(self):
+        '''
+        Send placeholder message
+        '''
+        try:
+            message = await self.update.message.reply_text(self.placeholder, reply_to_message_id=self.update.message.message_id if message_reply else None)
+            self.messages.append(message)
+            self.shown.append((self.placeholder, False))
+            self.last_edit = time.monotonic()
+        except Exception as e:
+            logger.error(f'Could not send placeholder message: {e}')
+
+    async def add(self, text):
+        '''
+        Add piece of the answer (used as stream_callback)
+        '''
+        self.text += text
+        if time.monotonic() - self.last_edit >= self.interval:
+            await self.show(self.text)
+
+    def split(self, text):
+        '''
+        Split text into parts that fit into messages (empty parts can not be sent)
+        '''
+        parts = [text[i:i+self.max_length] for i in range(0, len(text), self.max_length)]
+        return [part for part in parts if part.strip() != '']
+
+    async def show(self, text, markdown=False):
+        '''
+        Show text in sent messages (edit changed parts, send new ones if needed)
+        Output: seconds to wait if Telegram asked to slow down (parts after it were not shown), None otherwise
+        '''
+        if len(self.messages) == 0:
+            return None
+        self.last_edit = time.monotonic()
+        for index, part in enumerate(self.split(text)):
+            try:
+                if index >= len(self.messages):
+                    message = await self.update.message.reply_text(part)
+                    self.messages.append(message)
+                    self.shown.append((part, False))
+                if self.shown[index] != (part, markdown):
+                    await self.edit(self.messages[index], part, markdown)
+                    self.shown[index] = (part, markdown)
+            except RetryAfter as e:
+                # wait with the next edit as long as Telegram asks
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.debug(f'Telegram asked to slow down message edits for {retry_after} seconds')
+                self.last_edit = time.monotonic() + float(retry_after)
+                return float(retry_after)
+            except Exception as e:
+                logger.debug(f'(!) Could not update streamed message: {e}')
+        return None
+
+    async def edit(self, message, text, markdown=False):
+        if markdown:
+            try:
+                await message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+                return
+            except RetryAfter:
+                raise
+            except Exception as e:
+                logger.debug(f'(!) Error editing message (markdown - {e}): {text}')
+        try:
+            await message.edit_text(text)
+        except BadRequest as e:
+            # text was not changed
+            if 'not modified' not in str(e):
+                raise
+
+    async def finish(self, text):
+        '''
+        Show final answer (with markdown), send it as a new message if placeholder was not sent
+        '''
+        if len(self.messages) == 0:
+            await send_message(self.update, text, markdown=1)
+            return
+        self.text = text
+        for attempt in range(self.final_attempts):
+            # previous edit could be throttled by Telegram
+            wait = self.last_edit - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if await self.show(text, markdown=True) is None:
+                break
+        else:
+            logger.warning(f'Final answer was not shown in {self.final_attempts} attempts, Telegram kept throttling edits')
+        # streamed text could take more messages than the final one
+        parts = len(self.split(text))
+        for message in self.messages[parts:]:
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.debug(f'(!) Could not delete streamed message: {e}')
+        self.messages, self.shown = self.messages[:parts], self.shown[:parts]
+
+    async def discard(self):
+        '''
+        Delete sent messages (e.g. if answer is an image)
+        '''
+        for message in self.messages:
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.debug(f'(!) Could not delete streamed message: {e}')
+        self.messages, self.shown = [], []
+
 ################################## Commands ###################################################
 
 async def ratelimiter(user_id, check=False):
@@ -276,10 +390,7 @@ async def ratelimiter(user_id, check=False):
         return None
     
     # get the limits for users
-    if rates_exists:
-        user_rates = get_rates()
-    else:
-        user_rates = None 
+    user_rates = registry.rates()
 
     # if user is in the dict, get the limit
     if user_rates is not None and user_rates != {}:
@@ -303,68 +414,17 @@ async def ratelimiter(user_id, check=False):
             limit = int(ratelimit_general)
 
     try:
-        # open the pickle file with the dict if exists
-        try:
-            if os.path.exists('./data/tech/ratelimit.pickle'):
-                with open('./data/tech/ratelimit.pickle', 'rb') as f:
-                    rate = pickle.load(f)
-            else:
-                logger.info('No ratelimit.pickle file found. Creating a new one.')
-                rate = {}
-                with open('./data/tech/ratelimit.pickle', 'wb') as f:
-                    pickle.dump(rate, f)
-        except Exception as e:
-            logger.error(f'Error while opening ratelimit.pickle. Error: {e}')
-            rate = {}
-        
-        # create a function to check if user is in the dict
-        if user_id not in rate:
-            rate[user_id] = []
-        # delete old values from the list 
-        if len(rate[user_id]) > 0:
-            rate[user_id] = [x for x in rate[user_id] if x > time.time() - ratelimit_time]
-            # if the list is longer than the limit, return False
-            if (len(rate[user_id]) > limit) and check != True:
-                return False
-        # add new value to the list
-        if not check:
-            rate[user_id].append(time.time())
-        # save the dict to a pickle file
-        with open('./data/tech/ratelimit.pickle', 'wb') as f:
-            pickle.dump(rate, f)
+        # messages of users are kept in memory (state is saved in background)
         if check: 
-            if len(rate[user_id]) > limit:
+            used = rate_limiter.usage(user_id)
+            if used >= limit:
                 return f"Rate limit of {limit} messages per {ratelimit_time} seconds exceeded. Please wait."
-            return f"You have used your limit of {len(rate[user_id])}/{limit} messages per {ratelimit_time} seconds."
-        return True
+            return f"You have used your limit of {used}/{limit} messages per {ratelimit_time} seconds."
+        return rate_limiter.hit(user_id, limit)
     except Exception as e:
         logger.exception('Could not create rate limiter. Rate is not limited.')
         return None
 
-async def chat_modes_read(filepath='./data/chat_modes.ini'):
-    '''
-    Read chat modes from a ini file. Returns a dict with the chat mode names as keys and a dict with the description and system message as values.
-    INI example:
-        [Alice]
-        Description = Alice is empathetic and friendly
-        SystemMessage = You are a empathetic and friendly woman named Alice, who answers helpful, funny and a bit flirty.
-    '''
-    try:
-        # read chat modes from file
-        chat_modes = configparser.ConfigParser()
-        chat_modes.read(filepath)
-        # create a dict with chat modes
-        modes = {}
-        for mode in chat_modes.sections():
-            modes[mode] = {
-                'Desc': chat_modes[mode]['Description'],
-                'SystemMessage': chat_modes[mode]['SystemMessage']
-            }
-        return modes
-    except Exception as e:
-        logger.exception('Could not read chat modes from file: ' + filepath)
-        return None
-
 async def escaping(text):
    '''
    Inside (...) part of inline link definition, all ')' and '\' must be escaped with a preceding '\' character.
@@ -416,17 +476,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     Send a message when the command /start is issued.
     '''
     user = update.effective_user
-    # check if user is in whitelist
-    access = await check_user(update, update.message.text)
-    # if yes, send welcome message
-    if access == True:
-        answer = await gpt.chat(id=user.id, message=rf"Hi! I'm {user.full_name}!")
-        if answer is None:
-            answer = "Sorry, something went wrong. Please try again later."
-            logger.error('Could not get answer to start message')
-        await send_message(update, answer)
-    else:
-        logger.info("Restricted access to: " + str(user))
+    async with user_lock(user.id):
+        # check if user is in whitelist
+        access = await check_user(update, update.message.text)
+        # if yes, send welcome message
+        if access == True:
+            answer = await gpt.chat(id=user.id, message=rf"Hi! I'm {user.full_name}!")
+            if answer is None:
+                answer = "Sorry, something went wrong. Please try again later."
+                logger.error('Could not get answer to start message')
+            await send_message(update, answer)
+        else:
+            logger.info("Restricted access to: " + str(user))
 
 @is_authorized
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -516,7 +577,11 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await application.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
     message = update.message.text
-    answer = await gpt.chat(id=update.effective_user.id, message=message)
+    reply = None
+    if stream_answers:
+        reply = StreamingReply(update, interval=stream_edit_interval)
+        await reply.start()
+    answer = await gpt.chat(id=update.effective_user.id, message=message, stream_callback=reply.add if reply is not None else None)
     
     # DEBUG
     logger.debug(f'>> Username: {update.effective_user.username}. Message: {update.message.text}')
@@ -533,10 +598,14 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             logger.debug(f'<< Username: {update.effective_user.username}. Answer - Image ({answer[2]}')
             image_bytes = base64.b64decode(answer[1])
             await update.message.reply_photo(photo=image_bytes)
-
+            if reply is not None and reply.text.strip() == '':
+                await reply.discard()
             return None
     logger.debug(f'<< Username: {update.effective_user.username}. Answer: {answer}')
-    await send_message(update, answer, markdown=1)
+    if reply is not None:
+        await reply.finish(answer)
+    else:
+        await send_message(update, answer, markdown=1)
 
 @is_authorized
 async def answer_voice_or_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -589,7 +658,7 @@ async def style_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     '''
     user = update.effective_user
     # read chat modes
-    modes = await chat_modes_read()
+    modes = registry.chat_modes()
     if modes is None:
         await update.message.reply_text('Sorry, something went wrong. Please try again later.')
         return None
@@ -624,7 +693,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
     user = update.effective_user
     # read chat modes
-    modes = await chat_modes_read()
+    modes = registry.chat_modes()
     if modes is None:
         await update.message.reply_text('Sorry, something went wrong. Please try again later.')
         return None
@@ -855,13 +924,49 @@ async def imagine_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ###############################################################################################
 
+class FastLaneUpdateProcessor(SimpleUpdateProcessor):
+    '''
+    Limits number of updates processed at the same time,
+    but cheap commands (/statistics, /limit, /delete) do not wait for a free slot
+    behind long requests to providers
+    '''
+    fast_commands = ['/statistics', '/limit', '/delete']
+
+    async def process_update(self, update, coroutine) -> None:
+        message = getattr(update, 'message', None)
+        if message is not None and message.text is not None:
+            command = message.text.split()[0].split('@')[0] if message.text.strip() != '' else ''
+            if command in self.fast_commands:
+                await self.do_process_update(update, coroutine)
+                return
+        await super().process_update(update, coroutine)
+
+async def post_init(application: Application) -> None:
+    '''
+    Start background tasks when event loop is running
+    '''
+    await gpt.start()
+
+async def post_shutdown(application: Application) -> None:
+    '''
+    Stop background tasks and write all pending changes
+    '''
+    await gpt.stop()
+
 def main() -> None:
     '''
     Start the bot.
     '''
     global application
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(FastLaneUpdateProcessor(max(concurrent_updates, 1)))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -895,6 +1000,10 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.Document.Category('application/vnd.openxmlformats-officedocument.presentationml.presentation'), downloader))
     application.add_handler(MessageHandler(filters.Document.Category('text/plain'), downloader))
 
+    # reload whitelist, banlist, rates and chat modes on SIGHUP (kill -HUP <pid>)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: registry.reload())
+
     # Run the bot until the Ctrl-C is pressed
     application.run_polling()
 